@@ -0,0 +1,165 @@
+"""
+author: @nimrobotics
+description: benchmark the processing stages on synthetic recordings, results are stored
+             as json per version so that regressions are visible between versions
+usage: python benchmark.py --scenarios small medium --label v1.0 --compare results/v0.9.json
+"""
+
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from fnirslib.fnirslib import Fnirslib
+from fnirslib.cohort import Cohort
+from synthetic import generate_recording, generate_cohort, write_recording, make_regions
+import numpy as np
+import argparse
+import datetime
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+# duration in seconds, sampling frequency, channels, regions, trials per condition, subjects for the cohort stage
+SCENARIOS = {'small': dict(duration=600, freq=10, nChannels=16, nRegions=4, nTrials=15, nSubjects=4),
+             'medium': dict(duration=3600, freq=10, nChannels=46, nRegions=11, nTrials=100, nSubjects=8),
+             'large': dict(duration=10800, freq=10, nChannels=200, nRegions=20, nTrials=200, nSubjects=4)}
+STAGES = ['load_nirs', 'sanity_check', 'get_ROI_concat', 'get_ROI_mean', 'get_local_baseline', 'cluster_channels',
+          'detrend', 'peak_activation', 'functional_connectivity', 'cohort']
+
+def measure(fn, repeat, minTime=0.05):
+    """
+    Time a function and record its peak memory. Fast functions are called in a loop
+    so that each timed run takes at least minTime
+    :param fn: function without arguments
+    :param repeat: number of timed runs
+    :param minTime: minimum duration of a timed run in seconds
+    :return: dict with the min and median wall time per call in seconds and the peak traced memory in MB
+    """
+    number = 1
+    while True: # calibrate the number of calls per run, as timeit
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter()-start
+        if elapsed >= minTime:
+            break
+        number = max(2*number, int(number*minTime/max(elapsed, 1e-9)))
+    times = [elapsed/number]
+    for _ in range(repeat-1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter()-start)/number)
+    tracemalloc.start() # separate run, tracing slows down the allocations
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'min': min(times), 'median': float(np.median(times)), 'peakMB': peak/2**20, 'number': number}
+
+def run_scenario(name, params, repeat, directory):
+    """
+    Benchmark all stages on one scenario
+    :param name: scenario name
+    :param params: scenario parameters, see SCENARIOS
+    :param repeat: number of timed runs per stage
+    :param directory: directory for the generated files
+    :return: dict of stage results
+    """
+    freq = params['freq']
+    recording = dict(duration=params['duration'], freq=freq, nChannels=params['nChannels'], nTrials=params['nTrials'])
+    regions = make_regions(params['nChannels'], params['nRegions'])
+    filename = str(Path(directory)/'{}.nirs'.format(name))
+    write_recording(filename, *generate_recording(**recording))
+    fnirs = Fnirslib(filename, regions, 1, 'condition_1')
+
+    # inputs of each stage, computed once
+    data, stims = fnirs.load_nirs()
+    concat, _ = fnirs.get_ROI(data, stims, aggMethod='concat')
+    mean, _ = fnirs.get_ROI(data, stims, aggMethod='mean')
+    baseline = fnirs.get_local_baseline(data, stims, 0, duration=2, freq=freq)
+    clustered = fnirs.cluster_channels(fnirs.detrend(concat))
+    files = generate_cohort(Path(directory)/name, params['nSubjects'], **recording)
+    cohort = Cohort(files, regions, [1, 2], ['condition_1', 'condition_2'], freq)
+
+    stages = {'load_nirs': lambda: fnirs.load_nirs(),
+              'sanity_check': lambda: fnirs.sanity_check(data, stims),
+              'get_ROI_concat': lambda: fnirs.get_ROI(data, stims, aggMethod='concat'),
+              'get_ROI_mean': lambda: fnirs.get_ROI(data, stims, aggMethod='mean'),
+              'get_local_baseline': lambda: fnirs.get_local_baseline(data, stims, 0, duration=2, freq=freq),
+              'cluster_channels': lambda: fnirs.cluster_channels(concat),
+              'detrend': lambda: fnirs.detrend(concat),
+              'peak_activation': lambda: fnirs.peak_activation(mean[:,0,:], baseline, peakPadding=5),
+              'functional_connectivity': lambda: fnirs.functional_connectivity(clustered[:,0,:].T),
+              'cohort': lambda: cohort.run(workers=1)}
+    results = {}
+    for stage in STAGES:
+        results[stage] = measure(stages[stage], repeat)
+        print('{:>10} {:>24}: {:10.3f} ms (median {:10.3f} ms), peak {:9.1f} MB'.format(
+            name, stage, 1e3*results[stage]['min'], 1e3*results[stage]['median'], results[stage]['peakMB']))
+    return results
+
+def compare(results, reference, threshold):
+    """
+    Print the time ratio of each stage to a reference run
+    :param results: benchmark results
+    :param reference: reference benchmark results
+    :param threshold: ratio above which a stage counts as a regression
+    :return: list of (scenario, stage, ratio) regressions
+    """
+    regressions = []
+    print('\nCompared to {}:'.format(reference['label']))
+    for name, stages in results['scenarios'].items():
+        for stage, result in stages.items():
+            ref = reference['scenarios'].get(name, {}).get(stage)
+            if ref is None:
+                continue
+            ratio = result['min']/ref['min']
+            flag = ' REGRESSION' if ratio > threshold else ''
+            print('{:>10} {:>24}: {:6.2f}x time, {:6.2f}x memory{}'.format(
+                name, stage, ratio, result['peakMB']/max(ref['peakMB'], 1e-9), flag))
+            if flag:
+                regressions.append((name, stage, ratio))
+    return regressions
+
+def default_label():
+    """
+    Short git commit of the working tree, 'local' outside of git
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'local'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fnirslib processing stages')
+    parser.add_argument('--scenarios', nargs='+', default=['small', 'medium'], choices=list(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--label', default=None, help='version label of the results, defaults to the git commit')
+    parser.add_argument('--output', default=str(Path(__file__).parent/'results'), help='directory for the results')
+    parser.add_argument('--compare', default=None, help='results json to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='time ratio counted as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR) # per-file warnings of the stages would flood the output
+
+    label = args.label if args.label is not None else default_label()
+    results = {'label': label, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+               'repeat': args.repeat, 'scenarios': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.scenarios:
+            results['scenarios'][name] = run_scenario(name, SCENARIOS[name], args.repeat, directory)
+
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    outfile = Path(args.output)/'{}.json'.format(label)
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to {}'.format(outfile))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
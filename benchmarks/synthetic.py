@@ -0,0 +1,88 @@
+"""
+author: @nimrobotics
+description: synthetic fnirs recordings and cohorts at scale, for benchmarks
+"""
+
+import numpy as np
+import scipy.io
+import scipy.stats
+from pathlib import Path
+
+def make_regions(nChannels, nRegions):
+    """
+    Splits the channels into contiguous regions
+    :param nChannels: number of channels
+    :param nRegions: number of regions
+    :return: regions, type: list of lists
+    """
+    return [list(map(int, e)) for e in np.array_split(np.arange(nChannels), nRegions)]
+
+def generate_recording(duration=3600, freq=10, nChannels=46, nTrials=100, nConditions=2, trialDuration=10, seed=0):
+    """
+    Generate a recording: drifting noise on every channel plus a hemodynamic response
+    to each trial, trials of all conditions are interleaved after a global baseline
+    :param duration: duration in seconds
+    :param freq: sampling frequency
+    :param nChannels: number of channels
+    :param nTrials: number of trials per condition
+    :param nConditions: number of conditions
+    :param trialDuration: mean trial duration in seconds
+    :param seed: random seed, or a numpy SeedSequence
+    :return: data (samples x 3 x channels), stims (samples x nConditions+1, column 0 marks the
+             start and end of the baseline, column i+1 the paired start and end of the trials of condition i)
+    """
+    rng = np.random.default_rng(seed)
+    nSamples = int(duration*freq)
+    trialLength = int(trialDuration*freq)
+    baselineEnd = int(min(60*freq, nSamples//10))
+    slot = (nSamples-baselineEnd) // (nTrials*nConditions)
+    assert slot > 1.5*trialLength, 'Recording is too short for the number of trials'
+    stims = np.zeros((nSamples, nConditions+1), dtype=np.int64)
+    stims[[0, baselineEnd-1], 0] = 1
+    starts = baselineEnd + slot*np.arange(nTrials*nConditions) + rng.integers(0, slot-int(1.2*trialLength), nTrials*nConditions)
+    ends = starts + trialLength + rng.integers(-trialLength//5, trialLength//5+1, nTrials*nConditions)
+    conditions = rng.permutation(np.arange(nTrials*nConditions) % nConditions)
+    stims[starts, conditions+1] = 1
+    stims[ends, conditions+1] = 1
+
+    # canonical (gamma) response to the boxcar of all trials, amplitude per channel and condition
+    t = np.arange(0, 30, 1/freq)
+    hrf = scipy.stats.gamma.pdf(t, 6) - scipy.stats.gamma.pdf(t, 16)/6
+    boxcars = np.zeros((nSamples, nConditions))
+    for start, end, condition in zip(starts, ends, conditions):
+        boxcars[start:end, condition] = 1
+    responses = np.stack([np.convolve(boxcars[:,i], hrf)[:nSamples] for i in range(nConditions)], axis=1)
+    hbo = responses @ rng.uniform(0, 1, (nConditions, nChannels))
+    hbo += np.cumsum(rng.normal(0, 0.01, (nSamples, nChannels)), axis=0) # drift
+    hbo += rng.normal(0, 0.1, (nSamples, nChannels))
+    data = np.empty((nSamples, 3, nChannels))
+    data[:,0] = hbo
+    data[:,1] = -0.3*hbo + rng.normal(0, 0.05, (nSamples, nChannels))
+    data[:,2] = data[:,0] + data[:,1]
+    return data, stims
+
+def write_recording(filepath, data, stims):
+    """
+    Write a recording to a .nirs file
+    :param filepath: .nirs filepath
+    :param data: data, samples x 3 x channels
+    :param stims: stimulus data
+    :return: None
+    """
+    scipy.io.savemat(filepath, {'s': stims, 'procResult': {'dc': data}})
+
+def generate_cohort(directory, nSubjects, seed=0, **kwargs):
+    """
+    Write a cohort of synthetic recordings, subject<i>.nirs
+    :param directory: output directory
+    :param nSubjects: number of subjects
+    :param seed: random seed of the cohort, each subject gets an independent stream
+    :param kwargs: recording parameters, see generate_recording
+    :return: list of filepaths
+    """
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    files = []
+    for i, subjectSeed in enumerate(np.random.SeedSequence(seed).spawn(nSubjects)):
+        files.append(str(Path(directory)/'subject{:04d}.nirs'.format(i)))
+        write_recording(files[-1], *generate_recording(seed=subjectSeed, **kwargs))
+    return files
@@ -0,0 +1,120 @@
+"""
+author: @nimrobotics
+description: example of processing a cohort of files in parallel with the fnirslib package
+"""
+
+import sys
+sys.path.append('../')
+from fnirslib.cohort import Cohort
+from fnirslib.cache import Cache
+from fnirslib.results import ResultStore
+from fnirslib import stats
+from fnirslib.plots import plotData
+import glob
+import logging
+import datetime
+import pandas as pd
+import numpy as np
+import scipy.io
+from pathlib import Path
+import itertools
+
+regions =  [[0, 1, 3, 4],   # APFC
+            [2, 5, 6, 7, 8],    #MDPFC
+            [14, 15, 16],   #RDPFC
+            [10, 11, 12],   #LDPFC
+            [9, 18, 19, 21, 22, 28, 31],    #IFC
+            [17, 33],   #RBA
+            [13, 29],   #LBA
+            [20, 23, 24, 25, 26, 30, 32],   #PMC-SMA
+            [27, 34, 35, 36, 37, 38],   #M1
+            [39, 40, 42, 44],   #V2-V3
+            [41, 43, 45] ]  #V1
+threshold = 0.4
+labels = ['APFC', 'MDPFC', 'RDPFC', 'LDPFC', 'IFC', 'RBA', 'LBA', 'PMC-SMA', 'M1', 'V2-V3', 'V1']
+in_dir = './rawData'
+stimulus=[2,3] # stimulus numbers, 2-normal, 3-attack
+sig_type=0  # 0 for HbO, 1 for HbR, 2 for HbT
+conditions = ['normal', 'attack'] # condition labels
+freq = 4.2 # sampling frequency
+workers = None # number of processes, None uses all cores
+
+if __name__ == '__main__':
+    output_dir = './output_{}'.format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+    # create output directory
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(filename=output_dir+'/logs.log',
+                        filemode='w',
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO,
+                        encoding='utf-8')
+
+    files = sorted(glob.glob(in_dir+'/*.nirs')) # get all the files in the directory
+    assert len(files) > 0, 'No files found in the directory'
+
+    # process all files and conditions, files are spread across the process pool
+    cohort = Cohort(files, regions, stimulus, conditions, freq, sig_type=sig_type,
+                    baselineDuration=2, peakPadding=5, outputDir=output_dir,
+                    cache=Cache('./cache')) # intermediate results shared by the workers and reruns
+    results = cohort.run(workers=workers)
+    for file, condition, error in results.errors:
+        print("Failed condition '{}' for file {}: {}".format(condition, file, error))
+
+    # store results, one row per subject and condition
+    channels = ['C'+str(i) for i in range(sum([len(e) for e in regions]))]
+    edges = [i+'-'+j for i,j in list(itertools.combinations(labels, 2))]
+    triu = np.triu_indices(len(regions), 1)
+    store = ResultStore({'peakAct': channels, 'meanAct': channels, 'peakActClust': labels, 'meanActClust': labels, 'funcCon': edges})
+    for r in results.successful():
+        corr = r['corr'].copy()
+        # save the data for each individual, each file thresholded separately
+        if threshold is not None:
+            corr[np.where(np.abs(r['zscores']) < threshold)] = 0
+        for name, values in [('peakAct', r['peak']), ('meanAct', r['mean']), ('peakActClust', r['peakClust']),
+                             ('meanActClust', r['meanClust']), ('funcCon', corr[triu])]:
+            store.append(name, values, r['ID'], r['sex'], r['condition'])
+    store.to_csv(output_dir)
+
+    for condition in conditions:
+        # average correlation, zscores over files/participants
+        group = results.group_connectivity(condition)
+        if group.corr.mean is None: # no file succeeded for this condition
+            print("No connectivity results for condition '{}', skipping".format(condition))
+            logging.warning("No connectivity results for condition '{}', skipping".format(condition))
+            continue
+        avgCorr = group.corr.mean.copy()
+        avgZscores = group.zscores.mean.copy()
+        scipy.io.savemat(output_dir+'/{}_avgCorr.mat'.format(condition), mdict={'avgCorr': avgCorr})
+        scipy.io.savemat(output_dir+'/{}_avgZscores.mat'.format(condition), mdict={'avgZscores': avgZscores})
+        pd.DataFrame(avgCorr, index=labels, columns=labels).to_csv(output_dir+'/{}_avgCorr.csv'.format(condition))
+        pd.DataFrame(avgZscores, index=labels, columns=labels).to_csv(output_dir+'/{}_avgZscores.csv'.format(condition))
+        # apply threshold to the average data
+        if threshold is not None:
+            avgCorr[np.where(np.abs(avgZscores) < threshold)] = np.nan
+        # save the average correlation matrix after thresholding
+        scipy.io.savemat(output_dir+'/{}_avgCorrThresholded.mat'.format(condition), mdict={'avgCorr': avgCorr})
+        pd.DataFrame(avgCorr, index=labels, columns=labels).to_csv(output_dir+'/{}_avgCorrThresholded.csv'.format(condition))
+
+        # make plots for functional connectivity
+        plot = plotData(avgCorr, labels, output_dir+'/', colormap='jet', dpi=300, title='FC: '+condition, filename='FC_'+condition +'.png')
+        plot.matrixPlot()
+        plot.circularPlot()
+
+    # group statistics between the two conditions, paired over the subjects with both conditions
+    for name, feature, columns in [('funcCon', 'zscores', edges), ('meanActClust', 'meanClust', labels)]:
+        idsA, a = results.stack(feature, conditions[0])
+        idsB, b = results.stack(feature, conditions[1])
+        if len(idsA) == 0 or len(idsB) == 0:
+            continue
+        if feature == 'zscores':
+            a, b = stats.edges(a), stats.edges(b) # upper triangle, same columns as funcCon.csv
+        ids, a, b = stats.pair_subjects(idsA, a, idsB, b)
+        t, p, pFWE = stats.permutation_test(a, b, paired=True, nPermutations=10000, workers=workers)
+        _, pFDR = stats.fdr(stats.ttest(a, b, paired=True)[1])
+        pd.DataFrame({'t': t, 'p': p, 'pFWE': pFWE, 'pFDR': pFDR}, index=columns).to_csv(
+            output_dir+'/{}_{}_vs_{}.csv'.format(name, *conditions))
+        if feature == 'zscores': # networks of edges that differ between the conditions
+            network = stats.nbs(a, b, paired=True, threshold=3.0, nPermutations=10000, workers=workers)
+            for i, (size, pNBS) in enumerate(zip(network['size'], network['p'])):
+                print('Network {}: {} edges, p={:.4f}: {}'.format(i, size, pNBS,
+                      [edges[e] for e in np.flatnonzero(network['component'] == i)]))
@@ -8,6 +8,11 @@ description: example of how to use the fnirslib package
 import sys
 sys.path.append('../')
 from fnirslib.fnirslib import *
+from fnirslib.recording import Recording
+from fnirslib.cache import Cache
+from fnirslib.connectivity import GroupConnectivity
+from fnirslib.results import ResultStore
+from fnirslib.writer import ProcessedDataWriter
 from fnirslib.plots import plotData
 import glob
 import logging
@@ -47,29 +52,39 @@ sig_type=0  # 0 for HbO, 1 for HbR, 2 for HbT
 conditions = ['normal', 'attack'] # condition labels
 freq = 4.2 # sampling frequency
 files = glob.glob(in_dir+'/*.nirs') # get all the files in the directory
+cache = Cache('./cache') # intermediate results, reruns only recompute the stages whose input or parameters changed
 
 assert len(files) > 0, 'No files found in the directory'
 assert len(stimulus) == len(conditions), 'Number of stimulus should be equal to the len of conditions array'
 
-# initialize dataframes to store results
-peakActDF = pd.DataFrame(columns=['ID', 'sex', 'condition']+['C'+str(i) for i in range(sum([len(e) for e in regions]))]) # store peak activation data for each channel
-peakActClustDF = pd.DataFrame(columns=['ID', 'sex', 'condition']+labels) # store peak activation data for each brain region
-meanActDF = pd.DataFrame(columns=['ID', 'sex', 'condition']+['C'+str(i) for i in range(sum([len(e) for e in regions]))]) # store mean activation data for each channel
-meanActClustDF = pd.DataFrame(columns=['ID', 'sex', 'condition']+labels) # store mean activation data for each brain region
-funcConDF = pd.DataFrame(columns=['ID', 'sex', 'condition']+[i+'-'+j for i,j in list(itertools.combinations(labels, 2))]) # store FC con data
+# initialize the store of per-subject results, rows are flushed to output_dir/results as they come in
+channels = ['C'+str(i) for i in range(sum([len(e) for e in regions]))]
+results = ResultStore({'peakAct': channels, # peak activation data for each channel
+                       'meanAct': channels, # mean activation data for each channel
+                       'peakActClust': labels, # peak activation data for each brain region
+                       'meanActClust': labels, # mean activation data for each brain region
+                       'funcCon': [i+'-'+j for i,j in list(itertools.combinations(labels, 2))]}, # FC con data
+                      directory=output_dir+'/results', flushEvery=50)
+# processed data of all subjects, one file per condition written in the background, use format='mat' for one .mat per subject
+actWriter = ProcessedDataWriter(output_dir+'/processed_act', format='hdf5')
+conWriter = ProcessedDataWriter(output_dir+'/processed_con', format='hdf5')
 
-# loop through all the files and conditions
-for stimNumber, condition in zip(stimulus, conditions):
-    avgCorr = np.zeros((len(regions),len(regions)))
-    avgZscores = np.zeros((len(regions),len(regions)))
-    for file in files:
+# running group statistics of correlation, zscores for each condition
+groupFC = {condition: GroupConnectivity() for condition in conditions}
+
+# loop through all the files and conditions, each file is parsed only once
+for file in files:
+    recording = Recording(file, cache=cache, dtype=np.float32) # data is loaded on first use and shared by all conditions, signals stored as float32
+    recording.channel_quality(freq) # mask of the good channels, shared by the views; bad channels are left out of the regions
+    for stimNumber, condition in zip(stimulus, conditions):
         print("\nProcessing condition '{}' for file {}".format(condition,file))
         try:
             # perform activation analysis on mean aggregated data
-            fnirs = Fnirslib(file, regions, stimNumber, condition) # initialize the fnirs object
+            fnirs = recording.view(regions, stimNumber, condition) # per-condition view of the recording
             logging.info("Activation analysis! averaging trial data")
             data, stims = fnirs.load_nirs() # load the data
             fnirs.sanity_check(data, stims) # check the data
+            data = fnirs.mask_channels(data) # bad channels to NaN, the metrics ignore them
             # baseline = fnirs.get_global_baseline(data, stims, baseline_stim, sig_type) # get the baseline
             baseline = fnirs.get_local_baseline(data, stims, sig_type, duration=2, freq=freq) # get the baseline
             print("data shape: {}".format(data.shape))
@@ -78,38 +93,47 @@ for stimNumber, condition in zip(stimulus, conditions):
             peak = fnirs.peak_activation(data, baseline, peakPadding=5) # get the peak activation
             print("peak shape: {}".format(peak.shape))
             mean = fnirs.mean_activation(data) # get the mean activation
-            peakActDF.loc[len(peakActDF)] = [file.split('/')[-1].split('.')[0], fnirs.sex, fnirs.condition] + list(peak)
-            meanActDF.loc[len(meanActDF)] = [file.split('/')[-1].split('.')[0], fnirs.sex, fnirs.condition] + list(mean)
+            subjectID = file.split('/')[-1].split('.')[0]
+            results.append('peakAct', peak, subjectID, fnirs.sex, fnirs.condition)
+            results.append('meanAct', mean, subjectID, fnirs.sex, fnirs.condition)
             peak = fnirs.cluster_channels(peak) # cluster data into regions
-            peakActClustDF.loc[len(peakActClustDF)] = [file.split('/')[-1].split('.')[0], fnirs.sex, fnirs.condition] + list(peak)
-            meanActClustDF.loc[len(meanActClustDF)] = [file.split('/')[-1].split('.')[0], fnirs.sex, fnirs.condition] + list(peak)
-            fnirs.save_processed_data(data, stims, output_dir+'/processed_act') # save processed fnirs data
+            results.append('peakActClust', peak, subjectID, fnirs.sex, fnirs.condition)
+            results.append('meanActClust', fnirs.cluster_channels(mean), subjectID, fnirs.sex, fnirs.condition)
+            fnirs.save_processed_data(data, stims, output_dir+'/processed_act', writer=actWriter) # save processed fnirs data
 
             # perform connectivity analysis on concatenated data
-            fnirs = Fnirslib(file, regions, stimNumber, condition) # initialize the fnirs object
             logging.info("Connectivity analysis! concatenating trial data")
-            data, stims = fnirs.load_nirs() # load the data
-            fnirs.sanity_check(data, stims) # check the data
+            data, stims = fnirs.load_nirs() # reuses the already loaded data
+            data = fnirs.mask_channels(data)
             data, stims = fnirs.get_ROI(data, stims, aggMethod='concat', equalize=False) # get the ROI data
             data = fnirs.detrend(data) # detrend the data
             data = fnirs.cluster_channels(data) # cluster the channels into regions
             data = data[:,sig_type,:] # 0 for HbO, 1 for HbR, 2 for HbT
-            # econ = fnirs.effective_connectivity(data)
+            # gc, pvalues, order = fnirs.effective_connectivity(data.T)
             corr,zscores = fnirs.functional_connectivity(data.T)
             print('Corr shape: {}, Zscores shape: {}'.format(corr.shape, zscores.shape))
-            avgCorr = np.mean( np.array([ avgCorr, corr ]), axis=0 ) # average over files/participants
-            avgZscores = np.mean( np.array([ avgZscores, zscores ]), axis=0 ) # average over files/participants
-            fnirs.save_processed_data(data, stims, output_dir+'/processed_con') # save processed fnirs data
+            groupFC[condition].add(corr, zscores) # average over files/participants
+            fnirs.save_processed_data(data, stims, output_dir+'/processed_con', writer=conWriter) # save processed fnirs data
             # save the data for each individual, each file thresholded separately
             if threshold is not None:
                 corr[np.where(np.abs(zscores) < threshold)] = 0
             triuCorr = corr[np.triu_indices(len(corr), 1)] # get the upper triangle of the correlation matrix
-            funcConDF.loc[len(funcConDF)] = [file.split('/')[-1].split('.')[0], fnirs.sex, fnirs.condition] + list(triuCorr)
+            results.append('funcCon', triuCorr, subjectID, fnirs.sex, fnirs.condition)
         except Exception as e:
             print(e)
             logging.error(e)
             continue
-    
+    recording.release() # free the memory before loading the next file
+actWriter.close() # wait for the pending writes
+conWriter.close()
+
+for condition in conditions:
+    if groupFC[condition].corr.mean is None: # no file succeeded for this condition
+        print("No connectivity results for condition '{}', skipping".format(condition))
+        logging.warning("No connectivity results for condition '{}', skipping".format(condition))
+        continue
+    avgCorr = groupFC[condition].corr.mean.copy()
+    avgZscores = groupFC[condition].zscores.mean.copy()
     # save average correlation, zscores as .mat and .csv
     scipy.io.savemat(output_dir+'/{}_avgCorr.mat'.format(condition), mdict={'avgCorr': avgCorr})
     scipy.io.savemat(output_dir+'/{}_avgZscores.mat'.format(condition), mdict={'avgZscores': avgZscores})
@@ -117,7 +141,7 @@ for stimNumber, condition in zip(stimulus, conditions):
     pd.DataFrame(avgZscores, index=labels, columns=labels).to_csv(output_dir+'/{}_avgZscores.csv'.format(condition))
     # apply threshold to the average data
     if threshold is not None:
-        avgCorr[np.where(np.abs(avgZscores) < threshold)] = np.NaN
+        avgCorr[np.where(np.abs(avgZscores) < threshold)] = np.nan
     # save the average correlation matrix after thresholding
     scipy.io.savemat(output_dir+'/{}_avgCorrThresholded.mat'.format(condition), mdict={'avgCorr': avgCorr})
     pd.DataFrame(avgCorr, index=labels, columns=labels).to_csv(output_dir+'/{}_avgCorrThresholded.csv'.format(condition))
@@ -128,10 +152,7 @@ for stimNumber, condition in zip(stimulus, conditions):
     plot.circularPlot()
 
 ## save all data in a CSV file
-peakActDF.to_csv(output_dir+'/peakAct.csv', index=False)
-meanActDF.to_csv(output_dir+'/meanAct.csv', index=False)
-peakActClustDF.to_csv(output_dir+'/peakActClust.csv', index=False)
-meanActClustDF.to_csv(output_dir+'/meanActClust.csv', index=False)
-funcConDF.to_csv(output_dir+'/funcCon.csv', index=False)
+results.flush()
+results.to_csv(output_dir) # peakAct.csv, meanAct.csv, peakActClust.csv, meanActClust.csv, funcCon.csv
 
 
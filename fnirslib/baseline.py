@@ -0,0 +1,49 @@
+"""
+author: @nimrobotics
+description: vectorized baseline computation for fnirs data
+"""
+
+import numpy as np
+
+def window_means(data, starts, ends):
+    """
+    Mean of data[start:end] for every (start, end) window, computed from one cumulative
+    sum over the span covered by the windows, O(samples) for any number of windows.
+    Windows are clipped to the data, missing (NaN) samples are left out, empty windows give NaN
+    :param data: data, samples along the first axis
+    :param starts: first sample of each window
+    :param ends: end of each window (exclusive)
+    :return: window means, windows x data.shape[1:]
+    """
+    n = data.shape[0]
+    starts = np.clip(np.asarray(starts), 0, n)
+    ends = np.clip(np.asarray(ends), 0, n)
+    ends = np.maximum(ends, starts)
+    if starts.shape[0] == 0:
+        return np.zeros((0,)+data.shape[1:])
+    first, last = starts.min(), ends.max()
+    span = np.asarray(data[first:last], dtype=np.float64)
+    ref = np.nan_to_num(span[0]) if span.shape[0] > 0 else 0 # subtract a reference to keep the cumulative sum small
+    nan = np.isnan(span)
+    csum = np.zeros((span.shape[0]+1,)+data.shape[1:])
+    np.cumsum(np.where(nan, 0, span - ref), axis=0, out=csum[1:])
+    if nan.any(): # missing samples only drop out of the windows holding them
+        ccount = np.zeros(csum.shape, dtype=np.int64)
+        np.cumsum(~nan, axis=0, out=ccount[1:])
+        count = ccount[ends-first] - ccount[starts-first]
+    else:
+        count = (ends - starts).reshape((-1,)+(1,)*(data.ndim-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (csum[ends-first] - csum[starts-first]) / count + ref
+
+def subtract(epochs, baseline):
+    """
+    Subtracts a baseline from trial epochs
+    :param epochs: epochs, trials x samples x ...
+    :param baseline: baseline per trial (trials x ...) or one baseline for all trials
+    :return: baseline corrected epochs
+    """
+    baseline = np.asarray(baseline)
+    if baseline.ndim == epochs.ndim - 1 and baseline.shape[0] == epochs.shape[0]:
+        baseline = baseline[:,None] # per trial baseline, broadcast over samples
+    return epochs - baseline
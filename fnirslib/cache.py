@@ -0,0 +1,208 @@
+"""
+author: @nimrobotics
+description: content-addressed on-disk cache of intermediate pipeline results
+"""
+
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+import weakref
+import zlib
+from pathlib import Path
+
+def _hash(*parts):
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        h.update(part if isinstance(part, (bytes, memoryview)) else str(part).encode())
+    return h.hexdigest()
+
+def _crc(arr):
+    arr = np.ascontiguousarray(arr)
+    return zlib.crc32(arr.data if arr.size > 0 else b'')
+
+class Cache:
+    """
+    Stores the outputs of pipeline stages as .npz files, keyed on the content of the input
+    file plus the parameters of every stage that led to them. Arrays produced by a stage
+    (or by a conversion, see derive) remember their key, so a following stage is keyed
+    without hashing the array again; a CRC of the content, much cheaper than the hash,
+    catches arrays modified in place since.
+    Entries are evicted least recently used first once the cache exceeds maxBytes. Writes
+    are atomic, so several processes can share one cache directory
+    """
+    def __init__(self, directory, maxBytes=2**32):
+        """
+        :param directory: cache directory
+        :param maxBytes: size limit of the cache in bytes
+        """
+        self.directory = Path(directory)
+        self.maxBytes = maxBytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._files = {} # (path, size, mtime) -> digest
+        self._lineage = {} # id(array) -> (weakref, key, crc)
+        self._bytes = None # running size of the cache, None until the first scan
+
+    def __getstate__(self):
+        # the in-memory lookups are per process
+        state = self.__dict__.copy()
+        state['_files'], state['_lineage'] = {}, {}
+        state['_bytes'] = None
+        return state
+
+    def file_digest(self, filepath):
+        """
+        Hash of the file content, memoized per path, size and modification time
+        :param filepath: filepath
+        :return: hex digest
+        """
+        stat = os.stat(filepath)
+        memo = (str(Path(filepath).resolve()), stat.st_size, stat.st_mtime_ns)
+        if memo not in self._files:
+            h = hashlib.blake2b(digest_size=20)
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1<<22), b''):
+                    h.update(chunk)
+            self._files[memo] = h.hexdigest()
+        return self._files[memo]
+
+    def digest(self, value):
+        """
+        Key of a stage input: the remembered key of an array produced by a cached stage,
+        otherwise the hash of the array content. Strings are treated as filepaths
+        :param value: array or filepath
+        :return: hex digest
+        """
+        if isinstance(value, str):
+            return self.file_digest(value)
+        entry = self._lineage.get(id(value))
+        if entry is not None and entry[0]() is value and entry[2] == _crc(value):
+            return entry[1]
+        arr = np.ascontiguousarray(value)
+        return _hash(arr.dtype.str, arr.shape, arr.data if arr.size > 0 else b'')
+
+    def _remember(self, value, key):
+        """
+        Remembers the key of an output array for the following stages
+        """
+        if len(self._lineage) > 1024: # drop entries of arrays that are gone
+            self._lineage = {k: v for k, v in self._lineage.items() if v[0]() is not None}
+        self._lineage[id(value)] = (weakref.ref(value), key, _crc(value))
+
+    def _path(self, key):
+        return self.directory / key[:2] / (key+'.npz')
+
+    def get(self, key):
+        """
+        Load a cache entry
+        :param key: entry key
+        :return: stored arrays and whether the output was a single array, None if missing
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = [npz['a{}'.format(i)] for i in range(len(npz.files)-1)]
+                single = bool(npz['single'])
+            os.utime(path) # mark as recently used
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+        return arrays, single
+
+    def put(self, key, arrays, single):
+        """
+        Store a cache entry, written to a temporary file and moved into place
+        :param key: entry key
+        :param arrays: list of arrays
+        :param single: the output was a single array, not a tuple
+        :return: None
+        """
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name('{}.{}.tmp.npz'.format(key, os.getpid()))
+        np.savez(tmp, single=np.array(single), **{'a{}'.format(i): np.asarray(a) for i, a in enumerate(arrays)})
+        size = tmp.stat().st_size
+        try:
+            size -= path.stat().st_size # replaced entry
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+        if self._bytes is not None:
+            self._bytes += size
+        if self._bytes is None or self._bytes > self.maxBytes: # the directory is scanned only when it may be full
+            self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in 90% of maxBytes, the
+        headroom keeps a full cache from being scanned on every write. Scans the
+        directory and resets the running size, which also picks up the entries written by
+        other processes sharing the directory
+        :return: None
+        """
+        entries = []
+        for path in self.directory.glob('*/*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= 0.9*self.maxBytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+
+    def _key(self, stage, inputs, params):
+        return _hash(stage, *[self.digest(x) for x in inputs], json.dumps(params, sort_keys=True, default=str))
+
+    def _remember_outputs(self, key, arrays, inputs):
+        for i, arr in enumerate(arrays):
+            if isinstance(arr, np.ndarray) and not any(arr is x for x in inputs): # inputs passed through keep their key
+                self._remember(arr, _hash(key, i))
+
+    def memoize(self, stage, inputs, params, compute):
+        """
+        Return the cached output of a stage, or compute and store it
+        :param stage: stage name
+        :param inputs: stage inputs, arrays or filepaths
+        :param params: stage parameters, must be JSON serializable (other values use str)
+        :param compute: function computing the stage output, an array or tuple of arrays
+        :return: stage output, writable as without a cache (a hit is loaded into new arrays)
+        """
+        key = self._key(stage, inputs, params)
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            logging.info("Cache hit for stage '{}'".format(stage))
+            arrays, single = entry
+        else:
+            self.misses += 1
+            output = compute()
+            single = not isinstance(output, tuple)
+            arrays = [output] if single else list(output)
+            self.put(key, arrays, single)
+        self._remember_outputs(key, arrays, inputs)
+        return arrays[0] if single else tuple(arrays)
+
+    def derive(self, stage, inputs, params, output):
+        """
+        Remembers the keys of the output of a cheap conversion (e.g. a dtype change or masking)
+        that is not worth storing, so that the following stages are keyed without hashing it
+        :param stage: conversion name
+        :param inputs: conversion inputs, arrays or filepaths
+        :param params: conversion parameters
+        :param output: conversion output, an array or tuple of arrays
+        :return: output
+        """
+        arrays = [output] if not isinstance(output, tuple) else list(output)
+        if any(isinstance(arr, np.ndarray) and not any(arr is x for x in inputs) for arr in arrays):
+            self._remember_outputs(self._key(stage, inputs, params), arrays, inputs)
+        return output
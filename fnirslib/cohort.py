@@ -0,0 +1,215 @@
+"""
+author: @nimrobotics
+description: batch processing of a cohort of fnirs files over a process pool
+"""
+
+import numpy as np
+import logging
+import functools
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from .recording import Recording
+from .connectivity import GroupConnectivity
+from .profiling import Profiler
+
+def process_file(file, regions, stimulus, conditions, freq, sig_type=0, sex='NA',
+                 baselineDuration=2, peakPadding=5, outputDir=None, mmap=False, cacheDir=None, cache=None, quality=None, dtype=None):
+    """
+    Run the activation and connectivity analysis for all conditions of one file,
+    the file is parsed once and failures are isolated per condition
+    :param file: .nirs or .snirf filepath
+    :param regions: brain regions, type: list of lists
+    :param stimulus: stimulus numbers, type: list
+    :param conditions: condition labels, same length as stimulus, type: list
+    :param freq: sampling frequency
+    :param sig_type: signal type, 0 HbO, 1 HbR, 2 HbT
+    :param sex: sex of the participant, M or F, type: str
+    :param baselineDuration: duration of the local baseline in seconds
+    :param peakPadding: number of samples to pad the peak
+    :param outputDir: directory to save processed data, nothing is saved if None
+    :param mmap: memory-map the data, see fnirslib.read_nirs, type: bool
+    :param cacheDir: directory for the memory-mappable copy of the data, see fnirslib.read_nirs
+    :param cache: on-disk cache of intermediate results, see cache.Cache, type: Cache
+    :param quality: thresholds of the channel quality check (see quality.channel_mask), {} for the
+                    defaults; bad channels are set to NaN and left out of the regions. None for no check, type: dict
+    :param dtype: storage dtype of the signals, e.g. np.float32, see Recording
+    :return: list of result dicts, one per condition
+    """
+    recording = Recording(file, sex=sex, mmap=mmap, cacheDir=cacheDir, cache=cache, dtype=dtype)
+    subjectID = Path(file).stem
+    results = []
+    channelMask = None
+    if quality is not None:
+        try:
+            _, channelMask = recording.channel_quality(freq, **quality)
+        except Exception as e:
+            logging.error("Failed channel quality check for file {}: {}".format(file, e))
+    for stimNumber, condition in zip(stimulus, conditions):
+        result = {'file': file, 'ID': subjectID, 'sex': sex, 'condition': condition, 'error': None, 'channelMask': channelMask}
+        try:
+            fnirs = recording.view(regions, stimNumber, condition)
+            # activation analysis on mean aggregated data
+            data, stims = fnirs.load_nirs()
+            fnirs.sanity_check(data, stims)
+            data = fnirs.mask_channels(data)
+            baseline = fnirs.get_local_baseline(data, stims, sig_type, duration=baselineDuration, freq=freq)
+            data, stims = fnirs.get_ROI(data, stims, aggMethod='mean')
+            data = data[:,sig_type,:]
+            result['peak'] = fnirs.peak_activation(data, baseline, peakPadding=peakPadding)
+            result['mean'] = fnirs.mean_activation(data)
+            result['peakClust'] = fnirs.cluster_channels(result['peak'])
+            result['meanClust'] = fnirs.cluster_channels(result['mean'])
+            if outputDir is not None:
+                fnirs.save_processed_data(data, stims, outputDir+'/processed_act')
+
+            # connectivity analysis on concatenated data
+            data, stims = fnirs.load_nirs()
+            data = fnirs.mask_channels(data)
+            data, stims = fnirs.get_ROI(data, stims, aggMethod='concat', equalize=False)
+            data = fnirs.detrend(data)
+            data = fnirs.cluster_channels(data)
+            data = data[:,sig_type,:]
+            result['corr'], result['zscores'] = fnirs.functional_connectivity(data.T)
+            if outputDir is not None:
+                fnirs.save_processed_data(data, stims, outputDir+'/processed_con')
+        except Exception as e:
+            logging.error("Failed condition '{}' for file {}: {}".format(condition, file, e))
+            result = {'file': file, 'ID': subjectID, 'sex': sex, 'condition': condition, 'error': repr(e),
+                      'channelMask': channelMask}
+        results.append(result)
+    recording.release()
+    return results
+
+def _process_job(job, profile=None, **kwargs):
+    """
+    Unpack a (file, sex) job for the process pool
+    :param profile: None, or profile the job recording memory if True
+    :return: results, events recorded by the profiler of the job or None
+    """
+    file, sex = job
+    if profile is None:
+        return process_file(file, sex=sex, **kwargs), None
+    with Profiler(memory=profile) as profiler:
+        results = process_file(file, sex=sex, **kwargs)
+    return results, profiler.events
+
+class Cohort:
+    """
+    Process a cohort of files, spreading the files across a process pool
+    """
+    def __init__(self, files, regions, stimulus, conditions, freq, sig_type=0, sex=None,
+                 baselineDuration=2, peakPadding=5, outputDir=None, mmap=False, cacheDir=None, cache=None, quality=None, dtype=None):
+        """
+        :param files: .nirs or .snirf filepaths, type: list
+        :param regions: brain regions, type: list of lists
+        :param stimulus: stimulus numbers, type: list
+        :param conditions: condition labels, same length as stimulus, type: list
+        :param freq: sampling frequency
+        :param sig_type: signal type, 0 HbO, 1 HbR, 2 HbT
+        :param sex: sex of each participant keyed by filepath, 'NA' if missing, type: dict
+        :param baselineDuration: duration of the local baseline in seconds
+        :param peakPadding: number of samples to pad the peak
+        :param outputDir: directory to save processed data, nothing is saved if None
+        :param mmap: memory-map the data so that workers on one node share the page cache, type: bool
+        :param cacheDir: directory for the memory-mappable copy of the data, see fnirslib.read_nirs
+        :param cache: on-disk cache of intermediate results, the directory is shared by the workers, see cache.Cache, type: Cache
+        :param quality: thresholds of the channel quality check, {} for the defaults, None for no check, see process_file, type: dict
+        :param dtype: storage dtype of the signals, e.g. np.float32 to halve the memory of the workers, see Recording
+        """
+        assert len(stimulus) == len(conditions), 'Number of stimulus should be equal to the len of conditions array'
+        self.files = list(files)
+        self.regions = regions
+        self.stimulus = stimulus
+        self.conditions = conditions
+        self.freq = freq
+        self.sig_type = sig_type
+        self.sex = sex if sex is not None else {}
+        self.baselineDuration = baselineDuration
+        self.peakPadding = peakPadding
+        self.outputDir = outputDir
+        self.mmap = mmap
+        self.cacheDir = cacheDir
+        self.cache = cache
+        self.quality = quality
+        self.dtype = dtype
+
+    def run(self, workers=None, chunksize=1, profiler=None):
+        """
+        Process all files
+        :param workers: number of processes, None for os.cpu_count(), 1 runs in the current process
+        :param chunksize: number of files sent to a worker at a time
+        :param profiler: profiler collecting the stage timings of all workers, see profiling.Profiler
+        :return: CohortResults, in the order of files and conditions
+        """
+        worker = functools.partial(_process_job, regions=self.regions, stimulus=self.stimulus,
+                                   conditions=self.conditions, freq=self.freq, sig_type=self.sig_type,
+                                   baselineDuration=self.baselineDuration, peakPadding=self.peakPadding,
+                                   outputDir=self.outputDir, mmap=self.mmap, cacheDir=self.cacheDir, cache=self.cache, quality=self.quality, dtype=self.dtype,
+                                   profile=None if profiler is None else profiler.memory)
+        jobs = [(file, self.sex.get(file, 'NA')) for file in self.files]
+        logging.info("Processing {} files with {} workers".format(len(jobs), workers))
+        if workers == 1:
+            perFile = list(map(worker, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                perFile = list(executor.map(worker, jobs, chunksize=chunksize)) # map keeps the order of files
+        for _, events in perFile:
+            if events is not None:
+                profiler.merge(events)
+        return CohortResults([result for results, _ in perFile for result in results], self.conditions)
+
+class CohortResults:
+    """
+    Per-subject results of a cohort run
+    """
+    def __init__(self, results, conditions):
+        """
+        :param results: result dicts from process_file, type: list
+        :param conditions: condition labels, type: list
+        """
+        self.results = results
+        self.conditions = conditions
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    @property
+    def errors(self):
+        """
+        Failed (file, condition, error) entries
+        """
+        return [(r['file'], r['condition'], r['error']) for r in self.results if r['error'] is not None]
+
+    def successful(self, condition=None):
+        """
+        Results without errors
+        :param condition: only return results for this condition, all if None
+        :return: list of result dicts
+        """
+        return [r for r in self.results if r['error'] is None and (condition is None or r['condition']==condition)]
+
+    def stack(self, feature, condition=None):
+        """
+        Stack a feature over subjects
+        :param feature: one of 'peak', 'mean', 'peakClust', 'meanClust', 'corr', 'zscores'
+        :param condition: only stack results for this condition, all if None
+        :return: subject IDs, stacked feature with subjects along the first axis
+        """
+        results = self.successful(condition)
+        if len(results) == 0:
+            return [], None
+        return [r['ID'] for r in results], np.stack([r[feature] for r in results])
+
+    def group_connectivity(self, condition):
+        """
+        Group statistics (count, mean, variance) of the connectivity of all subjects
+        :param condition: condition label
+        :return: GroupConnectivity
+        """
+        group = GroupConnectivity()
+        for r in self.successful(condition):
+            group.add(r['corr'], r['zscores'])
+        return group
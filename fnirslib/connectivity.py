@@ -0,0 +1,243 @@
+"""
+author: @nimrobotics
+description: batched connectivity and running group statistics for fnirs data
+"""
+
+import numpy as np
+
+MAX_CORRELATION = np.nextafter(1.0, 0.0) # largest correlation with a finite z-score
+
+def correlation(data):
+    """
+    Pearson correlation between regions from one centered, normalized matmul. Regions
+    without any samples (NaN) give NaN rows and columns, samples with a NaN in any other
+    region are left out
+    :param data: samples x regions, or a stack subjects x samples x regions
+    :return: correlation matrix, regions x regions (subjects x regions x regions for a stack)
+    """
+    x = np.asarray(data, dtype=np.float64)
+    nan = np.isnan(x)
+    if nan.any():
+        empty = nan.all(axis=-2, keepdims=True)
+        keep = ~np.any(nan & ~empty, axis=-1, keepdims=True) # samples complete in the non-empty regions
+        x = np.where(keep & ~nan, x, 0.0)
+        x = x - np.sum(x, axis=-2, keepdims=True) / np.sum(keep, axis=-2, keepdims=True)
+        x *= keep
+    else:
+        x = x - np.mean(x, axis=-2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = x / np.linalg.norm(x, axis=-2, keepdims=True) # constant regions give NaN
+    corr = np.swapaxes(x, -1, -2) @ x
+    return np.clip(corr, -1, 1, out=corr)
+
+def fisher_z(corr):
+    """
+    Fisher z-transform of correlation matrices, the diagonal is set to NaN and
+    off-diagonal correlations of +-1 (e.g. duplicated regions) are capped at the largest
+    finite z-score, so no inf values are produced
+    :param corr: correlation matrix or stack of matrices, modified in place
+    :return: correlation matrix with NaN diagonal, z-scores
+    """
+    diag = np.arange(corr.shape[-1])
+    corr[..., diag, diag] = np.nan
+    zscores = np.arctanh(np.clip(corr, -MAX_CORRELATION, MAX_CORRELATION))
+    return corr, zscores
+
+def functional_connectivity(data):
+    """
+    Correlation and Fisher z-scores between regions
+    :param data: samples x regions, or a stack subjects x samples x regions
+    :return: correlation matrix, z-scores; both with NaN diagonal
+    """
+    return fisher_z(correlation(data))
+
+class RunningCorrelation:
+    """
+    Correlation between regions over a changing set of samples, from running sums
+    and cross-products. Adding or removing k samples costs O(k*regions^2)
+    """
+    def __init__(self, nRegions):
+        """
+        :param nRegions: number of regions
+        """
+        self.n = 0
+        self.sum = np.zeros(nRegions)
+        self.cross = np.zeros((nRegions, nRegions))
+
+    def add(self, x):
+        """
+        Add samples
+        :param x: samples x regions
+        :return: None
+        """
+        self.n += x.shape[0]
+        self.sum += np.sum(x, axis=0)
+        self.cross += x.T @ x
+
+    def remove(self, x):
+        """
+        Remove samples that were added before
+        :param x: samples x regions
+        :return: None
+        """
+        self.n -= x.shape[0]
+        self.sum -= np.sum(x, axis=0)
+        self.cross -= x.T @ x
+
+    def correlation(self):
+        """
+        Correlation of the current samples
+        :return: regions x regions correlation matrix
+        """
+        mean = self.sum/self.n
+        cov = self.cross/self.n - np.outer(mean, mean)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(np.diag(cov))
+            corr = cov/np.outer(std, std)
+        return np.clip(corr, -1, 1, out=corr)
+
+def sliding_connectivity(data, width, step=1):
+    """
+    Time-resolved connectivity over sliding windows. The window sums are updated
+    incrementally as the window slides, each step costs O(step*regions^2); the sums
+    are recomputed once per full window turnover to stop round-off from accumulating
+    :param data: samples x regions
+    :param width: window width in samples
+    :param step: step between windows in samples
+    :return: correlation matrices, z-scores; windows x regions x regions, NaN diagonal
+    """
+    assert width >= 2, 'Window width should be at least 2 samples'
+    assert data.shape[0] >= width, 'Window width is larger than the data'
+    x = np.asarray(data, dtype=np.float64)
+    x = x - np.mean(x, axis=0) # centering does not change the correlation, keeps the sums small
+    nWindows = (x.shape[0]-width)//step + 1
+    refresh = -(-width//step) # windows per full turnover
+    corr = np.empty((nWindows, x.shape[1], x.shape[1]))
+    running = None
+    for w in range(nWindows):
+        start, end = w*step, w*step+width
+        if running is None or w % refresh == 0:
+            running = RunningCorrelation(x.shape[1])
+            running.add(x[start:end])
+        else:
+            prevStart, prevEnd = start-step, end-step
+            running.remove(x[prevStart:min(prevEnd, start)])
+            running.add(x[max(prevEnd, start):end])
+        corr[w] = running.correlation()
+    return fisher_z(corr)
+
+class RunningStats:
+    """
+    Running count, mean and variance of equally shaped arrays (Welford's algorithm,
+    batches and other RunningStats are merged with Chan's formula), O(size of one array) memory.
+    Missing (NaN) entries are left out element-wise, each entry keeps its own count
+    """
+    def __init__(self):
+        self.count = 0 # number of observations
+        self.counts = None # number of finite values of each entry
+        self.mean = None
+        self._m2 = None
+
+    def update(self, x, batch=False):
+        """
+        Add an observation
+        :param x: observation, or a stack of observations along the first axis if batch
+        :param batch: x is a stack of observations, type: bool
+        :return: None
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if not batch:
+            x = x[None]
+        if x.shape[0] == 0:
+            return
+        finite = np.isfinite(x)
+        counts = np.sum(finite, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.sum(x, axis=0, where=finite) / counts
+        m2 = np.sum((x - mean)**2, axis=0, where=finite)
+        self._merge(x.shape[0], counts, mean, m2)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another RunningStats, e.g. from a parallel worker
+        :param other: RunningStats
+        :return: None
+        """
+        if other.count > 0:
+            self._merge(other.count, other.counts, other.mean, other._m2)
+
+    def _merge(self, count, counts, mean, m2):
+        if self.count == 0:
+            self.count, self.counts, self.mean, self._m2 = count, counts.copy(), mean.copy(), m2.copy()
+            return
+        total = self.counts + counts
+        delta = np.nan_to_num(mean) - np.nan_to_num(self.mean) # entries without values have a NaN mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, counts/total, 0)
+        self.mean = np.where(total > 0, np.nan_to_num(self.mean) + delta*weight, np.nan)
+        self._m2 = self._m2 + m2 + delta**2*self.counts*weight
+        self.counts = total
+        self.count += count
+
+    @property
+    def variance(self):
+        """
+        Sample variance (ddof=1), NaN for entries with less than two values
+        """
+        if self.mean is None:
+            return None
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts >= 2, self._m2/(self.counts-1), np.nan)
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation (ddof=1)
+        """
+        variance = self.variance
+        return None if variance is None else np.sqrt(variance)
+
+class GroupConnectivity:
+    """
+    Running group statistics of functional connectivity over subjects
+    """
+    def __init__(self):
+        self.corr = RunningStats()
+        self.zscores = RunningStats()
+
+    @property
+    def count(self):
+        """
+        Number of subjects added
+        """
+        return self.corr.count
+
+    def add(self, corr, zscores):
+        """
+        Add the connectivity of one subject, or a stack of subjects
+        :param corr: correlation matrix, regions x regions or subjects x regions x regions
+        :param zscores: z-scores, same shape as corr
+        :return: None
+        """
+        batch = np.ndim(corr) == 3
+        self.corr.update(corr, batch=batch)
+        self.zscores.update(zscores, batch=batch)
+
+    def add_data(self, data):
+        """
+        Compute and add the connectivity of one subject or a stack of subjects
+        :param data: samples x regions, or subjects x samples x regions
+        :return: correlation matrix, z-scores of the added data
+        """
+        corr, zscores = functional_connectivity(data)
+        self.add(corr, zscores)
+        return corr, zscores
+
+    def merge(self, other):
+        """
+        Merge the statistics of another GroupConnectivity
+        :param other: GroupConnectivity
+        :return: None
+        """
+        self.corr.merge(other.corr)
+        self.zscores.merge(other.zscores)
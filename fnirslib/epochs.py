@@ -0,0 +1,37 @@
+"""
+author: @nimrobotics
+description: cut fnirs data into equal length trial epochs
+"""
+
+import numpy as np
+
+def trial_bounds(stims, stimNumber):
+    """
+    Gets the start and end indices of paired stims
+    :param stims: stimulus data
+    :param stimNumber: stimulus column
+    :return: start indices, end indices
+    """
+    loc = np.flatnonzero(stims[:,stimNumber])
+    assert loc.shape[0]%2==0, "Number of stims should be even"
+    return loc[::2], loc[1::2]
+
+def epoch(data, starts, length, pre=0, post=0):
+    """
+    Cuts equal length windows out of the data with a single fancy index, only the
+    samples inside the windows are read (also for memory-mapped data). Samples of a
+    window that fall outside the data are set to NaN
+    :param data: data, samples along the first axis
+    :param starts: start index of each trial
+    :param length: number of samples in each trial
+    :param pre: number of samples to add before the start
+    :param post: number of samples to add after the end
+    :return: epochs, trials x (pre+length+post) x data.shape[1:]
+    """
+    idx = np.asarray(starts)[:,None] + np.arange(-pre, length+post)
+    outside = (idx < 0) | (idx >= data.shape[0])
+    if not outside.any():
+        return data[idx]
+    epochs = data[idx.clip(0, data.shape[0]-1)].astype(np.result_type(data.dtype, np.float16))
+    epochs[outside] = np.nan
+    return epochs
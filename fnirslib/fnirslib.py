@@ -5,13 +5,173 @@ description: class for processing fnirs data
 
 import numpy as np
 import scipy.io
-import scipy.signal
 from . import metrics
+from . import snirf
+from . import epochs
+from . import baseline as baseline_mod
+from . import preprocessing
+from . import mbll
+from . import quality
+from . import glm as glm_mod
+from .profiling import instrument
 import logging
+import warnings
+import hashlib
+import os
+import tempfile
+import glob
 from pathlib import Path
 
+def _is_hdf5_mat(filepath):
+    """
+    Checks if a .nirs (MAT) file is saved in the v7.3 (HDF5) format
+    :param filepath: .nirs filepath
+    :return: True for v7.3 files
+    """
+    return scipy.io.matlab.matfile_version(filepath, appendmat=False)[0] == 2
+
+def _read_nirs_hdf5(filepath, mmap=False):
+    """
+    Reads the dc and s variables of a v7.3 (HDF5) .nirs file. MATLAB stores arrays
+    column-major, the datasets are transposed back to samples first
+    :param filepath: .nirs filepath
+    :param mmap: memory-map dc instead of reading it, only possible for contiguous, uncompressed datasets
+    :return: data, stims; data is None if it could not be memory-mapped
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is required to read v7.3 .nirs files, install it with 'pip install h5py'")
+    with h5py.File(filepath, 'r') as f:
+        stims = np.asarray(f['s'][()].T, dtype=np.int64)
+        dc = f['procResult']['dc']
+        if not mmap:
+            return np.asarray(dc[()].T, dtype=np.float64), stims
+        offset = dc.id.get_offset()
+        if dc.chunks is not None or dc.compression is not None or offset is None or dc.dtype != np.float64:
+            return None, stims
+        shape = dc.shape
+    data = np.memmap(filepath, dtype=np.float64, mode='r', offset=offset, shape=shape).T # no copy, only pages that are indexed are read
+    return data, stims
+
+def _read_nirs_mat(filepath):
+    """
+    Reads only the dc and s variables of a .nirs file, arrays already stored with
+    the target dtype are not copied
+    :param filepath: .nirs filepath
+    :return: data, stims
+    """
+    if _is_hdf5_mat(filepath):
+        return _read_nirs_hdf5(filepath)
+    nirs = scipy.io.loadmat(filepath, variable_names=['s', 'procResult'])
+    stims = np.asarray(nirs['s'], dtype=np.int64) # stimulus data
+    data = np.asarray(nirs['procResult']['dc'][0][0], dtype=np.float64) # HbO, HbR, HbT values
+    return data, stims
+
+def _remove_stale_copies(cacheDir, stem, key):
+    """
+    Removes the .npy copies of earlier versions of a source file
+    :param cacheDir: directory of the .npy copies
+    :param stem: stem of the source file
+    :param key: key of the current copy, kept
+    :return: None
+    """
+    for suffix in ['.dc.npy', '.s.npy']:
+        for fname in cacheDir.glob('{}-*{}'.format(glob.escape(stem), suffix)):
+            old = fname.name[len(stem)+1:-len(suffix)]
+            if old == key or len(old) != len(key): # another source whose stem has a dash
+                continue
+            try:
+                fname.unlink()
+                logging.info("Removed stale cached copy {}".format(fname))
+            except OSError: # removed by another worker, or still mapped on windows
+                pass
+
+def _read_nirs_cached(filepath, cacheDir):
+    """
+    Memory-maps the data from a .npy copy in cacheDir, the copy is written on first
+    read and reused as long as the source file is unchanged, copies of earlier
+    versions of the file are removed when a new one is written
+    :param filepath: .nirs filepath
+    :param cacheDir: directory for the .npy copies
+    :return: data (memory-mapped, read-only), stims
+    """
+    source = Path(filepath).resolve()
+    stat = source.stat()
+    key = hashlib.sha1('{}:{}:{}'.format(source, stat.st_size, stat.st_mtime_ns).encode()).hexdigest()[:16]
+    dcFile = Path(cacheDir) / '{}-{}.dc.npy'.format(source.stem, key)
+    sFile = Path(cacheDir) / '{}-{}.s.npy'.format(source.stem, key)
+    if not (dcFile.exists() and sFile.exists()):
+        data, stims = _read_nirs_mat(filepath)
+        Path(cacheDir).mkdir(parents=True, exist_ok=True)
+        for fname, arr in [(dcFile, data), (sFile, stims)]:
+            tmp = fname.with_name('{}.{}.tmp.npy'.format(fname.stem, os.getpid()))
+            np.save(tmp, arr)
+            os.replace(tmp, fname) # atomic, safe when several workers cache the same file
+        del data
+        logging.info("Cached data of {} in {}".format(filepath, dcFile))
+        _remove_stale_copies(Path(cacheDir), source.stem, key)
+    return np.load(dcFile, mmap_mode='r'), np.load(sFile)
+
+def read_nirs(filepath, mmap=False, cacheDir=None):
+    """
+    Parse a .nirs file
+    :param filepath: .nirs filepath
+    :param mmap: return data as a read-only memory-mapped array so that only the indexed samples are read into memory, type: bool
+    :param cacheDir: directory for the memory-mappable copy of the data, used with mmap when the file can not be mapped directly, defaults to the system temp directory
+    :return: data, stims
+    """
+    data = None
+    if mmap and _is_hdf5_mat(filepath):
+        data, stims = _read_nirs_hdf5(filepath, mmap=True)
+    if mmap and data is None:
+        data, stims = _read_nirs_cached(filepath, cacheDir if cacheDir is not None else Path(tempfile.gettempdir())/'fnirslib')
+    elif data is None:
+        data, stims = _read_nirs_mat(filepath)
+    logging.info("Successfully loaded data from {}".format(filepath))
+    logging.info("Data shape: {}, Stimulus data shape: {}".format(data.shape, stims.shape))
+    return data, stims
+
+STIM_DTYPE = np.int8 # stims are flags, negative for stims disabled in Homer
+
+def storage(data, stims, dtype=None):
+    """
+    Converts loaded data to the storage dtypes of the pipeline: the signals to dtype (np.float32
+    halves the memory and bandwidth of float64, the stages that need it still accumulate in
+    float64) and the stims to compact int8 flags. Memory-mapped data are left mapped
+    :param data: data
+    :param stims: stimulus data
+    :param dtype: signal dtype, None to keep the data and stims as read
+    :return: data, stims
+    """
+    if dtype is None:
+        return data, stims
+    if not isinstance(data, np.memmap):
+        data = np.asarray(data, dtype=dtype)
+    return data, np.asarray(stims, dtype=STIM_DTYPE)
+
+def region_matrix(regions, nChannels, regionWeights=None, channelMask=None):
+    """
+    Channel to region averaging matrix
+    :param regions: brain regions, type: list of lists
+    :param nChannels: number of channels in the data
+    :param regionWeights: weight of each channel within its region, None for equal weights, type: list of lists
+    :param channelMask: good channels, the weights of the other channels are set to 0 and
+                        the remaining weights renormalized, None for all channels, type: boolean array
+    :return: nChannels x nRegions matrix, columns sum to 1 (NaN for regions without good channels)
+    """
+    matrix = np.zeros((nChannels, len(regions)))
+    for i,region in enumerate(regions):
+        weights = np.ones(len(region)) if regionWeights is None else np.asarray(regionWeights[i], dtype=np.float64)
+        assert np.max(region) < nChannels, 'Region {} has channels outside the data'.format(i)
+        np.add.at(matrix[:,i], region, weights)
+    if channelMask is not None:
+        matrix[:len(channelMask)][~np.asarray(channelMask, dtype=bool)] = 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return matrix / np.sum(matrix, axis=0)
+
 class Fnirslib:
-    def __init__(self, filepath, regions, stimNumber, condition, sex='NA', paired=True):
+    def __init__(self, filepath, regions, stimNumber, condition, sex='NA', paired=True, recording=None, regionWeights=None, cache=None, channelMask=None, dtype=None):
         """
         Initialize the class
         :param filepath: .nirs or .snirf filepath
@@ -20,8 +180,15 @@ class Fnirslib:
         :param condition: condition, type: str
         :param sex: sex of the participant, M or F, type: str
         :param paired: True if each trial has start and end stim, type: bool
+        :param recording: already parsed recording to share data from, see recording.Recording, type: Recording
+        :param regionWeights: weight of each channel within its region, same shape as regions, None for equal weights, type: list of lists
+        :param cache: on-disk cache of intermediate results, stages are recomputed only when their input or parameters change, see cache.Cache, type: Cache
+        :param channelMask: good channels, bad channels are left out of the regions, see channel_quality, None for all channels, type: boolean array
+        :param dtype: storage dtype of the loaded signals, e.g. np.float32, stims are then stored as int8, see storage. None keeps the dtypes of the file
         """
         self.filepath = filepath
+        self.recording = recording
+        self.cache = cache
         self.regions = regions
         self.stimNumber = stimNumber
         self.condition = condition
@@ -29,33 +196,83 @@ class Fnirslib:
         self.paired = paired
         self.nRegions = len(regions) # number of brain regions
         self.nChannels = sum([len(e) for e in regions]) # number of channels
+        self.regionWeights = regionWeights
+        self.channelMask = None if channelMask is None else np.asarray(channelMask, dtype=bool)
+        self.dtype = dtype
+        self.quality = None # channel quality metrics, see channel_quality
+        self._regionMatrices = {}
+        self.regionMatrix = self.region_matrix(max(self.nChannels, max([max(e) for e in regions])+1)) # channels x regions averaging matrix
         logging.info("Processing file '{}', with condition '{}' ...".format(self.filepath,self.condition))        
         logging.info("Number of channels: {}, Number of regions: {}".format(self.nChannels, self.nRegions))
 
-    def load_nirs(self):
+    def _cached(self, stage, inputs, params, compute):
+        """
+        Output of a pipeline stage, from the cache if one is set
+        :param stage: stage name
+        :param inputs: stage inputs, arrays or filepaths
+        :param params: stage parameters
+        :param compute: function computing the stage output
+        :return: stage output
+        """
+        if self.cache is None:
+            return compute()
+        return self.cache.memoize(stage, inputs, params, compute)
+
+    def _storage(self, data, stims):
         """
-        Load nirs data from filepath
+        Converts loaded data to the storage dtypes, the converted arrays keep their cache key
+        :param data: data
+        :param stims: stimulus data
+        :return: data, stims, see storage
+        """
+        converted = storage(data, stims, dtype=self.dtype)
+        if self.cache is None:
+            return converted
+        return self.cache.derive('storage', [data, stims], {'dtype': str(self.dtype)}, converted)
+
+    @instrument
+    def load_nirs(self, mmap=False, cacheDir=None):
+        """
+        Load nirs data from filepath, if the object is bound to a recording
+        the shared (read-only) data of the recording is returned instead
+        :param mmap: memory-map the data, see read_nirs, type: bool
+        :param cacheDir: directory for the memory-mappable copy of the data, see read_nirs
         :return: data, stims
         """
-        nirs = scipy.io.loadmat(self.filepath) 
-        stims = np.array(nirs['s'], dtype=np.int64) # stimulus data
-        data = np.array(nirs['procResult']['dc'][0][0], dtype=np.float64) # HbO, HbR, HbT values
-        logging.info("Successfully loaded data from {}".format(self.filepath))
-        logging.info("Data shape: {}, Stimulus data shape: {}".format(data.shape, stims.shape))
-        return data, stims
+        if self.recording is not None:
+            return self.recording.load()
+        if mmap:
+            return storage(*read_nirs(self.filepath, mmap=mmap, cacheDir=cacheDir), dtype=self.dtype)
+        return self._storage(*self._cached('load_nirs', [self.filepath], {}, lambda: read_nirs(self.filepath)))
 
-    def load_snirf(self):
+    @instrument
+    def load_snirf(self, start=0, stop=None, channels=None):
         """
-        Loads snirf file
+        Loads snirf file, only the requested samples and channels are read from disk
+        :param start: first sample
+        :param stop: last sample (exclusive), None for the end of the recording
+        :param channels: channel indices, None for all channels
         :return: data, stims
         """
-        raise NotImplementedError
-        stims = None
-        data = None
-        logging.info("Successfully loaded data from {}".format(self.filepath))
-        logging.info("Data shape: {}, Stimulus data shape: {}".format(data.shape, stims.shape))
-        return data, stims
+        if self.recording is not None:
+            return self.recording.load()
+        return self._storage(*self._cached('load_snirf', [self.filepath], {'start': start, 'stop': stop, 'channels': channels},
+                                           lambda: snirf.read_snirf(self.filepath, start=start, stop=stop, channels=channels)))
+
+    @instrument
+    def load_raw_nirs(self, ppf=6):
+        """
+        Load the raw intensity of a .nirs file and convert it to HbO, HbR, HbT with the
+        modified Beer-Lambert law, for files not processed by Homer, see mbll.read_conc
+        :param ppf: partial pathlength factor, one value or one per wavelength
+        :return: data (samples x 3 x channels), stims
+        """
+        if self.recording is not None:
+            return self.recording.load()
+        return self._storage(*self._cached('load_raw_nirs', [self.filepath], {'ppf': np.ravel(ppf).tolist()},
+                                           lambda: mbll.read_conc(self.filepath, ppf=ppf)))
 
+    @instrument
     def sanity_check(self, data, stims, trialTimes=None):
         """
         :param data: data
@@ -78,16 +295,71 @@ class Fnirslib:
             end_stim = loc[1::2] # get end indices
             trial_durations = end_stim - start_stim
             mean_duration = np.mean(trial_durations)
-            logging.info("Trial starts: {}".format(start_stim))
-            logging.info("Trial ends: {}".format(end_stim))
+            logging.debug("Trial starts: %s", start_stim) # formatted only if debug logging is on
+            logging.debug("Trial ends: %s", end_stim)
         elif not self.paired:
             if trialTimes is None:
                 logging.error("Trial times not provided")
             mean_duration = np.mean(trialTimes)
-            logging.info("Trial starts: {}".format(np.where(stims[:,self.stimNumber]==1)[0]))
-            logging.info("Trial durations: {}".format(trialTimes))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Trial starts: %s", np.where(stims[:,self.stimNumber]==1)[0])
+            logging.debug("Trial durations: %s", trialTimes)
         logging.info("Mean trial duration: {}".format(mean_duration))
 
+    @instrument
+    def get_baseline(self, data, stims, method='local', sig_type=None, duration=None, freq=None, baseline_stim=None, perTrial=False):
+        """
+        Gets the baseline of all trials in one pass
+        :param data: data
+        :param stims: stimulus data
+        :param method: 'local' for the window of given duration before each trial start, 'global' for the
+                       data between the two baseline_stim marks, type: str
+        :param sig_type: signal type, 0 HbO, 1 HbR, 2 HbT, None for all signal types
+        :param duration: duration of the local baseline in seconds
+        :param freq: sampling frequency
+        :param baseline_stim: baseline stimulus, for the global baseline
+        :param perTrial: return the baseline of each trial instead of the mean over the trials, type: bool
+        :return: baseline data, trials x ... if perTrial
+        """
+        params = {'stimNumber': self.stimNumber, 'paired': self.paired, 'method': method, 'sig_type': sig_type,
+                  'duration': duration, 'freq': freq, 'baseline_stim': baseline_stim, 'perTrial': perTrial}
+        return self._cached('get_baseline', [data, stims], params,
+                            lambda: self._get_baseline(data, stims, method, sig_type, duration, freq, baseline_stim, perTrial))
+
+    def _get_baseline(self, data, stims, method, sig_type, duration, freq, baseline_stim, perTrial):
+        stim_indices = np.where(stims[:,self.stimNumber]==1)[0] # get indices of stims
+        if self.paired:
+            # get start indices
+            stim_indices = stim_indices[::2]
+        if method.lower() == 'local':
+            num_obs = int(duration*freq) # number of observations in the baseline
+            baseline = baseline_mod.window_means(data, stim_indices-num_obs+1, stim_indices) # window before each stim
+        elif method.lower() == 'global':
+            loc = np.where(stims[:,baseline_stim]==1)[0]
+            if loc.shape[0] !=2:
+                raise ValueError('Baseline stim not found')
+            baseline = baseline_mod.window_means(data, loc[:1], loc[1:])
+            baseline = np.repeat(baseline, stim_indices.shape[0], axis=0) # same baseline for every trial
+        else:
+            raise ValueError('Unknown baseline method {}'.format(method))
+        if sig_type is not None:
+            baseline = baseline[:,sig_type]
+        if perTrial:
+            return baseline
+        with np.errstate(invalid='ignore'):
+            return np.nanmean(baseline, axis=0) if baseline.shape[0] > 0 else np.full(baseline.shape[1:], np.nan) # mean across trials
+
+    @instrument
+    def baseline_correct(self, data, baseline):
+        """
+        Subtracts the baseline from trial epochs
+        :param data: epochs, trials x samples x ..., see get_epochs
+        :param baseline: baseline from get_baseline, per trial if perTrial was set
+        :return: baseline corrected epochs
+        """
+        return baseline_mod.subtract(data, baseline)
+
+    @instrument
     def get_global_baseline(self, data, stims, baseline_stim, sig_type):
         """
         Gets the baseline
@@ -97,14 +369,9 @@ class Fnirslib:
         :param sig_type: signal type, 0 HbO, 1 HbR, 2 HbT
         :return: baseline data
         """
-        loc = np.where(stims[:,baseline_stim]==1)[0]
-        if loc.shape[0] !=2:
-            raise ValueError('Baseline stim not found')
-        baseline = data[loc[0]:loc[1],:]
-        baseline = baseline[:,sig_type,:]
-        baseline = np.mean(baseline, axis=0)
-        return baseline
+        return self.get_baseline(data, stims, 'global', sig_type=sig_type, baseline_stim=baseline_stim)
 
+    @instrument
     def get_local_baseline(self, data, stims, sig_type, duration, freq):
         """
         Gets the local baseline
@@ -115,27 +382,7 @@ class Fnirslib:
         :param freq: sampling frequency
         :return: local baseline data
         """
-        data = data[:,sig_type,:]
-        num_obs = int(duration*freq) # number of observations in the baseline
-        stim_indices = np.where(stims[:,self.stimNumber]==1)[0] # get indices of stims
-        if self.paired:
-            # get start indices
-            stim_indices = stim_indices[::2]
-        baseline = []
-        for idx in stim_indices:
-            baseline.append(np.mean(data[idx-num_obs+1:idx,:], axis=0)) # mean across observations
-        baseline = np.array(baseline)
-        baseline = np.mean(baseline, axis=0) # mean across trials
-        print(baseline.shape)
-        return baseline
-
-    def _find_islands(self, x):
-        """
-        Finds islands of 1s in the data
-        :param x: data
-        :return: number of islands
-        """
-        return np.sum(x[1:] & ~x[:-1]) + x[0]
+        return self.get_baseline(data[:,sig_type,:], stims, 'local', duration=duration, freq=freq)
 
     def _insert_end_stim(self, stims, trialTimes, freq):
         '''
@@ -145,6 +392,7 @@ class Fnirslib:
         :param freq: sampling frequency
         :return: stims with end stims
         '''
+        stims = stims.copy() # stims may be shared with other conditions
         startIdx = np.nonzero(stims[:,self.stimNumber])[0]  # get index of start stim
         stopIdx = startIdx + np.array(trialTimes*freq, dtype=np.int64)[:startIdx.shape[0]]
 
@@ -163,6 +411,7 @@ class Fnirslib:
         make number of observations equal across trials, by setting them equal
         to min number of observations
         '''
+        stims = stims.copy() # stims may be shared with other conditions
         loc = np.where(stims[:,self.stimNumber]==1)[0]
         start = loc[::2] # get start indices
         end = loc[1::2] # get end indices
@@ -171,17 +420,54 @@ class Fnirslib:
         stims[start+np.min(end-start),self.stimNumber] = 1 # set end stims to 1
         return stims
 
-    def get_ROI(self, data, stims,  equalize=False,  aggMethod='concat', trialTimes=None, freq=None):
+    @instrument
+    def get_epochs(self, data, stims, pre=0, post=0, trialTimes=None, freq=None):
         """
-        get ROI data for the stimulus condition
+        Cut the trials of the stimulus condition into equal length epochs, trials are
+        cut to the shortest trial
         :param data: data, type: numpy array
         :param stims: stimulus data, type: numpy array
-        :param equalize: equalize the number of obs in all trials, automatically set True if aggMethod is 'mean', type: bool
-        :param aggMethod: method to aggregate data, either 'concat' or 'mean' the trials, type: str
+        :param pre: number of samples to add before the start of each trial, type: int
+        :param post: number of samples to add after the end of each trial, type: int
         :param trialTimes: array of trial durations, cannot be None if stimPair is False, type: list
         :param freq: frequency of the data, type: float
-        :return: ROI data, concatenated data for all trials with given stimulus/condition
+        :return: epochs (trials x samples x 3 x channels), stims with equalized trials
         """
+        if not self.paired:
+            stims = self._insert_end_stim(stims, trialTimes, freq)
+        stims = self._equalize_trial_length(stims)
+        start, end = epochs.trial_bounds(stims, self.stimNumber)
+        return epochs.epoch(data, start, np.min(end-start), pre=pre, post=post), stims
+
+    @instrument
+    def get_ROI(self, data, stims,  equalize=False,  aggMethod='concat', trialTimes=None, freq=None, pre=0, post=0):
+        """
+        get ROI data for the stimulus condition
+        :param data: data, type: numpy array
+        :param stims: stimulus data, type: numpy array
+        :param equalize: equalize the number of obs in all trials, automatically set True if aggMethod is 'mean' or 'trials', type: bool
+        :param aggMethod: method to aggregate data, either 'concat' or 'mean' the trials, or 'trials' to keep each trial, type: str
+        :param trialTimes: array of trial durations, cannot be None if stimPair is False, type: list
+        :param freq: frequency of the data, type: float
+        :param pre: number of samples to add before each trial, only for 'mean' and 'trials', type: int
+        :param post: number of samples to add after each trial, only for 'mean' and 'trials', type: int
+        :return: ROI data, concatenated data for all trials with given stimulus/condition, mean over the trials
+                 or trials x samples x 3 x channels for 'trials'
+        """
+        params = {'stimNumber': self.stimNumber, 'paired': self.paired, 'equalize': equalize, 'aggMethod': aggMethod,
+                  'trialTimes': None if trialTimes is None else np.asarray(trialTimes).tolist(), 'freq': freq, 'pre': pre, 'post': post}
+        return self._cached('get_ROI', [data, stims], params,
+                            lambda: self._get_ROI(data, stims, equalize, aggMethod, trialTimes, freq, pre, post))
+
+    def _get_ROI(self, data, stims, equalize, aggMethod, trialTimes, freq, pre, post):
+        if aggMethod.lower() in ['mean', 'trials']:
+            data, stims = self.get_epochs(data, stims, pre=pre, post=post, trialTimes=trialTimes, freq=freq)
+            if aggMethod.lower()=='mean':
+                # mean over the trials, accumulated in float64 and stored with the dtype of the data
+                data = np.mean(data, axis=0, dtype=np.float64).astype(np.result_type(data.dtype, np.float32), copy=False)
+            logging.info('Number of observations in ROI: {}'.format(data.shape[-3]))
+            return data, stims
+
         if not self.paired:
             # print('# stims before pairing: ', np.count_nonzero(stims[:,self.stimNumber]))
             stims = self._insert_end_stim(stims, trialTimes, freq)
@@ -189,51 +475,111 @@ class Fnirslib:
 
         assert np.count_nonzero(stims[:,self.stimNumber])%2==0, "Number of stims should be even"
 
-        if equalize or aggMethod.lower()=='mean':
+        if equalize:
             stims = self._equalize_trial_length(stims)
 
         # create a mask for the stimulus
         mask = np.cumsum(stims[:,self.stimNumber]) % 2   # set values to 1 between two consecutive 1s
-        islands = self._find_islands(mask) # number of islands
-        # print('# of islands: ', islands)
         if aggMethod.lower()=='concat':
             data = data[mask==1]  # apply the mask to the data
-        if aggMethod.lower()=='mean':
-            idx = np.where(mask!=0)[0]
-            data = np.array(np.split(data[idx],np.where(np.diff(idx)!=1)[0]+1))
-            data = np.mean(data, axis=0) # mean over the trials
-            # print('data shape after mean', data.shape)
         logging.info('Number of observations in ROI: {}'.format(data.shape[0]))
         return data, stims
 
-    def cluster_channels(self, data):
+    @instrument
+    def channel_quality(self, data, freq=None, raw=None, **thresholds):
+        """
+        Computes the quality metrics of all channels in one pass and sets the channel mask,
+        bad channels are left out of the regions from then on, see quality.assess
+        :param data: data, samples x 3 x channels
+        :param freq: sampling frequency, needed for the scalp coupling index
+        :param raw: raw intensity, samples x wavelengths x channels (see quality.raw_by_channel), optional
+        :param thresholds: sciMin, cvMax, saturationMax, nanMax, see quality.channel_mask
+        :return: quality metrics, channel mask
+        """
+        self.quality, mask = quality.assess(data, freq=freq, raw=raw, **thresholds)
+        self.channelMask = mask
+        self._regionMatrices = {}
+        self.regionMatrix = self.region_matrix(self.regionMatrix.shape[0])
+        return self.quality, mask
+
+    @instrument
+    def mask_channels(self, data):
+        """
+        Sets the bad channels to NaN, the metrics ignore them
+        :param data: data, channels along the last axis
+        :return: masked copy of the data, the data itself if there is no channel mask or all channels are good
+        """
+        if self.channelMask is None:
+            return data
+        masked = quality.mask_channels(data, self.channelMask)
+        if self.cache is None:
+            return masked
+        return self.cache.derive('mask_channels', [data], {'channelMask': self.channelMask.tolist()}, masked)
+
+    @instrument
+    def region_matrix(self, nChannels):
         """
-        Merge channels into regions using mean
-        :param data: data
+        Channel to region averaging matrix, built once per number of channels
+        :param nChannels: number of channels in the data
+        :return: nChannels x nRegions matrix, columns sum to 1
+        """
+        if nChannels not in self._regionMatrices:
+            self._regionMatrices[nChannels] = region_matrix(self.regions, nChannels, self.regionWeights, self.channelMask)
+        return self._regionMatrices[nChannels]
+
+    @instrument
+    def cluster_channels(self, data, aggMethod='mean'):
+        """
+        Merge channels into regions, channels along the last axis. Bad channels (see
+        channel_quality) and missing (NaN) values are left out and the weights of the
+        remaining channels of the region renormalized
+        :param data: data, any number of dimensions
+        :param aggMethod: 'mean' (weighted if regionWeights were given) or 'median', type: str
         :return: clustered data for the brain regions
         """
-        if data.ndim==1:
-            outData = np.zeros((self.nRegions,))
-            for i,region in enumerate(self.regions):
-                outData[i] = np.mean(data[region], axis=0)
-        elif data.ndim==2:
-            outData = np.zeros((data.shape[0], self.nRegions))
-            for i,region in enumerate(self.regions):
-                outData[:,i] = np.mean(data[:,region], axis=1)
-        elif data.ndim==3:
-            outData = np.zeros((data.shape[0], data.shape[1], self.nRegions))
-            for i,region in enumerate(self.regions):
-                outData[:,:,i] = np.mean(data[:,:,region], axis=2)
-        return outData
+        params = {'regions': [np.asarray(r).tolist() for r in self.regions], 'aggMethod': aggMethod,
+                  'regionWeights': None if self.regionWeights is None else [np.asarray(w).tolist() for w in self.regionWeights],
+                  'channelMask': None if self.channelMask is None else self.channelMask.tolist()}
+        return self._cached('cluster_channels', [data], params, lambda: self._cluster_channels(data, aggMethod))
+
+    def _cluster_channels(self, data, aggMethod):
+        if aggMethod.lower() == 'median':
+            if self.channelMask is not None:
+                data = self.mask_channels(data)
+            with warnings.catch_warnings(): # regions without good channels give NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                return np.stack([np.nanmedian(data[...,region], axis=-1) for region in self.regions], axis=-1)
+        matrix = self.region_matrix(data.shape[-1]).astype(np.result_type(data.dtype, np.float32), copy=False) # float32 data stay float32
+        nan = np.isnan(data)
+        if not nan.any():
+            return data @ matrix # single matmul over the channel axis
+        with np.errstate(invalid='ignore', divide='ignore'): # renormalize by the weight of the values present
+            return (np.where(nan, 0.0, data) @ np.nan_to_num(matrix)) / ((~nan) @ np.nan_to_num(matrix))
 
+    @instrument
     def detrend(self, data):
         """
-        Detrends the data
-        :param data: data
+        Removes a linear trend from every channel, masked (NaN) channels stay NaN
+        :param data: data, samples along the first axis
         :return: detrended data
         """
-        return scipy.signal.detrend(data, axis=0, type='linear')
+        return self._cached('detrend', [data], {}, lambda: preprocessing.polynomial_detrend(data, order=1))
 
+    @instrument
+    def preprocess(self, data, freq, steps=None):
+        """
+        Applies a chain of preprocessing steps (band-pass filter, motion correction, polynomial
+        detrend, z-score) to all channels and signal types in one pass, see preprocessing.preprocess
+        :param data: data, samples x ...
+        :param freq: sampling frequency
+        :param steps: list of (step, parameters), None for preprocessing.DEFAULT_STEPS
+        :return: preprocessed data
+        """
+        steps = preprocessing.DEFAULT_STEPS if steps is None else steps
+        return self._cached('preprocess', [data], {'freq': freq, 'steps': steps},
+                            lambda: preprocessing.preprocess(data, freq, steps))
+
+    @instrument
     def normalize(self, data):
         """
         Normalizes the data
@@ -242,49 +588,117 @@ class Fnirslib:
         """
         return data/np.max(data)
 
-    def peak_activation(self, data, baseline=None, peakPadding=4):
+    def _samples_first(self, data, trials):
+        """
+        Checks the shape of activation input and moves the samples to the first axis
+        :param data: data, samples x channels or trials x samples x channels
+        :param trials: data holds one epoch per trial, type: bool
+        :return: data, samples first
+        """
+        if trials:
+            if data.ndim != 3:
+                raise ValueError('Expected trials x samples x channels, got shape {}'.format(data.shape))
+            return np.moveaxis(data, 1, 0)
+        if data.ndim > 2:
+            raise ValueError('Expected samples x channels, got shape {} (select the signal type first, '
+                             'or set trials for trials x samples x channels)'.format(data.shape))
+        return data
+
+    @instrument
+    def peak_activation(self, data, baseline=None, peakPadding=4, trials=False):
         """
         Finds the peak activation of the data
-        :param data: data
-        :param baseline: baseline data
+        :param data: data, samples x channels, or trials x samples x channels if trials is set
+        :param baseline: baseline data, per channel or per trial and channel
         :param peakPadding: number of samples to pad the peak
-        :return: peak activations
+        :param trials: data holds one epoch per trial (see get_ROI with aggMethod='trials'), type: bool
+        :return: peak activations, per channel or trials x channels
         """
+        data = self._samples_first(data, trials)
         return metrics.Metrics(data, peakPadding).get_peak_activation(baseline=baseline)
 
-    def mean_activation(self, data):
+    @instrument
+    def mean_activation(self, data, trials=False):
         """
         Finds the mean activation of the data
-        :param data: data
-        :return: mean activations 
+        :param data: data, samples x channels, or trials x samples x channels if trials is set
+        :param trials: data holds one epoch per trial (see get_ROI with aggMethod='trials'), type: bool
+        :return: mean activations, per channel or trials x channels
         """
+        data = self._samples_first(data, trials)
         return metrics.Metrics(data).get_mean_activation()
 
+    @instrument
+    def glm(self, data, stims, freq, stimNumbers=None, basis='hrf', contrasts=None, trialTimes=None, **designParams):
+        """
+        Hemodynamic response of every channel from a general linear model of the whole recording,
+        fitted to all channels and signal types with one shared factorization of the design. Use it
+        on the data before get_ROI and without detrend, the drift regressors of the design model the
+        trends (see glm.design_matrix for designParams)
+        :param data: data, samples x ... (e.g. samples x 3 x channels)
+        :param stims: stimulus data
+        :param freq: sampling frequency
+        :param stimNumbers: stimulus columns modelled as conditions, type: list, the view's stimulus if None
+        :param basis: 'hrf' (canonical HRF, one beta per condition) or 'fir' (block-averaged response per time bin)
+        :param contrasts: weights of the regressors for the t-statistics, None for every regressor
+        :param trialTimes: trial durations in seconds for unpaired stims
+        :return: betas (regressors x ...), t-statistics, regressor names
+        """
+        stimNumbers = [self.stimNumber] if stimNumbers is None else stimNumbers
+        design, names = glm_mod.design_matrix(stims, freq, stimNumbers, paired=self.paired, trialTimes=trialTimes,
+                                              basis=basis, **designParams)
+        betas, tstats, _ = glm_mod.fit(data, design, contrasts=contrasts)
+        return betas, tstats, names
+
+    @instrument
     def functional_connectivity(self, data):
         """
         Finds functional connectivity
-        :param data: data
+        :param data: data, regions x samples
         :return: correlation matrix, z-scores
         """
         return metrics.Metrics(data).get_functional_connectivity()
 
-    def effective_connectivity(self, data):
+    @instrument
+    def dynamic_connectivity(self, data, width, step=1):
         """
-        Finds effective connectivity
-        :param data: data
-        :return:  None
+        Finds functional connectivity over sliding windows
+        :param data: data, regions x samples
+        :param width: window width in samples
+        :param step: step between windows in samples
+        :return: correlation matrices, z-scores; windows x regions x regions
+        """
+        return metrics.Metrics(data).get_dynamic_connectivity(width, step)
+
+    @instrument
+    def effective_connectivity(self, data, order=None, maxOrder=10, criterion='bic'):
+        """
+        Finds effective connectivity (conditional Granger causality)
+        :param data: data, regions x samples
+        :param order: VAR model order, selected by information criterion if None
+        :param maxOrder: largest model order considered for the selection
+        :param criterion: information criterion for the order selection, 'aic' or 'bic'
+        :return: Granger causality, p-values, model order
         """
-        return metrics.Metrics(data).get_effective_connectivity()
+        return metrics.Metrics(data).get_effective_connectivity(order=order, maxOrder=maxOrder, criterion=criterion)
 
-    def save_processed_data(self, data, stims, dir):
+    @instrument
+    def save_processed_data(self, data, stims, dir, writer=None):
         """
-        Saves processed data to .mat files
+        Saves processed data to .mat files, or through a batched writer
         :param data: data
         :param stims: stimulus data
-        :param dir: directory to save the data
+        :param dir: directory to save the data, not used with a writer
+        :param writer: writer storing all subjects of a condition in one container, see writer.ProcessedDataWriter
         :return: None
         """
-        Path(dir+'/'+self.condition).mkdir(parents=True, exist_ok=True) # create a directory for the condition
-        fname = dir+'/'+self.condition+'/'+self.filepath.split('/')[-1].split('.')[0]+'.mat'
-        scipy.io.savemat(fname, {"pdata": data, "nTrials": np.count_nonzero(stims[:,self.stimNumber])/2})
-        logging.info('Saved data to {}'.format(fname))
\ No newline at end of file
+        subject = Path(self.filepath).name.split('.')[0]
+        nTrials = np.count_nonzero(stims[:,self.stimNumber])/2
+        if writer is not None:
+            writer.write(self.condition, subject, data, nTrials)
+            return
+        directory = Path(dir) / self.condition
+        directory.mkdir(parents=True, exist_ok=True) # create a directory for the condition
+        fname = directory / (subject+'.mat')
+        scipy.io.savemat(str(fname), {"pdata": data, "nTrials": nTrials})
+        logging.info('Saved data to {}'.format(fname))
@@ -0,0 +1,185 @@
+"""
+author: @nimrobotics
+description: general linear model of fnirs data, design matrices from the stim columns with a
+             canonical HRF or FIR basis and drift regressors, one shared solve for all channels
+"""
+
+import numpy as np
+import scipy.stats
+import scipy.signal
+import functools
+import logging
+from . import epochs
+
+BASES = ['hrf', 'fir']
+DRIFTS = ['polynomial', 'dct', None]
+
+@functools.lru_cache(maxsize=16)
+def hrf(freq, duration=32.0, peak=6.0, undershoot=16.0, ratio=6.0):
+    """
+    Canonical double-gamma hemodynamic response function (as SPM), computed once per parameters
+    :param freq: sampling frequency
+    :param duration: length of the response in seconds
+    :param peak: delay of the response peak in seconds
+    :param undershoot: delay of the undershoot in seconds
+    :param ratio: ratio of the peak to the undershoot
+    :return: response sampled at freq, sums to 1, read-only
+    """
+    t = np.arange(0, duration, 1/freq)
+    response = scipy.stats.gamma.pdf(t, peak) - scipy.stats.gamma.pdf(t, undershoot)/ratio
+    response /= np.sum(response)
+    response.flags.writeable = False
+    return response
+
+def trial_bounds(stims, stimNumber, paired=True, trialTimes=None, freq=None):
+    """
+    Start and end (exclusive) samples of the trials of a stim column
+    :param stims: stimulus data
+    :param stimNumber: stimulus column
+    :param paired: each trial has a start and an end stim, type: bool
+    :param trialTimes: trial durations in seconds for unpaired stims, one value for all trials or one per trial
+    :param freq: sampling frequency, needed for unpaired stims
+    :return: start indices, end indices
+    """
+    if paired:
+        return epochs.trial_bounds(stims, stimNumber)
+    assert trialTimes is not None and freq is not None, 'Unpaired stims need trialTimes and freq'
+    start = np.flatnonzero(stims[:,stimNumber])
+    duration = np.broadcast_to(np.asarray(trialTimes, dtype=np.float64), start.shape) if np.ndim(trialTimes) == 0 \
+               else np.asarray(trialTimes, dtype=np.float64)[:start.shape[0]]
+    return start, np.minimum(start + np.round(duration*freq).astype(np.int64), stims.shape[0])
+
+def boxcars(nSamples, bounds):
+    """
+    Boxcar of every condition, 1 during its trials
+    :param nSamples: number of samples
+    :param bounds: (start indices, end indices) of each condition, type: list
+    :return: boxcars, samples x conditions
+    """
+    edges = np.zeros((nSamples+1, len(bounds)))
+    for i, (start, end) in enumerate(bounds):
+        np.add.at(edges[:,i], start, 1)
+        np.add.at(edges[:,i], end, -1)
+    return np.minimum(np.cumsum(edges[:-1], axis=0), 1)
+
+def fir(nSamples, bounds, freq, duration=20.0, binWidth=1.0):
+    """
+    Finite impulse response basis: one regressor per condition and time bin after the trial
+    onsets, the betas are the block-averaged response in each bin
+    :param nSamples: number of samples
+    :param bounds: (start indices, end indices) of each condition, type: list
+    :param freq: sampling frequency
+    :param duration: length of the response in seconds
+    :param binWidth: width of a bin in seconds
+    :return: regressors (samples x conditions*bins, condition-major), number of bins
+    """
+    width = max(int(round(binWidth*freq)), 1)
+    nBins = max(int(round(duration*freq/width)), 1)
+    onsets = np.zeros((nSamples + 1, len(bounds)))
+    for i, (start, _) in enumerate(bounds):
+        np.add.at(onsets[1:,i], start, 1)
+    cumulative = np.cumsum(onsets, axis=0) # cumulative[t+1] = onsets up to sample t
+    t = np.arange(nSamples)
+    lags = np.arange(nBins)*width
+    # onsets in (t - lag - width, t - lag] for every lag, from the cumulative onset count
+    upper = np.clip(t[:,None] - lags + 1, 0, nSamples)
+    lower = np.clip(t[:,None] - lags - width + 1, 0, nSamples)
+    regressors = cumulative[upper] - cumulative[lower] # samples x bins x conditions
+    return np.moveaxis(regressors, 2, 1).reshape(nSamples, -1), nBins
+
+def drift(nSamples, freq, method='polynomial', order=1, cutoff=128.0):
+    """
+    Drift regressors, including the constant
+    :param nSamples: number of samples
+    :param freq: sampling frequency
+    :param method: 'polynomial' (Legendre-like polynomials over scaled time) or 'dct' (discrete
+                   cosines, a high-pass filter at 1/cutoff Hz), None for the constant only
+    :param order: polynomial order
+    :param cutoff: longest period kept by the dct drift in seconds
+    :return: regressors, samples x drifts
+    """
+    if method is None:
+        return np.ones((nSamples, 1))
+    if method == 'polynomial':
+        t = np.linspace(-1, 1, nSamples) # scaled time keeps the design well conditioned
+        return np.vander(t, order+1, increasing=True)
+    if method == 'dct':
+        nCosines = int(np.floor(2*nSamples/(freq*cutoff)))
+        k = np.arange(1, nCosines+1)
+        cosines = np.sqrt(2/nSamples)*np.cos(np.pi*(np.arange(nSamples)[:,None] + 0.5)*k/nSamples)
+        return np.c_[np.ones(nSamples), cosines]
+    raise ValueError('Unknown drift {}, expected one of {}'.format(method, DRIFTS))
+
+def design_matrix(stims, freq, stimNumbers, paired=True, trialTimes=None, basis='hrf', firDuration=20.0, firBin=1.0,
+                  driftMethod='polynomial', driftOrder=1, cutoff=128.0):
+    """
+    Design matrix of the stim columns
+    :param stims: stimulus data, samples x stimulus columns
+    :param freq: sampling frequency
+    :param stimNumbers: stimulus columns modelled as conditions, type: list
+    :param paired: each trial has a start and an end stim, type: bool
+    :param trialTimes: trial durations in seconds for unpaired stims
+    :param basis: 'hrf' (boxcar convolved with the canonical HRF) or 'fir'
+    :param firDuration: length of the FIR response in seconds
+    :param firBin: width of a FIR bin in seconds
+    :param driftMethod: drift regressors, see drift
+    :param driftOrder: polynomial drift order
+    :param cutoff: longest period kept by the dct drift in seconds
+    :return: design (samples x regressors), regressor names
+    """
+    nSamples = stims.shape[0]
+    bounds = [trial_bounds(stims, s, paired=paired, trialTimes=trialTimes, freq=freq) for s in stimNumbers]
+    if basis == 'hrf':
+        # one FFT convolution for all conditions, truncated to the recording
+        conditions = scipy.signal.fftconvolve(boxcars(nSamples, bounds), hrf(float(freq))[:,None], axes=0)[:nSamples]
+        names = ['stim{}'.format(s) for s in stimNumbers]
+    elif basis == 'fir':
+        conditions, nBins = fir(nSamples, bounds, freq, duration=firDuration, binWidth=firBin)
+        names = ['stim{}_bin{}'.format(s, b) for s in stimNumbers for b in range(nBins)]
+    else:
+        raise ValueError('Unknown basis {}, expected one of {}'.format(basis, BASES))
+    drifts = drift(nSamples, freq, method=driftMethod, order=driftOrder, cutoff=cutoff)
+    names += ['drift{}'.format(i) for i in range(drifts.shape[1])]
+    return np.c_[conditions, drifts], names
+
+def fit(data, design, contrasts=None, chunkSize=256):
+    """
+    Ordinary least squares fit of every channel and chromophore at once. The design is
+    factorized once (SVD) and shared by all columns of the data: the betas and the residual
+    sum of squares both come from one product with the left singular vectors, chunkSize
+    columns at a time to bound the memory
+    :param data: data, samples x ... (e.g. samples x 3 x channels)
+    :param design: design matrix, samples x regressors, with the constant in its span
+    :param contrasts: weights of the regressors (contrasts x regressors, e.g. [1, -1, 0, ...] for
+                      condition A - B) for the t-statistics, None for the t-statistic of every regressor
+    :param chunkSize: data columns per chunk
+    :return: betas (regressors x ...), t-statistics (regressors or contrasts x ...), degrees of freedom;
+             NaN for columns with missing (NaN) samples
+    """
+    shape = data.shape[1:]
+    y = np.asarray(data).reshape(data.shape[0], -1)
+    u, singular, vt = np.linalg.svd(design, full_matrices=False)
+    rank = int(np.sum(singular > singular[0]*max(design.shape)*np.finfo(np.float64).eps))
+    if rank < design.shape[1]:
+        logging.warning('Design matrix is rank deficient ({} of {} regressors), betas are minimum norm'.format(rank, design.shape[1]))
+    u, coef = u[:,:rank], vt[:rank].T / singular[:rank] # pseudo-inverse = coef @ u.T
+    uSum = np.sum(u, axis=0) # u.T @ ones
+    dof = design.shape[0] - rank
+    finite = np.flatnonzero(np.all(np.isfinite(y), axis=0))
+    betas = np.full((design.shape[1], y.shape[1]), np.nan)
+    rss = np.full(y.shape[1], np.nan)
+    for start in range(0, finite.shape[0], chunkSize):
+        columns = finite[start:start+chunkSize]
+        chunk = np.asarray(y[:,columns], dtype=np.float64)
+        # centered first, so that large offsets do not cancel in the sums of squares
+        mean = np.mean(chunk, axis=0)
+        chunk -= mean
+        projection = u.T @ chunk
+        betas[:,columns] = coef @ (projection + np.outer(uSum, mean))
+        # the constant is in the span of the design, the residuals of y and y - mean are the same
+        rss[columns] = np.maximum(np.einsum('ij,ij->j', chunk, chunk) - np.einsum('ij,ij->j', projection, projection), 0)
+    weights = np.eye(design.shape[1]) if contrasts is None else np.atleast_2d(np.asarray(contrasts, dtype=np.float64))
+    scale = np.linalg.norm(weights @ coef, axis=1) # sqrt(c' (X'X)^-1 c)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tstats = (weights @ betas) / (scale[:,None]*np.sqrt(rss/dof))
+    return betas.reshape((-1,)+shape), tstats.reshape((-1,)+shape), dof
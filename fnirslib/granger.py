@@ -0,0 +1,124 @@
+"""
+author: @nimrobotics
+description: effective connectivity, conditional Granger causality from VAR models
+"""
+
+import numpy as np
+import scipy.stats
+
+def _lagged(x, order, skip):
+    """
+    Builds the lagged design of a VAR model, columns are ordered lag 1 (all regions),
+    lag 2 (all regions), ... so the design of a lower order is a leading block of columns
+    :param x: centered data, ... x samples x regions
+    :param order: number of lags
+    :param skip: number of leading samples without a full history, >= order
+    :return: design (... x n x order*regions), targets (... x n x regions)
+    """
+    T = x.shape[-2]
+    design = np.concatenate([x[..., skip-k:T-k, :] for k in range(1, order+1)], axis=-1)
+    return design, x[..., skip:, :]
+
+def _triangular(x, order, skip):
+    """
+    R factor of the QR factorization of [design, targets]. It is the only pass over the
+    samples: since [design, targets] = Q R with orthonormal Q, the least squares fit of
+    the targets on any subset of design columns has the same residuals as the fit on
+    the corresponding columns of R, which is small
+    :param x: centered data, ... x samples x regions
+    :param order: number of lags
+    :param skip: number of leading samples without a full history, >= order
+    :return: R factor (... x k+regions x k+regions), number of samples n
+    """
+    design, targets = _lagged(x, order, skip)
+    r = np.linalg.qr(np.concatenate([design, targets], axis=-1), mode='r')
+    return r, targets.shape[-2]
+
+def _residual_cov(r, cols, k, n):
+    """
+    Residual covariance of the fit of all targets on a subset of design columns,
+    one factorization is shared by all targets
+    :param r: R factor from _triangular
+    :param cols: design columns used in the fit
+    :param k: number of design columns
+    :param n: number of samples
+    :return: ... x regions x regions
+    """
+    q, _ = np.linalg.qr(r[..., :, cols])
+    targets = r[..., :, k:]
+    proj = np.swapaxes(q, -1, -2) @ targets
+    cov = np.swapaxes(targets, -1, -2) @ targets - np.swapaxes(proj, -1, -2) @ proj
+    return cov / n
+
+def _center(data):
+    x = np.asarray(data, dtype=np.float64)
+    return x - np.mean(x, axis=-2, keepdims=True)
+
+def order_criteria(data, maxOrder):
+    """
+    AIC and BIC of VAR models of order 1..maxOrder. All orders are scored from a single
+    QR factorization of the maxOrder design: the residual of order p is the part of the
+    targets below the leading p*regions rows of R, so no model is refit. All orders use
+    the same samples
+    :param data: samples x regions, or subjects x samples x regions
+    :param maxOrder: largest model order
+    :return: aic, bic; ... x maxOrder
+    """
+    x = _center(data)
+    R = x.shape[-1]
+    k = maxOrder*R
+    r, n = _triangular(x, maxOrder, maxOrder)
+    aic = np.empty(x.shape[:-2]+(maxOrder,))
+    bic = np.empty(x.shape[:-2]+(maxOrder,))
+    for p in range(1, maxOrder+1):
+        resid = r[..., p*R:, k:] # residual of the targets after the leading p*R columns
+        cov = np.swapaxes(resid, -1, -2) @ resid / n
+        logdet = np.linalg.slogdet(cov)[1]
+        aic[..., p-1] = logdet + 2*p*R*R/n
+        bic[..., p-1] = logdet + np.log(n)*p*R*R/n
+    return aic, bic
+
+def select_order(data, maxOrder, criterion='bic'):
+    """
+    Selects the VAR model order by information criterion, for a stack of subjects the
+    order minimizing the mean criterion over subjects is used
+    :param data: samples x regions, or subjects x samples x regions
+    :param maxOrder: largest model order
+    :param criterion: 'aic' or 'bic'
+    :return: model order
+    """
+    aic, bic = order_criteria(data, maxOrder)
+    crit = {'aic': aic, 'bic': bic}[criterion.lower()]
+    return int(np.argmin(np.mean(crit.reshape(-1, maxOrder), axis=0))) + 1
+
+def granger_causality(data, order):
+    """
+    Conditional Granger causality between all pairs of regions. The samples are factorized
+    once; the full VAR model and, for each source, the reduced model without the source's
+    lags are fit on the small R factor, each fit shared by all targets. Subjects are
+    solved as a batch
+    :param data: samples x regions, or subjects x samples x regions
+    :param order: VAR model order
+    :return: gc, pvalues (F-test); ... x regions x regions, gc[i, j] is the causality
+             from region j to region i (MVGC convention), NaN diagonal
+    """
+    x = _center(data)
+    R = x.shape[-1]
+    k = order*R
+    r, n = _triangular(x, order, order)
+    full = np.diagonal(_residual_cov(r, np.arange(k), k, n), axis1=-2, axis2=-1)
+    gc = np.full(x.shape[:-2]+(R, R), np.nan)
+    pvalues = np.full(x.shape[:-2]+(R, R), np.nan)
+    dfFull = n - k
+    for j in range(R):
+        keep = np.ones(k, dtype=bool)
+        keep[j::R] = False # all lags of source j
+        reduced = np.diagonal(_residual_cov(r, np.flatnonzero(keep), k, n), axis1=-2, axis2=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gc[..., :, j] = np.log(reduced/full)
+            F = (reduced-full)/order / (full/dfFull)
+        pvalues[..., :, j] = scipy.stats.f.sf(F, order, dfFull)
+    diag = np.arange(R)
+    gc[..., diag, diag] = np.nan
+    pvalues[..., diag, diag] = np.nan
+    return gc, pvalues
@@ -0,0 +1,140 @@
+"""
+author: @nimrobotics
+description: raw intensity to HbO/HbR/HbT conversion with the modified Beer-Lambert law
+"""
+
+import numpy as np
+import scipy.io
+import functools
+import logging
+
+# molar extinction coefficients of HbO and HbR in cm^-1/M (S. Prahl, omlc.org/spectra/hemoglobin)
+EXTINCTION = {650: (368.0, 3750.12), 660: (319.6, 3226.56), 670: (294.0, 2795.12), 680: (277.6, 2407.92),
+              690: (276.0, 2051.96), 700: (290.0, 1794.28), 710: (314.0, 1540.48), 720: (348.0, 1325.88),
+              730: (390.0, 1102.2), 740: (446.0, 1115.88), 750: (518.0, 1405.24), 760: (586.0, 1548.52),
+              770: (650.0, 1311.88), 780: (710.0, 1075.44), 790: (770.0, 890.8), 800: (816.0, 761.72),
+              810: (864.0, 717.08), 820: (916.0, 693.76), 830: (974.0, 693.04), 840: (1022.0, 692.36),
+              850: (1058.0, 691.32), 860: (1092.0, 694.32), 870: (1128.0, 705.84), 880: (1154.0, 726.44),
+              890: (1178.0, 743.6), 900: (1198.0, 761.84)}
+
+@functools.lru_cache(maxsize=16)
+def extinction_coefficients(wavelengths):
+    """
+    Absorption of HbO and HbR per mm and M at each wavelength (molar extinction times ln(10),
+    as Homer's GetExtinctions, per mm), linearly interpolated between the tabulated wavelengths.
+    Computed once per wavelength set
+    :param wavelengths: wavelengths in nm, type: tuple
+    :return: coefficients (wavelengths x 2), pseudo-inverse (2 x wavelengths); read-only
+    """
+    table = np.array(sorted(EXTINCTION))
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    if np.any(wavelengths < table[0]) or np.any(wavelengths > table[-1]):
+        raise ValueError('Wavelengths should be within {}-{} nm'.format(table[0], table[-1]))
+    values = np.array([EXTINCTION[w] for w in table])
+    coef = np.stack([np.interp(wavelengths, table, values[:,i]) for i in range(2)], axis=1) * np.log(10) / 10
+    pinv = np.linalg.pinv(coef)
+    coef.flags.writeable = False
+    pinv.flags.writeable = False
+    return coef, pinv
+
+def intensity_to_od(d):
+    """
+    Optical density change relative to the mean intensity of each measurement
+    :param d: raw intensity, samples x measurements
+    :return: optical density, samples x measurements
+    """
+    d = np.abs(np.asarray(d, dtype=np.float64))
+    with np.errstate(divide='ignore'):
+        return -np.log(d / np.mean(d, axis=0))
+
+def channels(measList):
+    """
+    Source-detector pairs of a measurement list and the measurement of each pair per wavelength
+    :param measList: measurements x (source, detector, ..., wavelength index), 1-based as in .nirs files
+    :return: pairs (channels x 2), index (wavelengths x channels) into the measurements
+    """
+    measList = np.asarray(measList, dtype=np.int64)
+    wavelength = measList[:,-1] - 1
+    pairs, first, inverse = np.unique(measList[:,:2], axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first) # channels in the order of the measurement list
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    pairs = pairs[order]
+    index = np.full((wavelength.max()+1, pairs.shape[0]), -1)
+    index[wavelength, rank[inverse.ravel()]] = np.arange(measList.shape[0])
+    if np.any(index < 0):
+        raise ValueError('Every channel should be measured at every wavelength')
+    return pairs, index
+
+def od_to_conc(od, wavelengths, measList, distances, ppf=6):
+    """
+    Modified Beer-Lambert law for all channels at once: the optical densities of a channel at
+    all wavelengths are divided by distance x ppf and mapped to HbO and HbR by the pseudo-inverse
+    of the extinction coefficients
+    :param od: optical density, samples x measurements
+    :param wavelengths: wavelengths in nm
+    :param measList: measurement list, see channels
+    :param distances: source-detector distance of each channel in mm
+    :param ppf: partial pathlength factor, one value or one per wavelength
+    :return: HbO, HbR, HbT concentration changes in M, samples x 3 x channels
+    """
+    _, index = channels(measList)
+    _, pinv = extinction_coefficients(tuple(float(w) for w in wavelengths))
+    ppf = np.broadcast_to(np.asarray(ppf, dtype=np.float64), (index.shape[0],))
+    pathlength = ppf[:,None] * np.asarray(distances, dtype=np.float64)[None,:] # wavelengths x channels
+    od = np.asarray(od)[:, index] / pathlength # samples x wavelengths x channels
+    conc = np.empty((od.shape[0], 3, od.shape[2]))
+    np.matmul(pinv, od, out=conc[:,:2]) # one product for all samples and channels
+    np.add(conc[:,0], conc[:,1], out=conc[:,2])
+    return conc
+
+def raw_to_conc(d, SD, ppf=6):
+    """
+    Raw intensity to HbO, HbR, HbT concentration changes
+    :param d: raw intensity, samples x measurements
+    :param SD: probe description with Lambda, MeasList, SrcPos, DetPos and optionally SpatialUnit ('mm' or 'cm'), type: dict
+    :param ppf: partial pathlength factor, one value or one per wavelength
+    :return: concentration changes in M, samples x 3 x channels
+    """
+    pairs, _ = channels(SD['MeasList'])
+    src = np.atleast_2d(SD['SrcPos'])[pairs[:,0]-1]
+    det = np.atleast_2d(SD['DetPos'])[pairs[:,1]-1]
+    distances = np.linalg.norm(src - det, axis=1)
+    if str(SD.get('SpatialUnit', 'mm')).lower() == 'cm':
+        distances = distances * 10
+    logging.info("Converting {} channels at wavelengths {}".format(pairs.shape[0], np.ravel(SD['Lambda'])))
+    return od_to_conc(intensity_to_od(d), np.ravel(SD['Lambda']), SD['MeasList'], distances, ppf=ppf)
+
+def read_raw_nirs(filepath):
+    """
+    Reads the raw intensity, probe description and stims of a .nirs file
+    :param filepath: .nirs filepath
+    :return: d (samples x measurements), SD (dict), stims
+    """
+    if scipy.io.matlab.matfile_version(filepath, appendmat=False)[0] == 2: # v7.3 (HDF5)
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("h5py is required to read v7.3 .nirs files, install it with 'pip install h5py'")
+        with h5py.File(filepath, 'r') as f:
+            d = np.asarray(f['d'][()].T, dtype=np.float64)
+            stims = np.asarray(f['s'][()].T, dtype=np.int64)
+            SD = {key: f['SD'][key][()].T for key in ['Lambda', 'MeasList', 'SrcPos', 'DetPos']}
+            if 'SpatialUnit' in f['SD']:
+                SD['SpatialUnit'] = ''.join(map(chr, np.ravel(f['SD']['SpatialUnit'][()])))
+        return d, SD, stims
+    nirs = scipy.io.loadmat(filepath, variable_names=['d', 'SD', 's'], simplify_cells=True)
+    if 'd' not in nirs or 'SD' not in nirs:
+        raise ValueError('No raw intensity (d, SD) in {}'.format(filepath))
+    stims = np.asarray(nirs['s'], dtype=np.int64).reshape(np.shape(nirs['d'])[0], -1)
+    return np.asarray(nirs['d'], dtype=np.float64), nirs['SD'], stims
+
+def read_conc(filepath, ppf=6):
+    """
+    Reads a raw .nirs file and converts its intensity to concentration changes
+    :param filepath: .nirs filepath
+    :param ppf: partial pathlength factor, one value or one per wavelength
+    :return: data (samples x 3 x channels), stims
+    """
+    d, SD, stims = read_raw_nirs(filepath)
+    return raw_to_conc(d, SD, ppf=ppf), stims
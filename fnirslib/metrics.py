@@ -5,6 +5,9 @@ description: metrics for fnirs data
 
 import numpy as np
 import logging
+from . import connectivity
+from . import granger
+from .profiling import instrument
 
 class Metrics:
     """
@@ -12,7 +15,8 @@ class Metrics:
     1. mean activation
     2. peak activation
     3. functional connectivity
-    4. effective connectivity
+    4. dynamic functional connectivity
+    5. effective connectivity
     """
     def __init__(self, data, peakPadding=None):
         """
@@ -22,57 +26,84 @@ class Metrics:
         self.data = data
         self.peakPadding = peakPadding
 
+    @instrument
     def get_mean_activation(self):
         """
-        Get mean activation for each region
-        :return: mean activation for each region
+        Get mean activation for each region, missing (NaN) samples are ignored
+        :return: mean activation for each region (float64), NaN for regions without samples
         """
-        return np.mean(self.data, axis=0)
+        nan = np.isnan(self.data)
+        if not nan.any():
+            return np.mean(self.data, axis=0, dtype=np.float64) # float64 accumulation also for float32 data
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sum(self.data, axis=0, where=~nan, dtype=np.float64) / np.sum(~nan, axis=0)
 
+    @instrument
     def get_peak_activation(self, baseline=None):
         """
-        Get peak activation for each region
-        :param data: HbO, Hbr or HbT data
-        :param baseline: baseline to be subtracted from data
-        :param padding: padding to be considered surrounding the peak
-        :return: peak activation for each region
+        Get peak activation for each region, the data can have any number of
+        dimensions (e.g. samples x chromophores x channels), samples along the first axis.
+        Missing (NaN) samples are ignored, regions without samples give NaN
+        :param baseline: baseline to be subtracted from data, broadcast against the result
+        :return: peak activation for each region, data.shape[1:]
         """
-        # initialize array
-        peakActivation = np.zeros(self.data.shape[1])
-        # iterate over each column of data
-        for i in range(self.data.shape[1]):
-            maxIdx = np.argmax(self.data[:,i])
-            # check if padding overshoots the data at start or end
-            if maxIdx-self.peakPadding < 0:
-                logging.warning('Peak activation padding overshoots data at start')
-                peakActivation[i] = np.mean(self.data[0:maxIdx+self.peakPadding+1,i])
-            elif maxIdx+self.peakPadding+1 > self.data.shape[0]:
-                logging.warning('Peak activation padding overshoots data at end')
-                peakActivation[i] = np.mean(self.data[maxIdx-self.peakPadding:self.data.shape[0],i])
-            else:
-                # print(self.data[maxIdx-self.peakPadding:maxIdx+self.peakPadding+1,i])
-                peakActivation[i] = np.mean(self.data[maxIdx-self.peakPadding:maxIdx+self.peakPadding+1,i])
-            # subtract baseline if baseline is provided
-            if baseline is not None:
-                peakActivation[i] -= baseline[i]
+        n = self.data.shape[0]
+        nan = np.isnan(self.data)
+        hasNan = nan.any()
+        maxIdx = np.argmax(np.where(nan, -np.inf, self.data) if hasNan else self.data, axis=0)
+        # window around the peak, samples outside the data are masked
+        idx = maxIdx[None] + np.arange(-self.peakPadding, self.peakPadding+1).reshape((-1,)+(1,)*maxIdx.ndim)
+        valid = (idx >= 0) & (idx < n)
+        window = np.take_along_axis(self.data, idx.clip(0, n-1), axis=0)
+        if hasNan:
+            valid &= ~np.isnan(window)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            peakActivation = np.sum(window, axis=0, where=valid) / np.sum(valid, axis=0)
+        # report padding overshoots in aggregate, empty regions have no peak
+        found = ~nan.all(axis=0) if hasNan else True
+        self.overshoot = (int(np.count_nonzero((maxIdx-self.peakPadding < 0) & found)),
+                          int(np.count_nonzero((maxIdx+self.peakPadding+1 > n) & found)))
+        if any(self.overshoot):
+            logging.warning('Peak activation padding overshoots data at start for {} and at end for {} of {} columns'.format(
+                            self.overshoot[0], self.overshoot[1], maxIdx.size))
+        # subtract baseline if baseline is provided
+        if baseline is not None:
+            peakActivation = peakActivation - baseline
         return peakActivation
 
+    @instrument
     def get_functional_connectivity(self):
         """
         Get functional connectivity between regions
-        :return: correlation matrix, z-scores
+        data is regions x samples, or subjects x regions x samples; missing (NaN) regions
+        get NaN connectivity, samples missing in other regions are left out
+        :return: correlation matrix, z-scores; both with NaN diagonal
         """
-        corr = np.corrcoef(self.data)  # correlation matrix
-        zscores = np.arctanh(corr) #convert to tanh space
-        #set diagonal elements to NaN
-        for i in range(corr.shape[0]):
-            corr[i, i] = np.NaN 
-        return corr, zscores
+        return connectivity.functional_connectivity(np.swapaxes(self.data, -1, -2))
 
-    def get_effective_connectivity(self):
+    @instrument
+    def get_dynamic_connectivity(self, width, step=1):
         """
-        TIP: Use MATLAB MVGC toolbox to calculate the effective connectivity
-        Get effective connectivity between regions
-        :return: correlation matrix
+        Get time-resolved functional connectivity over sliding windows
+        data is regions x samples
+        :param width: window width in samples
+        :param step: step between windows in samples
+        :return: correlation matrices, z-scores; windows x regions x regions with NaN diagonal
         """
-        assert False, 'Not implemented: effective connectivity'
\ No newline at end of file
+        return connectivity.sliding_connectivity(self.data.T, width, step)
+
+    @instrument
+    def get_effective_connectivity(self, order=None, maxOrder=10, criterion='bic'):
+        """
+        Get effective connectivity between regions, conditional Granger causality
+        data is regions x samples, or subjects x regions x samples
+        :param order: VAR model order, selected by information criterion if None
+        :param maxOrder: largest model order considered for the selection
+        :param criterion: information criterion for the order selection, 'aic' or 'bic'
+        :return: Granger causality, p-values (gc[i, j] is from region j to region i), model order
+        """
+        data = np.swapaxes(self.data, -1, -2)
+        if order is None:
+            order = granger.select_order(data, maxOrder, criterion)
+        gc, pvalues = granger.granger_causality(data, order)
+        return gc, pvalues, order
@@ -4,14 +4,15 @@ description: methods for creating fnirs plots
 """
 
 import numpy as np
-from mne_connectivity.viz import plot_connectivity_circle
-import matplotlib.pyplot as plt
+from pathlib import Path
+from . import render
 
 class plotData(object):
     """
-    Plots the correlation matrix
+    Plots the correlation matrix, rendering goes through render.Renderer, so plots are
+    thread-safe and unchanged plots are not rendered again
     """
-    def __init__(self, data, labels, savedir, colormap='viridis', dpi=None, title=None, filename=None):
+    def __init__(self, data, labels, savedir, colormap='viridis', dpi=None, title=None, filename=None, positions=None):
         """
         Plots the correlation matrix
         :param data: correlation matrix
@@ -21,6 +22,8 @@ class plotData(object):
         :param dpi: dpi for the plot
         :param title: title of the plot
         :param filename: filename of the plot
+        :param positions: 2D positions of the regions for connectomes, of the channels for
+                          topographic maps, see topography.channel_positions and region_positions
         :return: None
         """
         self.data = data
@@ -30,55 +33,67 @@ class plotData(object):
         self.filename = filename
         self.colormap = colormap
         self.dpi = dpi
+        self.positions = positions
 
     def circularPlot(self):
         """
-        Plots the correlation circular plot
-        :return: None
+        Plots the correlation circular plot, see render.Renderer
+        :return: path of the plot
         """
-        fig = plt.figure(num=None, figsize=(8, 8), facecolor='white')
-        plot_connectivity_circle(self.data, self.labels, textcolor='black', colormap=self.colormap, 
-                                facecolor='white', vmax=1, vmin=0, linewidth=2.5, node_colors=['gray', 'silver'],                                
-                                title=self.title, fig=fig, show=False) 
-        plt.savefig(self.savedir +'circle_'+self.filename, dpi=self.dpi)
-        plt.cla() # clear the figure
-        fig.clf() # clear the figure
-        plt.close() # close the figure
+        return self._renderer().render('circle', self.data, self.labels, 'circle_'+self.filename, title=self.title)
 
     def matrixPlot(self):
         """
-        Plots the correlation matrix
-        :return: None
+        Plots the correlation matrix, see render.Renderer
+        :return: path of the plot
         """
-        plt.imshow(self.data, cmap=self.colormap)
-        plt.title(self.title)
-        plt.xticks(np.arange(0, len(self.labels)), self.labels, rotation=90)
-        plt.yticks(np.arange(0, len(self.labels)), self.labels)
-        plt.colorbar()
-        # set min and max values
-        plt.clim(0, 1)
-        plt.savefig(self.savedir +'matrix_'+self.filename, dpi=self.dpi)
-        plt.clf() # clear the figure
-        plt.close() # close the figure
-        plt.cla() # clear the figure
+        return self._renderer().render('matrix', self.data, self.labels, 'matrix_'+self.filename, title=self.title)
 
     def connectome(self):
         """
-        Plots brain connectome
-        :return: None
+        Plots brain connectome, regions at their positions, see render.Renderer
+        :return: path of the plot
         """
-        raise NotImplementedError
+        return self._renderer(fit=True).render('connectome', self.data, self.labels, 'connectome_'+self.filename,
+                                               title=self.title, positions=self._positions())
 
     def connectome_directed(self):
         """
-        Plots directed brain connectome
-        :return: None
+        Plots directed brain connectome, data[i, j] is the connection from region j to region i
+        (e.g. Granger causality), see render.Renderer
+        :return: path of the plot
         """
-        raise NotImplementedError
+        return self._renderer(fit=True).render('connectome_directed', self.data, self.labels, 'connectome_directed_'+self.filename,
+                                               title=self.title, positions=self._positions())
 
-    def topograph(self):
+    def topograph(self, workers=1):
         """
-        Plot brain topographic maps
-        :return: None
+        Plot brain topographic maps, data is one value per channel (or one map per row, e.g. per
+        sample, saved as <filename stem>_<row>), interpolated over the channel positions
+        :param workers: number of processes for several maps, see render.Renderer.render_batch
+        :return: path of the plot, list of paths for several maps
+        """
+        renderer = self._renderer(fit=True)
+        data = np.asarray(self.data)
+        if data.ndim == 1:
+            return renderer.render('topograph', data, self.labels, 'topo_'+self.filename, title=self.title,
+                                   positions=self._positions())
+        # the frames go in one batch, the manifest is written once for all of them
+        stem, suffix = Path(self.filename).stem, Path(self.filename).suffix
+        positions = self._positions()
+        jobs = [{'kind': 'topograph', 'data': values, 'labels': self.labels, 'title': self.title, 'positions': positions,
+                 'filename': 'topo_{}_{:06d}{}'.format(stem, i, suffix)} for i, values in enumerate(data)]
+        return renderer.render_batch(jobs, workers=workers)
+
+    def _positions(self):
+        assert self.positions is not None, 'Positions of the channels or regions are needed, see topography'
+        return self.positions
+
+    def _renderer(self, fit=False):
+        """
+        Renderer of the save directory and style, shared by all plotData objects
+        :param fit: fit the color scale to each plot instead of 0 to 1, type: bool
         """
-        raise NotImplementedError
+        if fit:
+            return render.renderer(str(self.savedir), colormap=self.colormap, dpi=self.dpi, vmin=None, vmax=None)
+        return render.renderer(str(self.savedir), colormap=self.colormap, dpi=self.dpi)
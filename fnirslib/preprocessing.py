@@ -0,0 +1,203 @@
+"""
+author: @nimrobotics
+description: signal preprocessing of fnirs data, filtering, motion artifact correction and detrending
+"""
+
+import numpy as np
+import scipy.signal
+import scipy.interpolate
+import functools
+import logging
+
+@functools.lru_cache(maxsize=64)
+def filter_sos(freq, band, order=3):
+    """
+    Butterworth filter coefficients, computed once per (freq, band, order)
+    :param freq: sampling frequency
+    :param band: (low, high) cutoff frequencies in Hz, None for no cutoff on that side
+    :param order: filter order
+    :return: second-order sections, shared by all callers, must not be modified
+    """
+    low, high = band
+    if low is not None and high is not None:
+        sos = scipy.signal.butter(order, [low, high], btype='bandpass', fs=freq, output='sos')
+    elif low is not None:
+        sos = scipy.signal.butter(order, low, btype='highpass', fs=freq, output='sos')
+    elif high is not None:
+        sos = scipy.signal.butter(order, high, btype='lowpass', fs=freq, output='sos')
+    else:
+        raise ValueError('Filter band should have a low or high cutoff')
+    return sos
+
+def bandpass(data, freq, band, order=3, out=None):
+    """
+    Zero-phase (forward-backward) filter of all channels and signal types in one call
+    :param data: data, samples along the first axis
+    :param freq: sampling frequency
+    :param band: (low, high) cutoff frequencies in Hz, None for no cutoff on that side
+    :param order: filter order
+    :param out: output array, may be data; the filter allocates its result, which is copied into out
+    :return: filtered data
+    """
+    filtered = scipy.signal.sosfiltfilt(filter_sos(freq, tuple(band), order), data, axis=0)
+    if out is None:
+        return filtered
+    out[...] = filtered
+    return out
+
+@functools.lru_cache(maxsize=16)
+def _detrend_projection(nSamples, order):
+    """
+    Polynomial design and its pseudo-inverse, shared by all channels
+    :return: design (samples x order+1), pseudo-inverse (order+1 x samples)
+    """
+    t = np.linspace(-1, 1, nSamples) # scaled time keeps the design well conditioned
+    design = np.vander(t, order+1)
+    pinv = np.linalg.pinv(design)
+    design.flags.writeable = False
+    pinv.flags.writeable = False
+    return design, pinv
+
+def polynomial_detrend(data, order=1, out=None):
+    """
+    Removes a least squares polynomial trend from every channel, one solve for all channels
+    :param data: data, samples along the first axis
+    :param order: polynomial order, 0 removes the mean, 1 a linear trend
+    :param out: output array, may be data
+    :return: detrended data
+    """
+    x = np.asarray(data, dtype=np.float64).reshape(data.shape[0], -1)
+    design, pinv = _detrend_projection(data.shape[0], order)
+    trend = design @ (pinv @ x)
+    if out is None:
+        out = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float32)) # solved in float64, stored as float32 for float32 data
+    np.subtract(x, trend, out=out.reshape(x.shape))
+    return out
+
+def moving_std(data, window):
+    """
+    Standard deviation over a centered moving window, from cumulative sums
+    :param data: data, samples along the first axis
+    :param window: window length in samples
+    :return: moving standard deviation, same shape as data
+    """
+    x = np.asarray(data, dtype=np.float64)
+    x = x - np.mean(x, axis=0) # keep the sums small
+    n = x.shape[0]
+    csum = np.zeros((n+1,)+x.shape[1:])
+    csq = np.zeros((n+1,)+x.shape[1:])
+    np.cumsum(x, axis=0, out=csum[1:])
+    np.cumsum(x*x, axis=0, out=csq[1:])
+    starts = np.clip(np.arange(n) - window//2, 0, n)
+    ends = np.clip(starts + window, 0, n)
+    count = (ends - starts).reshape((-1,)+(1,)*(x.ndim-1))
+    mean = (csum[ends] - csum[starts]) / count
+    var = (csq[ends] - csq[starts]) / count - mean*mean
+    return np.sqrt(np.maximum(var, 0))
+
+def detect_motion(data, freq, window=1.0, threshold=5.0):
+    """
+    Marks motion artifacts: samples where the moving standard deviation exceeds threshold
+    times its median over the channel
+    :param data: data, samples along the first axis
+    :param freq: sampling frequency
+    :param window: moving window in seconds
+    :param threshold: threshold relative to the median moving standard deviation
+    :return: boolean mask, same shape as data
+    """
+    std = moving_std(data, max(int(window*freq), 2))
+    return std > threshold*np.median(std, axis=0)
+
+def _segments(mask):
+    """
+    Start and end (exclusive) of the runs of True in a 1D mask
+    """
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def spline_correction(data, mask, freq, smoothing=0.01, out=None):
+    """
+    Motion artifact correction by spline interpolation (Scholkmann et al. 2010): a
+    smoothing spline fit to each artifact is subtracted from it, then all segments are
+    shifted to join continuously with the segment before. Only channels with artifacts
+    are touched
+    :param data: data, samples along the first axis
+    :param mask: motion artifact mask, see detect_motion
+    :param freq: sampling frequency
+    :param smoothing: spline smoothing, relative to the variance of the artifact
+    :param out: output array, may be data
+    :return: corrected data
+    """
+    if out is None:
+        out = np.array(data, dtype=np.float64)
+    elif out is not data:
+        out[...] = data
+    x = out.reshape(out.shape[0], -1)
+    mask = np.asarray(mask).reshape(x.shape)
+    overlap = max(int(freq), 1) # samples averaged to match the levels of adjacent segments
+    for column in np.flatnonzero(mask.any(axis=0)):
+        y = x[:,column]
+        starts, ends = _segments(mask[:,column])
+        for start, end in zip(starts, ends):
+            if end - start > 3: # a cubic spline needs 4 points
+                t = np.arange(end-start, dtype=np.float64)
+                segment = y[start:end]
+                spline = scipy.interpolate.UnivariateSpline(t, segment, k=3, s=smoothing*(end-start)*np.var(segment))
+                segment -= spline(t)
+        # shift every segment after the first to the level of the (already shifted) one before
+        bounds = np.unique(np.concatenate([[0], starts, ends, [y.shape[0]]]))
+        for prev, start, end in zip(bounds[:-2], bounds[1:-1], bounds[2:]):
+            y[start:end] += np.mean(y[max(start-overlap, prev):start]) - np.mean(y[start:min(start+overlap, end)])
+    return out
+
+def zscore(data, out=None):
+    """
+    Standardizes every channel to zero mean and unit variance
+    :param data: data, samples along the first axis
+    :param out: output array, may be data
+    :return: standardized data
+    """
+    mean = np.mean(data, axis=0, dtype=np.float64)
+    std = np.std(data, axis=0, dtype=np.float64)
+    if out is None:
+        out = np.empty(np.shape(data), dtype=np.result_type(np.asarray(data).dtype, np.float32)) # float32 data stay float32
+    np.subtract(data, mean, out=out)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(out, std, out=out)
+    return out
+
+STEPS = ['bandpass', 'motion', 'detrend', 'zscore']
+# motion correction, then remove slow drifts and the cardiac band; lower the high cutoff to
+# about 0.1 Hz to remove respiration and Mayer waves as well, e.g. for connectivity
+DEFAULT_STEPS = [('motion', {}), ('bandpass', {'band': (0.01, 0.5)}), ('detrend', {'order': 1})]
+
+def preprocess(data, freq, steps):
+    """
+    Applies a chain of preprocessing steps to all channels and signal types at once, in
+    a float64 working buffer updated in place (the band-pass filter result replaces it)
+    :param data: data, samples x ... (e.g. samples x 3 x channels)
+    :param freq: sampling frequency
+    :param steps: list of (step, parameters) applied in order, steps are
+                  ('bandpass', {'band': (low, high), 'order': 3}),
+                  ('motion', {'window': 1.0, 'threshold': 5.0, 'smoothing': 0.01}),
+                  ('detrend', {'order': 1}),
+                  ('zscore', {})
+    :return: preprocessed data
+    """
+    out = np.array(data, dtype=np.float64) # the only copy, the input is left untouched
+    for step, params in steps:
+        params = dict(params)
+        if step == 'bandpass':
+            out = bandpass(out, freq, params.pop('band'), **params) # rebound, not copied back
+        elif step == 'motion':
+            smoothing = params.pop('smoothing', 0.01)
+            mask = detect_motion(out, freq, **params)
+            logging.info('Motion artifacts in {:.2%} of the samples'.format(np.mean(mask)))
+            spline_correction(out, mask, freq, smoothing=smoothing, out=out)
+        elif step == 'detrend':
+            polynomial_detrend(out, out=out, **params)
+        elif step == 'zscore':
+            zscore(out, out=out)
+        else:
+            raise ValueError('Unknown preprocessing step {}, expected one of {}'.format(step, STEPS))
+    return out
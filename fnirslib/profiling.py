@@ -0,0 +1,168 @@
+"""
+author: @nimrobotics
+description: opt-in timing and memory instrumentation of the processing stages
+"""
+
+import numpy as np
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+_active = None # profiler recording the instrumented calls, None when disabled
+
+def instrument(fn):
+    """
+    Decorator recording the calls of a processing stage while a Profiler is active.
+    When disabled the only cost is one check of the active profiler
+    :param fn: function or method, the stage is named after its qualified name
+    :return: wrapped function
+    """
+    stage = fn.__qualname__
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return fn(*args, **kwargs)
+        return _active.call(stage, fn, args, kwargs)
+    return wrapper
+
+def _nbytes(values):
+    """
+    Total size of the arrays in values, looks into tuples and lists
+    """
+    if isinstance(values, np.ndarray):
+        return values.nbytes
+    if isinstance(values, (tuple, list)):
+        return sum(_nbytes(v) for v in values)
+    return 0
+
+class Profiler:
+    """
+    Records wall time, peak allocated memory (tracemalloc) and the size of the input and
+    output arrays of every instrumented call made while active, e.g.
+        with Profiler() as profiler:
+            ... # processing
+        print(profiler.table())
+        profiler.save_trace('trace.json') # open in chrome://tracing or Perfetto
+    The peak of a call includes the calls it makes, tracing memory slows down allocations
+    and can be turned off
+    """
+    def __init__(self, memory=True):
+        """
+        :param memory: record the peak allocated memory with tracemalloc, type: bool
+        """
+        self.memory = memory
+        self.events = [] # one dict per call
+        self._stack = [] # open calls: [start memory, running peak]
+        self._previous = None
+        self._startedTracing = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+
+    def call(self, stage, fn, args, kwargs):
+        """
+        Run and record one call of an instrumented stage
+        :param stage: stage name
+        :param fn: function
+        :param args: positional arguments
+        :param kwargs: keyword arguments
+        :return: output of fn
+        """
+        memory = self.memory and tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self._stack) > 0: # keep the peak of the caller before resetting it
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            self._stack.append([current, current])
+        timestamp = time.time()
+        start = time.perf_counter()
+        try:
+            output = fn(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            if memory:
+                startMemory, peak = self._stack.pop()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if len(self._stack) > 0:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+        event = {'stage': stage, 'timestamp': timestamp, 'duration': duration,
+                 'peakBytes': peak-startMemory if memory else None,
+                 'inputBytes': _nbytes(list(args)+list(kwargs.values())), 'outputBytes': _nbytes(output),
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        with self._lock:
+            self.events.append(event)
+        return output
+
+    def merge(self, events):
+        """
+        Add the events recorded by another profiler, e.g. in a worker process
+        :param events: list of events, see Profiler.events
+        :return: None
+        """
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self):
+        """
+        Statistics of each stage over all its calls
+        :return: dict of stage -> calls, total, mean and max time (s), max peak memory,
+                 total input and output array bytes; ordered by total time
+        """
+        stages = {}
+        for event in self.events:
+            s = stages.setdefault(event['stage'], {'calls': 0, 'total': 0.0, 'max': 0.0, 'peakBytes': None,
+                                                   'inputBytes': 0, 'outputBytes': 0})
+            s['calls'] += 1
+            s['total'] += event['duration']
+            s['max'] = max(s['max'], event['duration'])
+            if event['peakBytes'] is not None:
+                s['peakBytes'] = max(s['peakBytes'] or 0, event['peakBytes'])
+            s['inputBytes'] += event['inputBytes']
+            s['outputBytes'] += event['outputBytes']
+        for s in stages.values():
+            s['mean'] = s['total']/s['calls']
+        return dict(sorted(stages.items(), key=lambda item: -item[1]['total']))
+
+    def table(self):
+        """
+        Summary as a text table
+        :return: str
+        """
+        rows = ['{:<40} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+                'stage', 'calls', 'total s', 'mean ms', 'max ms', 'peak MB', 'in MB', 'out MB')]
+        for stage, s in self.summary().items():
+            rows.append('{:<40} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10} {:>10.1f} {:>10.1f}'.format(
+                stage, s['calls'], s['total'], 1e3*s['mean'], 1e3*s['max'],
+                '-' if s['peakBytes'] is None else '{:.1f}'.format(s['peakBytes']/2**20),
+                s['inputBytes']/2**20, s['outputBytes']/2**20))
+        return '\n'.join(rows)
+
+    def save_trace(self, filepath):
+        """
+        Save the calls in the Chrome trace event format
+        :param filepath: json filepath
+        :return: None
+        """
+        events = [{'name': e['stage'], 'ph': 'X', 'ts': e['timestamp']*1e6, 'dur': e['duration']*1e6,
+                   'pid': e['pid'], 'tid': e['tid'],
+                   'args': {'peakBytes': e['peakBytes'], 'inputBytes': e['inputBytes'], 'outputBytes': e['outputBytes']}}
+                  for e in self.events]
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,134 @@
+"""
+author: @nimrobotics
+description: per-channel signal quality (scalp coupling index, coefficient of variation,
+             saturation, missing samples) and the channel mask built from it
+"""
+
+import numpy as np
+import logging
+from . import preprocessing
+from . import mbll
+
+CARDIAC_BAND = (0.5, 2.5) # Hz, heart rate of about 30 to 150 bpm
+# thresholds of a good channel, see channel_mask
+THRESHOLDS = {'sciMin': 0.75, 'cvMax': 15.0, 'saturationMax': 0.05, 'nanMax': 0.2}
+
+def raw_by_channel(d, measList):
+    """
+    Raw intensity arranged per channel, in the channel order of the concentration data
+    :param d: raw intensity, samples x measurements
+    :param measList: measurement list, see mbll.channels
+    :return: raw intensity, samples x wavelengths x channels
+    """
+    _, index = mbll.channels(measList)
+    return np.asarray(d)[:, index]
+
+def _finite(x):
+    """
+    Copy of x with NaN and inf set to 0 and the mask of the finite values
+    """
+    finite = np.isfinite(x)
+    return np.where(finite, x, 0.0), finite
+
+def scalp_coupling_index(raw, freq, band=CARDIAC_BAND):
+    """
+    Scalp coupling index (Pollonini et al. 2014): correlation of the cardiac pulsation
+    at the first two wavelengths of each channel. All channels are filtered and correlated at once
+    :param raw: raw intensity or optical density, samples x wavelengths x channels
+    :param freq: sampling frequency
+    :param band: cardiac band in Hz, the high cutoff is lowered below the Nyquist frequency
+    :return: SCI per channel, NaN for channels without pulsation
+    """
+    low, high = band
+    high = min(high, 0.45*freq) if high is not None else None
+    x, _ = _finite(np.asarray(raw, dtype=np.float64)[:, :2])
+    x = preprocessing.bandpass(x, freq, (low, high))
+    x -= np.mean(x, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x /= np.linalg.norm(x, axis=0)
+    return np.clip(np.sum(x[:,0]*x[:,1], axis=0), -1, 1)
+
+def channel_metrics(data, freq=None, raw=None):
+    """
+    Quality metrics of all channels in one vectorized pass over the data
+    :param data: HbO, HbR, HbT, samples x 3 x channels
+    :param freq: sampling frequency, needed for the scalp coupling index
+    :param raw: raw intensity, samples x wavelengths x channels (see raw_by_channel), the
+                coefficient of variation and scalp coupling index need it and are NaN without
+    :return: dict of per-channel 'nan' (fraction of missing samples), 'flat' (constant signal),
+             'saturation' (fraction of samples clipped at the extreme of the channel),
+             'cv' (coefficient of variation of the intensity in %, largest over wavelengths), 'sci'
+    """
+    x = np.asarray(data, dtype=np.float64)
+    nChannels = x.shape[-1]
+    x, finite = _finite(x[:, :2]) # HbT is the sum of the two
+    count = np.sum(finite, axis=0)
+    metrics = {'nan': 1 - np.min(count, axis=0)/x.shape[0]}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(x, axis=0)/count
+        std = np.sqrt(np.sum(np.where(finite, (x-mean)**2, 0), axis=0)/count)
+    metrics['flat'] = ~np.any(std > 1e-12*np.maximum(np.abs(mean), 1e-300), axis=0)
+    signal = x if raw is None else np.asarray(raw, dtype=np.float64)
+    signal, finite = _finite(signal) if raw is not None else (x, finite)
+    # a clipped signal stays at its extreme value, a continuous signal reaches it once
+    top = np.sum(finite & (signal == np.max(np.where(finite, signal, -np.inf), axis=0)), axis=0)
+    bottom = np.sum(finite & (signal == np.min(np.where(finite, signal, np.inf), axis=0)), axis=0)
+    metrics['saturation'] = np.max(np.maximum(top, bottom)/signal.shape[0], axis=0)
+    metrics['cv'] = np.full(nChannels, np.nan)
+    metrics['sci'] = np.full(nChannels, np.nan)
+    if raw is not None:
+        count = np.sum(finite, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rawMean = np.sum(signal, axis=0)/count
+            rawStd = np.sqrt(np.sum(np.where(finite, (signal-rawMean)**2, 0), axis=0)/count)
+            metrics['cv'] = np.max(100*rawStd/np.abs(rawMean), axis=0)
+        if freq is not None:
+            metrics['sci'] = scalp_coupling_index(signal, freq)
+    return metrics
+
+def channel_mask(metrics, sciMin=THRESHOLDS['sciMin'], cvMax=THRESHOLDS['cvMax'],
+                 saturationMax=THRESHOLDS['saturationMax'], nanMax=THRESHOLDS['nanMax']):
+    """
+    Good channels from their quality metrics, metrics that are NaN (not computed) are not used
+    :param metrics: quality metrics, see channel_metrics
+    :param sciMin: lowest scalp coupling index
+    :param cvMax: largest coefficient of variation in %
+    :param saturationMax: largest fraction of clipped samples
+    :param nanMax: largest fraction of missing samples
+    :return: boolean mask, True for good channels
+    """
+    with np.errstate(invalid='ignore'):
+        good = (metrics['nan'] <= nanMax) & ~metrics['flat'] & (metrics['saturation'] <= saturationMax)
+        good &= np.isnan(metrics['cv']) | (metrics['cv'] <= cvMax)
+        good &= np.isnan(metrics['sci']) | (metrics['sci'] >= sciMin)
+    return good
+
+def assess(data, freq=None, raw=None, **thresholds):
+    """
+    Quality metrics and channel mask
+    :param data: HbO, HbR, HbT, samples x 3 x channels
+    :param freq: sampling frequency
+    :param raw: raw intensity, samples x wavelengths x channels, optional
+    :param thresholds: thresholds of channel_mask
+    :return: metrics, mask
+    """
+    metrics = channel_metrics(data, freq=freq, raw=raw)
+    mask = channel_mask(metrics, **thresholds)
+    if not np.all(mask):
+        logging.warning('Rejected {} of {} channels: {}'.format(np.count_nonzero(~mask), mask.shape[0],
+                                                                np.flatnonzero(~mask).tolist()))
+    return metrics, mask
+
+def mask_channels(data, mask):
+    """
+    Sets the channels rejected by the mask to NaN, channels along the last axis
+    :param data: data
+    :param mask: boolean mask, True for good channels
+    :return: masked copy of the data (float32 data stay float32), the data itself if all channels are good
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.all():
+        return data
+    out = np.array(data, dtype=np.result_type(data.dtype, np.float32))
+    out[..., ~mask] = np.nan
+    return out
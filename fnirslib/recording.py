@@ -0,0 +1,127 @@
+"""
+author: @nimrobotics
+description: load-once container for a fnirs recording shared across conditions
+"""
+
+import numpy as np
+import logging
+from pathlib import Path
+from .fnirslib import Fnirslib, read_nirs, storage
+from .snirf import read_snirf
+from .mbll import read_conc, read_raw_nirs
+from . import quality
+
+class Recording:
+    """
+    A fnirs recording that is parsed only once. The data and stims are held
+    read-only and shared by all the per-stimulus views handed out by view()
+    """
+    def __init__(self, filepath, sex='NA', mmap=False, cacheDir=None, cache=None, raw=False, ppf=6, dtype=None):
+        """
+        :param filepath: .nirs or .snirf filepath
+        :param sex: sex of the participant, M or F, type: str
+        :param mmap: memory-map the data of .nirs files instead of reading it into memory, see fnirslib.read_nirs, type: bool
+        :param cacheDir: directory for the memory-mappable copy of the data, see fnirslib.read_nirs
+        :param cache: on-disk cache of intermediate results, shared by the views, see cache.Cache, type: Cache
+        :param raw: convert the raw intensity of a .nirs file instead of reading procResult.dc, see Fnirslib.load_raw_nirs, type: bool
+        :param ppf: partial pathlength factor for raw files
+        :param dtype: storage dtype of the signals, e.g. np.float32, stims are then stored as int8, see fnirslib.storage. None keeps the dtypes of the file
+        """
+        self.filepath = filepath
+        self.sex = sex
+        self.mmap = mmap
+        self.cacheDir = cacheDir
+        self.cache = cache
+        self.raw = raw
+        self.ppf = ppf
+        self.dtype = dtype
+        self._data = None
+        self._stims = None
+        self.quality = None # channel quality metrics, see channel_quality
+        self.channelMask = None
+
+    def load(self):
+        """
+        Parse the file on first call, later calls return the cached arrays
+        :return: data, stims (read-only)
+        """
+        if self._data is None:
+            if self.raw:
+                stage, params, read = 'load_raw_nirs', {'ppf': np.ravel(self.ppf).tolist()}, lambda: read_conc(self.filepath, ppf=self.ppf)
+            elif Path(self.filepath).suffix.lower() == '.snirf':
+                stage, params, read = 'load_snirf', {'start': 0, 'stop': None, 'channels': None}, lambda: read_snirf(self.filepath)
+            else:
+                stage, params, read = 'load_nirs', {}, lambda: read_nirs(self.filepath, mmap=self.mmap, cacheDir=self.cacheDir)
+            if self.cache is not None and (self.raw or not self.mmap): # same entries as the Fnirslib loaders
+                data, stims = self.cache.memoize(stage, [self.filepath], params, read)
+            else:
+                data, stims = read()
+            converted = storage(data, stims, dtype=self.dtype) # converted once, shared by the views
+            if self.cache is not None and (self.raw or not self.mmap): # keyed from the loaded arrays
+                converted = self.cache.derive('storage', [data, stims], {'dtype': str(self.dtype)}, converted)
+            data, stims = converted
+            data.flags.writeable = False # shared between views, must not be modified in place
+            stims.flags.writeable = False
+            self._data, self._stims = data, stims
+        else:
+            logging.info("Reusing loaded data from {}".format(self.filepath))
+        return self._data, self._stims
+
+    @property
+    def data(self):
+        """
+        HbO, HbR, HbT values, samples x 3 x channels
+        """
+        return self.load()[0]
+
+    @property
+    def stims(self):
+        """
+        Stimulus data, samples x stimulus columns
+        """
+        return self.load()[1]
+
+    @property
+    def loaded(self):
+        """
+        True if the file has already been parsed
+        """
+        return self._data is not None
+
+    def channel_quality(self, freq=None, **thresholds):
+        """
+        Quality metrics of all channels and the channel mask, computed once per recording and
+        handed to every view. The intensity of raw recordings is used for the coefficient of
+        variation and the scalp coupling index, see quality.assess
+        :param freq: sampling frequency, needed for the scalp coupling index
+        :param thresholds: sciMin, cvMax, saturationMax, nanMax, see quality.channel_mask
+        :return: quality metrics, channel mask
+        """
+        if self.channelMask is None:
+            raw = None
+            if self.raw:
+                d, SD, _ = read_raw_nirs(self.filepath)
+                raw = quality.raw_by_channel(d, SD['MeasList'])
+            self.quality, self.channelMask = quality.assess(self.load()[0], freq=freq, raw=raw, **thresholds)
+        return self.quality, self.channelMask
+
+    def view(self, regions, stimNumber, condition, paired=True, regionWeights=None):
+        """
+        Get a Fnirslib object for one stimulus condition, sharing this recording's data
+        :param regions: brain regions, type: list of lists
+        :param stimNumber: stimulus number/condition, type: int
+        :param condition: condition, type: str
+        :param paired: True if each trial has start and end stim, type: bool
+        :param regionWeights: weight of each channel within its region, see Fnirslib, type: list of lists
+        :return: Fnirslib object, with the channel mask of the recording if channel_quality was called
+        """
+        return Fnirslib(self.filepath, regions, stimNumber, condition, sex=self.sex, paired=paired, recording=self,
+                        regionWeights=regionWeights, cache=self.cache, channelMask=self.channelMask)
+
+    def release(self):
+        """
+        Drop the cached arrays, next load() parses the file again
+        :return: None
+        """
+        self._data = None
+        self._stims = None
@@ -0,0 +1,308 @@
+"""
+author: @nimrobotics
+description: figure rendering with the object-oriented Agg API, figures are reused as templates
+             across calls, unchanged figures are skipped and batches are rendered over a process pool
+"""
+
+import numpy as np
+import functools
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.patches import FancyArrowPatch
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from mne_connectivity.viz import plot_connectivity_circle
+from . import topography
+from .cache import _hash
+
+KINDS = ['matrix', 'circle', 'topograph', 'connectome', 'connectome_directed']
+FIGSIZE = {'matrix': (6.4, 4.8), 'circle': (8, 8), 'topograph': (6.4, 4.8), 'connectome': (6.4, 4.8),
+           'connectome_directed': (6.4, 4.8)}
+MANIFEST = '.render.json' # key of every rendered file of a directory
+
+class Renderer:
+    """
+    Renders connectivity matrices into a directory without pyplot, each renderer owns its
+    figures so renderers can be used from several threads. The figure of a matrix plot is
+    built once per set of labels and later calls only replace the image data. A figure is
+    not rendered again when its matrix, labels, title and style are the same as for the
+    file on disk, e.g.
+        renderer = Renderer('./plots', colormap='jet', dpi=300)
+        renderer.render('matrix', corr, labels, 'matrix_FC.png', title='FC')
+        renderer.render_batch([{'kind': 'circle', 'data': corr, 'labels': labels, 'filename': 'circle_FC.png'}], workers=4)
+    """
+    def __init__(self, directory, colormap='viridis', dpi=None, vmin=0, vmax=1, resolution=64, manifest=True):
+        """
+        :param directory: output directory
+        :param colormap: colormap of the plots
+        :param dpi: resolution of the saved figures, None for the matplotlib default
+        :param vmin: lower limit of the color scale, None to fit each figure
+        :param vmax: upper limit of the color scale, None to fit each figure
+        :param resolution: pixels along the longer side of topographic maps, see topography.interpolation_matrix
+        :param manifest: keep the keys of the rendered files in the directory to skip unchanged figures, type: bool
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.style = {'colormap': colormap, 'dpi': dpi, 'vmin': vmin, 'vmax': vmax, 'resolution': resolution}
+        self.manifest = manifest
+        self.rendered = 0
+        self.skipped = 0
+        self._templates = {} # (kind, labels) -> figure and artists
+        self._lock = threading.Lock()
+        self._keys = {}
+        if manifest and (self.directory/MANIFEST).exists():
+            with open(self.directory/MANIFEST) as f:
+                self._keys = json.load(f)
+
+    def key(self, kind, data, labels, title=None, positions=None):
+        """
+        Hash of everything that goes into a figure
+        :return: hex digest
+        """
+        arr = np.ascontiguousarray(data)
+        return _hash(kind, json.dumps(self.style, sort_keys=True), list(labels), title,
+                     None if positions is None else np.asarray(positions, dtype=np.float64).tolist(),
+                     arr.dtype.str, arr.shape, arr.data if arr.size > 0 else b'')
+
+    def unchanged(self, filename, key):
+        """
+        True if the file was rendered from the same key and still exists
+        """
+        return self._keys.get(filename) == key and (self.directory/filename).exists()
+
+    def render(self, kind, data, labels, filename, title=None, positions=None, force=False):
+        """
+        Render one figure, skipped if the file is up to date
+        :param kind: 'matrix', 'circle', 'connectome', 'connectome_directed' or 'topograph'
+        :param data: connectivity matrix (regions x regions, data[i, j] is from j to i for
+                     'connectome_directed'), or values per channel for 'topograph'
+        :param labels: labels of the regions or channels
+        :param filename: filename in the directory, the extension sets the format
+        :param title: title of the figure
+        :param positions: 2D positions of the regions (connectome) or channels (topograph), see topography
+        :param force: render even if the file is up to date, type: bool
+        :return: path of the figure
+        """
+        key = self.key(kind, data, labels, title, positions)
+        with self._lock:
+            if not force and self.unchanged(filename, key):
+                self.skipped += 1
+                return self.directory/filename
+            self._draw(kind, data, labels, title, positions, self.directory/filename)
+            self.rendered += 1
+            self._keys[filename] = key
+            if self.manifest:
+                self._save_manifest()
+        return self.directory/filename
+
+    def render_batch(self, jobs, workers=None):
+        """
+        Render many figures over a process pool, unchanged figures are skipped before
+        anything is sent to the workers and each worker reuses its figure templates
+        :param jobs: dicts with kind, data, labels, filename and optionally title and positions, type: list
+        :param workers: number of processes, None for os.cpu_count(), 1 renders in the current process
+        :return: paths of the figures, in the order of jobs
+        """
+        pending = []
+        with self._lock:
+            for job in jobs:
+                key = self.key(job['kind'], job['data'], job['labels'], job.get('title'), job.get('positions'))
+                if self.unchanged(job['filename'], key):
+                    self.skipped += 1
+                else:
+                    pending.append((job, key))
+        if len(pending) > 0:
+            logging.info("Rendering {} of {} figures with {} workers".format(len(pending), len(jobs), workers))
+            render = functools.partial(_render_job, directory=str(self.directory), style=self.style)
+            if workers == 1:
+                list(map(render, [job for job, _ in pending]))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(render, [job for job, _ in pending]))
+            with self._lock:
+                self.rendered += len(pending)
+                self._keys.update({job['filename']: key for job, key in pending})
+                if self.manifest:
+                    self._save_manifest()
+        return [self.directory/job['filename'] for job in jobs]
+
+    def _save_manifest(self):
+        path = self.directory/MANIFEST
+        tmp = path.with_name(path.name+'.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self._keys, f)
+        os.replace(tmp, path)
+
+    def _draw(self, kind, data, labels, title, positions, path):
+        if kind == 'matrix':
+            figure = self._matrix(data, labels, title)
+        elif kind == 'circle':
+            figure = self._circle(data, labels, title)
+        elif kind == 'topograph':
+            figure = self._topograph(data, labels, title, positions)
+        elif kind in ['connectome', 'connectome_directed']:
+            figure = self._connectome(data, labels, title, positions, directed=kind == 'connectome_directed')
+        else:
+            raise ValueError('Unknown plot {}, expected one of {}'.format(kind, KINDS))
+        figure.savefig(path, dpi=self.style['dpi'] if self.style['dpi'] is not None else 'figure')
+
+    def _matrix(self, data, labels, title):
+        """
+        Matrix plot, the figure, axes, ticks and colorbar are built once per set of labels
+        """
+        template = self._templates.get(('matrix', tuple(labels)))
+        if template is None:
+            figure = Figure(figsize=FIGSIZE['matrix'])
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+            image = ax.imshow(data, cmap=self.style['colormap'], vmin=self.style['vmin'], vmax=self.style['vmax'])
+            ax.set_xticks(np.arange(0, len(labels)), labels, rotation=90)
+            ax.set_yticks(np.arange(0, len(labels)), labels)
+            figure.colorbar(image, ax=ax)
+            template = self._templates[('matrix', tuple(labels))] = (figure, ax, image)
+        figure, ax, image = template
+        image.set_data(data)
+        ax.set_title(title if title is not None else '')
+        return figure
+
+    def _circle(self, data, labels, title):
+        """
+        Circular plot, the lines change with every matrix so only the figure is reused
+        """
+        figure = self._templates.get(('circle', None))
+        if figure is None:
+            figure = self._templates[('circle', None)] = Figure(figsize=FIGSIZE['circle'], facecolor='white', layout='constrained')
+            FigureCanvasAgg(figure)
+        figure.clear()
+        ax = figure.add_subplot(polar=True, facecolor='white')
+        plot_connectivity_circle(data, labels, textcolor='black', colormap=self.style['colormap'],
+                                 facecolor='white', vmax=self.style['vmax'], vmin=self.style['vmin'], linewidth=2.5,
+                                 node_colors=['gray', 'silver'], title=title, ax=ax, interactive=False, show=False)
+        return figure
+
+    def _limits(self, values):
+        """
+        Color scale of the style, or fit to the finite values: from 0 for non-negative
+        values (e.g. Granger causality), symmetric around 0 otherwise
+        """
+        vmin, vmax = self.style['vmin'], self.style['vmax']
+        if vmin is None or vmax is None:
+            finite = np.asarray(values)[np.isfinite(values)]
+            bound = np.max(np.abs(finite)) if finite.size > 0 else 1.0
+            bound = bound if bound > 0 else 1.0
+            low = 0 if finite.size > 0 and np.min(finite) >= 0 else -bound
+            vmin, vmax = (low if vmin is None else vmin), (bound if vmax is None else vmax)
+        return vmin, vmax
+
+    def _topograph(self, data, labels, title, positions):
+        """
+        Topographic map, the interpolation matrix is computed once per montage (see
+        topography.interpolate) and the figure once per montage and labels, so each map costs
+        one sparse matrix-vector product and a redraw of the image
+        """
+        assert positions is not None, 'Channel positions are needed for a topographic map'
+        positions = np.asarray(positions, dtype=np.float64)
+        image = topography.interpolate(data, positions, self.style['resolution'])
+        templateKey = ('topograph', tuple(labels), positions.tobytes())
+        template = self._templates.get(templateKey)
+        if template is None:
+            figure = Figure(figsize=FIGSIZE['topograph'])
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+            extent = topography.interpolation_matrix(positions, self.style['resolution'])[3]
+            artist = ax.imshow(image, cmap=self.style['colormap'], origin='lower', extent=extent, interpolation='bilinear')
+            ax.scatter(positions[:,0], positions[:,1], s=8, c='black')
+            for label, (x, y) in zip(labels, positions):
+                ax.annotate(str(label), (x, y), xytext=(2, 2), textcoords='offset points', fontsize=6)
+            ax.set_axis_off()
+            ax.set_aspect('equal')
+            figure.colorbar(artist, ax=ax)
+            template = self._templates[templateKey] = (figure, ax, artist)
+        figure, ax, artist = template
+        artist.set_data(image)
+        artist.set_clim(*self._limits(data))
+        ax.set_title(title if title is not None else '')
+        return figure
+
+    def _connectome(self, data, labels, title, positions, directed=False):
+        """
+        Connectome, regions at their positions and an edge (arrow from j to i if directed) for
+        every finite, non-zero connection. The figure, nodes and labels are built once per layout
+        """
+        assert positions is not None, 'Region positions are needed for a connectome'
+        positions = np.asarray(positions, dtype=np.float64)
+        data = np.asarray(data, dtype=np.float64)
+        templateKey = ('connectome', tuple(labels), positions.tobytes())
+        template = self._templates.get(templateKey)
+        if template is None:
+            figure = Figure(figsize=FIGSIZE['connectome'])
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+            lines = ax.add_collection(LineCollection([], cmap=self.style['colormap'], zorder=1))
+            ax.scatter(positions[:,0], positions[:,1], s=120, c='gray', edgecolors='black', zorder=2)
+            for label, (x, y) in zip(labels, positions):
+                ax.annotate(str(label), (x, y), xytext=(6, 6), textcoords='offset points', fontsize=8)
+            margin = 0.1*np.max(np.ptp(positions, axis=0))
+            ax.set_xlim(positions[:,0].min()-margin, positions[:,0].max()+margin)
+            ax.set_ylim(positions[:,1].min()-margin, positions[:,1].max()+margin)
+            ax.set_aspect('equal')
+            ax.set_axis_off()
+            mappable = ScalarMappable(cmap=self.style['colormap'])
+            figure.colorbar(mappable, ax=ax)
+            template = self._templates[templateKey] = (figure, ax, lines, mappable, [])
+        figure, ax, lines, mappable, arrows = template
+        for arrow in arrows:
+            arrow.remove()
+        arrows.clear()
+        if directed:
+            target, source = np.nonzero(np.isfinite(data) & (data != 0) & ~np.eye(data.shape[0], dtype=bool))
+        else:
+            target, source = np.triu_indices(data.shape[0], 1)
+            keep = np.isfinite(data[target, source]) & (data[target, source] != 0)
+            target, source = target[keep], source[keep]
+        weights = data[target, source]
+        vmin, vmax = self._limits(weights)
+        norm = Normalize(vmin, vmax)
+        mappable.set_norm(norm)
+        scale = np.abs(weights) / max(np.max(np.abs(weights)), 1e-300) if weights.size > 0 else weights
+        if directed:
+            lines.set_segments([])
+            cmap = mappable.get_cmap()
+            for j, i, w, width in zip(source, target, weights, scale):
+                arrows.append(ax.add_patch(FancyArrowPatch(positions[j], positions[i], arrowstyle='-|>', mutation_scale=12,
+                                                           connectionstyle='arc3,rad=0.15', color=cmap(norm(w)),
+                                                           linewidth=0.5+2.5*width, shrinkA=8, shrinkB=8, zorder=1)))
+        else:
+            lines.set_segments(np.stack([positions[source], positions[target]], axis=1))
+            lines.set_array(weights)
+            lines.set_norm(norm)
+            lines.set_linewidths(0.5+2.5*scale)
+        ax.set_title(title if title is not None else '')
+        return figure
+
+@functools.lru_cache(maxsize=16)
+def renderer(directory, colormap='viridis', dpi=None, vmin=0, vmax=1, resolution=64):
+    """
+    Shared renderer per directory and style, keeps the figure templates of a process alive between calls
+    :return: Renderer
+    """
+    return Renderer(directory, colormap=colormap, dpi=dpi, vmin=vmin, vmax=vmax, resolution=resolution)
+
+def _render_job(job, directory, style):
+    """
+    Render one job in a worker of the process pool, the keys are kept by the calling renderer
+    """
+    worker = _worker_renderer(directory, style['colormap'], style['dpi'], style['vmin'], style['vmax'], style['resolution'])
+    worker.render(job['kind'], job['data'], job['labels'], job['filename'], title=job.get('title'),
+                  positions=job.get('positions'), force=True)
+
+@functools.lru_cache(maxsize=16)
+def _worker_renderer(directory, colormap, dpi, vmin, vmax, resolution):
+    return Renderer(directory, colormap=colormap, dpi=dpi, vmin=vmin, vmax=vmax, resolution=resolution, manifest=False)
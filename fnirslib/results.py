@@ -0,0 +1,192 @@
+"""
+author: @nimrobotics
+description: columnar, append-efficient store of per-subject results
+"""
+
+import numpy as np
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+
+META = ['ID', 'sex', 'condition']
+
+class ResultStore:
+    """
+    Collects one row of values per subject and condition for each feature (e.g. peak
+    activation per channel). Rows are written into preallocated chunks, so an append
+    costs O(columns). With a directory, rows are flushed every flushEvery rows to part
+    files (.npz, or .parquet if pyarrow is installed) so a crash only loses the rows
+    since the last flush. Appends are thread safe; parallel processes writing to the
+    same directory need a distinct prefix each
+    """
+    def __init__(self, columns, directory=None, flushEvery=1000, chunkSize=256, prefix='', format='npz'):
+        """
+        :param columns: column labels of each feature, type: dict of lists
+        :param directory: directory for the part files, rows are only kept in memory if None
+        :param flushEvery: number of rows of a feature kept in memory before they are flushed
+        :param chunkSize: number of rows allocated at a time
+        :param prefix: prefix of the part files written by this store, type: str
+        :param format: 'npz' or 'parquet', type: str
+        """
+        assert all('-' not in feature for feature in columns), 'Feature names should not contain -'
+        if format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("pyarrow is required to write parquet files, install it with 'pip install pyarrow'")
+        elif format != 'npz':
+            raise ValueError('Unknown format {}'.format(format))
+        self.columns = {feature: list(labels) for feature, labels in columns.items()}
+        self.directory = None if directory is None else Path(directory)
+        self.flushEvery = flushEvery
+        self.chunkSize = chunkSize
+        self.prefix = prefix
+        self.format = format
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._parts = 0 # continue the numbering of an earlier run with the same prefix
+        if self.directory is not None:
+            pattern = re.compile(r'[^-]+-{}(\d{{6}})\.{}$'.format(re.escape(prefix), format))
+            parts = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.directory)) if m is not None]
+            self._parts = max(parts)+1 if len(parts) > 0 else 0
+        self._chunks = {feature: [] for feature in columns} # filled chunks
+        self._current = {feature: None for feature in columns} # chunk being filled
+        self._fill = {feature: 0 for feature in columns}
+        self._meta = {feature: {key: [] for key in META} for feature in columns}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def append(self, feature, values, ID, sex, condition):
+        """
+        Append a row
+        :param feature: feature name
+        :param values: row values, one per column of the feature
+        :param ID: subject ID
+        :param sex: sex of the participant
+        :param condition: condition label
+        :return: None
+        """
+        values = np.ravel(values)
+        if values.shape[0] != len(self.columns[feature]):
+            raise ValueError("Expected {} values for feature '{}', got {}".format(len(self.columns[feature]), feature, values.shape[0]))
+        with self._lock:
+            if self._current[feature] is None:
+                self._current[feature] = np.empty((self.chunkSize, values.shape[0]))
+            self._current[feature][self._fill[feature]] = values
+            self._fill[feature] += 1
+            for key, value in zip(META, [ID, sex, condition]):
+                self._meta[feature][key].append(str(value))
+            if self._fill[feature] == self.chunkSize:
+                self._chunks[feature].append(self._current[feature])
+                self._current[feature], self._fill[feature] = None, 0
+            if self.directory is not None and len(self._meta[feature]['ID']) >= self.flushEvery:
+                self._flush(feature)
+
+    def _buffered(self, feature):
+        """
+        Rows held in memory
+        :return: meta dict, values (rows x columns)
+        """
+        chunks = self._chunks[feature]
+        if self._fill[feature] > 0:
+            chunks = chunks + [self._current[feature][:self._fill[feature]]]
+        values = np.concatenate(chunks) if len(chunks) > 0 else np.empty((0, len(self.columns[feature])))
+        return {key: list(v) for key, v in self._meta[feature].items()}, values
+
+    def flush(self):
+        """
+        Write the rows held in memory to part files, nothing is done without a directory
+        :return: None
+        """
+        if self.directory is None:
+            return
+        with self._lock:
+            for feature in self.columns:
+                self._flush(feature)
+
+    def _flush(self, feature):
+        meta, values = self._buffered(feature)
+        if values.shape[0] == 0:
+            return
+        path = self.directory / '{}-{}{:06d}.{}'.format(feature, self.prefix, self._parts, self.format)
+        tmp = path.with_name(path.name+'.tmp')
+        if self.format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.table(dict({key: meta[key] for key in META},
+                                       **{label: values[:,i] for i, label in enumerate(self.columns[feature])}))
+            pyarrow.parquet.write_table(table, tmp)
+        else:
+            with open(tmp, 'wb') as f:
+                np.savez(f, values=values, **{key: np.array(meta[key], dtype=str) for key in META})
+        os.replace(tmp, path) # a part file is either complete or missing
+        self._parts += 1
+        self._chunks[feature], self._current[feature], self._fill[feature] = [], None, 0
+        self._meta[feature] = {key: [] for key in META}
+        logging.info("Flushed {} rows of '{}' to {}".format(values.shape[0], feature, path))
+
+    def arrays(self, feature):
+        """
+        All rows of a feature: the part files of every writer in the directory, then the
+        rows held in memory
+        :param feature: feature name
+        :return: meta dict (ID, sex, condition lists), values (rows x columns)
+        """
+        metas, values = [], []
+        with self._lock: # no rows are flushed while reading
+            if self.directory is not None:
+                for path in sorted(self.directory.glob('{}-*.{}'.format(feature, self.format))):
+                    metas.append(_read_part(path, self.columns[feature]))
+                    values.append(metas[-1].pop('values'))
+            meta, buffered = self._buffered(feature)
+        metas.append(meta)
+        values.append(buffered)
+        return {key: [v for m in metas for v in m[key]] for key in META}, np.concatenate(values)
+
+    def frame(self, feature):
+        """
+        All rows of a feature as a DataFrame with the ID, sex and condition columns first
+        :param feature: feature name
+        :return: pandas DataFrame
+        """
+        import pandas as pd
+        meta, values = self.arrays(feature)
+        frame = pd.DataFrame(values, columns=self.columns[feature])
+        for i, key in enumerate(META):
+            frame.insert(i, key, meta[key])
+        return frame
+
+    def to_csv(self, directory):
+        """
+        Export each feature to <feature>.csv
+        :param directory: output directory
+        :return: None
+        """
+        for feature in self.columns:
+            self.frame(feature).to_csv(str(Path(directory)/'{}.csv'.format(feature)), index=False)
+
+def _read_part(path, columns):
+    """
+    Read a part file written by ResultStore
+    :param path: part filepath
+    :param columns: column labels of the feature
+    :return: meta dict with the values (rows x columns) under 'values'
+    """
+    if path.suffix == '.parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+        part = {key: table.column(key).to_pylist() for key in META}
+        part['values'] = np.column_stack([table.column(label).to_numpy() for label in columns]) if len(columns) > 0 \
+                         else np.empty((table.num_rows, 0))
+        return part
+    with np.load(path) as npz:
+        part = {key: npz[key].tolist() for key in META}
+        part['values'] = npz['values']
+    return part
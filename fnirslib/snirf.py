@@ -0,0 +1,180 @@
+"""
+author: @nimrobotics
+description: lazy reader for processed (HbO, HbR, HbT) .snirf files
+"""
+
+import numpy as np
+import logging
+
+HB_TYPES = ['hbo', 'hbr', 'hbt'] # order of the signal types in data
+
+def _read_str(dset):
+    """
+    Reads a string dataset
+    :param dset: h5py dataset
+    :return: str
+    """
+    value = dset[()]
+    if isinstance(value, np.ndarray):
+        value = value.flat[0]
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+def _numbered(group, prefix):
+    """
+    Gets numbered subgroups like stim1, stim2, ... in numeric order
+    :param group: h5py group
+    :param prefix: name prefix
+    :return: list of subgroups
+    """
+    keys = [k for k in group.keys() if k.startswith(prefix) and k[len(prefix):].isdigit()]
+    return [group[k] for k in sorted(keys, key=lambda k: int(k[len(prefix):]))]
+
+class SnirfReader:
+    """
+    Keeps a .snirf file open and reads time ranges and channels on demand,
+    only the requested part of dataTimeSeries is read from disk
+    """
+    def __init__(self, filepath, blockSize=65536):
+        """
+        :param filepath: .snirf filepath
+        :param blockSize: number of samples read from disk at a time, bounds the temporary memory
+        """
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("h5py is required to read .snirf files, install it with 'pip install h5py'")
+        self.filepath = filepath
+        self.blockSize = blockSize
+        self.file = h5py.File(filepath, 'r')
+        self.nirs = _numbered(self.file, 'nirs')[0] if 'nirs' not in self.file else self.file['nirs']
+        self.dataGroup = _numbered(self.nirs, 'data')[0]
+        self.series = self.dataGroup['dataTimeSeries'] # samples x measurements
+        self.nSamples = self.series.shape[0]
+        self.time = self._read_time()
+        self.columns = self._map_channels() # 3 x channels, measurement column of each signal type and channel
+        self.nChannels = self.columns.shape[1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the file
+        :return: None
+        """
+        self.file.close()
+
+    def _read_time(self):
+        """
+        Reads the time vector, expanding the (start, step) form
+        :return: time of each sample in seconds
+        """
+        time = np.asarray(self.dataGroup['time'][()], dtype=np.float64).ravel()
+        if time.shape[0] == 2 and self.nSamples != 2:
+            time = time[0] + time[1]*np.arange(self.nSamples)
+        return time
+
+    def _map_channels(self):
+        """
+        Maps the measurement list to (signal type, channel) positions, channels are the
+        source-detector pairs in order of first appearance. HbT is -1 if not stored
+        :return: 3 x channels array of measurement columns
+        """
+        pairs = []
+        columns = {}
+        for col, ml in enumerate(_numbered(self.dataGroup, 'measurementList')):
+            label = _read_str(ml['dataTypeLabel']).lower() if 'dataTypeLabel' in ml else ''
+            if label not in HB_TYPES:
+                continue
+            pair = (int(ml['sourceIndex'][()]), int(ml['detectorIndex'][()]))
+            if pair not in pairs:
+                pairs.append(pair)
+            columns[(HB_TYPES.index(label), pairs.index(pair))] = col
+        if len(pairs) == 0:
+            raise ValueError('No processed HbO/HbR/HbT measurements found in {}'.format(self.filepath))
+        out = -np.ones((3, len(pairs)), dtype=np.int64)
+        for (hb, ch), col in columns.items():
+            out[hb, ch] = col
+        if np.any(out[:2] < 0):
+            raise ValueError('HbO and HbR must be stored for every channel')
+        return out
+
+    def sample_index(self, t):
+        """
+        Nearest sample of the given times
+        :param t: times in seconds
+        :return: sample indices
+        """
+        idx = np.clip(np.searchsorted(self.time, t), 1, self.nSamples-1)
+        idx -= ((t - self.time[idx-1]) < (self.time[idx] - t)).astype(np.int64)
+        return idx
+
+    def stims(self, start=0, stop=None):
+        """
+        Builds the stimulus columns from the stim groups, each event marks its onset and
+        end (onset + duration) sample with 1 as in .nirs files with paired stims
+        :param start: first sample
+        :param stop: last sample (exclusive), None for the end of the recording
+        :return: samples x stim groups
+        """
+        stop = self.nSamples if stop is None else stop
+        groups = _numbered(self.nirs, 'stim')
+        stims = np.zeros((self.nSamples, len(groups)), dtype=np.int64)
+        for i, group in enumerate(groups):
+            events = np.atleast_2d(np.asarray(group['data'][()], dtype=np.float64)) if 'data' in group else np.zeros((0, 3))
+            if events.size == 0:
+                continue
+            events = events[:,:3] # onset, duration, value; further columns are optional extras
+            stims[self.sample_index(events[:,0]), i] = 1
+            paired = events[:,1] > 0
+            stims[self.sample_index(events[paired,0] + events[paired,1]), i] = 1
+        return stims[start:stop]
+
+    @property
+    def stimNames(self):
+        """
+        Names of the stim groups, in the order of the stim columns
+        """
+        return [_read_str(g['name']) if 'name' in g else '' for g in _numbered(self.nirs, 'stim')]
+
+    def read(self, start=0, stop=None, channels=None):
+        """
+        Reads a time range of the selected channels
+        :param start: first sample
+        :param stop: last sample (exclusive), None for the end of the recording
+        :param channels: channel indices, None for all channels
+        :return: data, samples x 3 (HbO, HbR, HbT) x channels
+        """
+        stop = self.nSamples if stop is None else stop
+        channels = np.arange(self.nChannels) if channels is None else np.asarray(channels)
+        columns = self.columns[:, channels]
+        stored = columns[columns >= 0]
+        order = np.unique(stored) # h5py needs increasing indices
+        position = np.searchsorted(order, columns.clip(min=0))
+        data = np.empty((stop-start, 3, len(channels)), dtype=np.float64)
+        for blockStart in range(start, stop, self.blockSize):
+            blockStop = min(blockStart+self.blockSize, stop)
+            block = self.series[blockStart:blockStop, order]
+            data[blockStart-start:blockStop-start] = block[:, position]
+        missing = columns[2] < 0
+        data[:, 2, missing] = data[:, 0, missing] + data[:, 1, missing] # HbT = HbO + HbR
+        return data
+
+def read_snirf(filepath, start=0, stop=None, channels=None):
+    """
+    Parse a .snirf file
+    :param filepath: .snirf filepath
+    :param start: first sample
+    :param stop: last sample (exclusive), None for the end of the recording
+    :param channels: channel indices, None for all channels
+    :return: data, stims
+    """
+    with SnirfReader(filepath) as reader:
+        data = reader.read(start, stop, channels)
+        stims = reader.stims(start, stop)
+    logging.info("Successfully loaded data from {}".format(filepath))
+    logging.info("Data shape: {}, Stimulus data shape: {}".format(data.shape, stims.shape))
+    return data, stims
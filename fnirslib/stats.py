@@ -0,0 +1,284 @@
+"""
+author: @nimrobotics
+description: group-level statistics of per-subject features (activations, connectivity edges),
+             t-tests, FDR correction and max-statistic and network-based permutation tests
+"""
+
+import numpy as np
+import scipy.stats
+import scipy.sparse
+import scipy.sparse.csgraph
+import functools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+def edges(matrices):
+    """
+    Upper triangle (without the diagonal) of connectivity matrices, in the order of the funcCon columns
+    :param matrices: regions x regions, or subjects x regions x regions
+    :return: edges, or subjects x edges
+    """
+    matrices = np.asarray(matrices)
+    rows, cols = np.triu_indices(matrices.shape[-1], 1)
+    return matrices[..., rows, cols]
+
+def pair_subjects(idsA, a, idsB, b):
+    """
+    Rows of the subjects present in both conditions, in the same order, for paired tests
+    :param idsA: subject IDs of the rows of a, type: list
+    :param a: features, subjects x features
+    :param idsB: subject IDs of the rows of b, type: list
+    :param b: features, subjects x features
+    :return: IDs, a, b of the common subjects
+    """
+    rowB = {ID: i for i, ID in enumerate(idsB)}
+    common = [(i, rowB[ID]) for i, ID in enumerate(idsA) if ID in rowB]
+    if len(common) < len(idsA) or len(common) < len(idsB):
+        logging.warning('Pairing {} of {} and {} subjects'.format(len(common), len(idsA), len(idsB)))
+    rowsA = [i for i, _ in common]
+    rowsB = [j for _, j in common]
+    return [idsA[i] for i in rowsA], np.asarray(a)[rowsA], np.asarray(b)[rowsB]
+
+def _design(a, b, paired):
+    """
+    Observations of the test: the (paired differences of the) subjects of a one-sample test,
+    or both groups stacked for a two-sample test
+    :return: observations (subjects x features), size of the first group or None for a one-sample test
+    """
+    a = np.asarray(a, dtype=np.float64).reshape(np.shape(a)[0], -1)
+    if b is None:
+        return a, None
+    b = np.asarray(b, dtype=np.float64).reshape(np.shape(b)[0], -1)
+    if paired:
+        assert a.shape == b.shape, 'Paired samples should have the same shape, see pair_subjects'
+        return a - b, None
+    x = np.concatenate([a, b])
+    with np.errstate(invalid='ignore'):
+        x -= np.nanmean(x, axis=0) # the two-sample statistic does not change, the sums stay small
+    return x, a.shape[0]
+
+def _one_sample_t(signs, x, valid, sumsq):
+    """
+    One-sample t-statistics for a batch of sign flips, one matmul for the whole batch
+    :param signs: flips x subjects of +-1
+    :param x: observations with missing values set to 0, subjects x features
+    :param valid: observations present, subjects x features
+    :param sumsq: sum of squares per feature, the same for every flip
+    :return: t-statistics, flips x features
+    """
+    n = np.sum(valid, axis=0)
+    mean = (signs @ x) / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (sumsq - n*mean*mean) / (n-1)
+        return mean / np.sqrt(var/n)
+
+def _two_sample_t(groups, x, valid):
+    """
+    Two-sample (pooled variance) t-statistics for a batch of group assignments, from the
+    per-group sums, sums of squares and counts as matmuls over the whole batch
+    :param groups: assignments x subjects, 1 for the first group
+    :param x: observations with missing values set to 0, subjects x features
+    :param valid: observations present, subjects x features
+    :return: t-statistics, assignments x features
+    """
+    n1 = groups @ valid
+    n2 = np.sum(valid, axis=0) - n1
+    s1 = groups @ x
+    s2 = np.sum(x, axis=0) - s1
+    ss1 = groups @ (x*x)
+    ss2 = np.sum(x*x, axis=0) - ss1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m1, m2 = s1/n1, s2/n2
+        var = (ss1 - n1*m1*m1 + ss2 - n2*m2*m2) / (n1+n2-2)
+        return (m1 - m2) / np.sqrt(var*(1/n1 + 1/n2))
+
+def _statistic(batch, x, valid, nFirst):
+    """
+    t-statistics for a batch of sign flips (one-sample) or group assignments (two-sample)
+    """
+    if nFirst is None:
+        return _one_sample_t(batch, x, valid, np.sum(x*x, axis=0))
+    return _two_sample_t(batch, x, valid)
+
+def _observed(nSubjects, nFirst):
+    """
+    Batch of the observed sign flips or group assignment
+    """
+    if nFirst is None:
+        return np.ones((1, nSubjects))
+    return (np.arange(nSubjects) < nFirst).astype(np.float64)[None]
+
+def _random_batch(rng, size, nSubjects, nFirst):
+    """
+    Batch of random sign flips or group assignments
+    """
+    if nFirst is None:
+        return rng.integers(0, 2, (size, nSubjects)).astype(np.float64)*2 - 1
+    return rng.permuted(np.repeat(_observed(nSubjects, nFirst), size, axis=0), axis=1)
+
+def ttest(a, b=None, paired=False):
+    """
+    t-test of every feature at once, missing (NaN) values are left out
+    :param a: features of the first group, subjects x ...
+    :param b: features of the second group, None for a one-sample test against 0
+    :param paired: paired test of a - b (same subjects in the same order), type: bool
+    :return: t-statistics, two-sided p-values; a.shape[1:]
+    """
+    x, nFirst = _design(a, b, paired)
+    valid = ~np.isnan(x)
+    x = np.where(valid, x, 0.0)
+    t = _statistic(_observed(x.shape[0], nFirst), x, valid, nFirst)[0]
+    n = np.sum(valid, axis=0)
+    df = n-1 if nFirst is None else n-2
+    with np.errstate(invalid='ignore'):
+        p = 2*scipy.stats.t.sf(np.abs(t), df)
+    shape = np.shape(a)[1:]
+    return t.reshape(shape), p.reshape(shape)
+
+def fdr(pvalues, alpha=0.05):
+    """
+    Benjamini-Hochberg false discovery rate correction, NaN p-values are left out
+    :param pvalues: p-values, any shape
+    :param alpha: false discovery rate
+    :return: significant (bool), adjusted p-values (NaN where p is NaN); same shape as pvalues
+    """
+    p = np.asarray(pvalues, dtype=np.float64)
+    flat = p.ravel()
+    present = np.flatnonzero(~np.isnan(flat))
+    order = present[np.argsort(flat[present], kind='stable')]
+    m = order.shape[0]
+    adjusted = np.full(flat.shape, np.nan)
+    if m > 0:
+        ranked = flat[order] * m / np.arange(1, m+1)
+        adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return (adjusted <= alpha).reshape(p.shape), adjusted.reshape(p.shape)
+
+def _components(supra, nRegions):
+    """
+    Connected components of the graph of the supra-threshold edges
+    :param supra: supra-threshold edges, bool, edges in the order of edges()
+    :param nRegions: number of regions
+    :return: component of every edge (-1 below threshold), number of edges per component
+    """
+    rows, cols = np.triu_indices(nRegions, 1)
+    graph = scipy.sparse.coo_matrix((np.ones(np.count_nonzero(supra)), (rows[supra], cols[supra])),
+                                    shape=(nRegions, nRegions))
+    _, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    component = np.where(supra, labels[rows], -1)
+    sizes = np.bincount(component[supra], minlength=nRegions)
+    return component, sizes
+
+def _largest_components(supra, nRegions):
+    """
+    Largest connected component of a batch of graphs, the graphs are joined into one
+    block-diagonal graph so that a single connected_components call labels them all
+    :param supra: supra-threshold edges, graphs x edges
+    :param nRegions: number of regions
+    :return: number of edges of the largest component of each graph
+    """
+    rows, cols = np.triu_indices(nRegions, 1)
+    graph, edge = np.nonzero(supra)
+    offset = graph*nRegions
+    n = supra.shape[0]*nRegions
+    blocks = scipy.sparse.coo_matrix((np.ones(edge.shape[0]), (rows[edge]+offset, cols[edge]+offset)), shape=(n, n))
+    _, labels = scipy.sparse.csgraph.connected_components(blocks, directed=False)
+    labels = labels[rows[edge]+offset]
+    sizes = np.bincount(labels)
+    largest = np.zeros(supra.shape[0], dtype=np.int64)
+    np.maximum.at(largest, graph, sizes[labels])
+    return largest
+
+def _null_chunk(seed, size, x, valid, nFirst, observed, threshold, nRegions):
+    """
+    Null distribution of one chunk of permutations, run in a worker of the process pool
+    :param seed: seed of the chunk, type: SeedSequence
+    :param size: permutations in the chunk
+    :return: max |t| per permutation, permutations with |t| >= |observed t| per feature,
+             largest component per permutation (None without threshold)
+    """
+    rng = np.random.default_rng(seed)
+    t = np.abs(_statistic(_random_batch(rng, size, x.shape[0], nFirst), x, valid, nFirst))
+    t = np.where(np.isnan(t), -np.inf, t)
+    exceed = np.sum(t >= np.abs(observed), axis=0)
+    largest = None if threshold is None else _largest_components(t > threshold, nRegions)
+    return np.max(t, axis=1), exceed, largest
+
+def _permutations(a, b, paired, nPermutations, chunkSize, workers, seed, threshold=None, nRegions=None):
+    """
+    Observed t-statistics and their permutation null distribution, the permutations are drawn
+    and evaluated chunkSize at a time as batched matmuls, chunks are spread over workers.
+    Every chunk has its own seed, the result does not depend on the number of workers
+    :return: observed t (features), max |t| per permutation, exceedances per feature,
+             largest component per permutation
+    """
+    x, nFirst = _design(a, b, paired)
+    valid = ~np.isnan(x)
+    x = np.where(valid, x, 0.0)
+    observed = _statistic(_observed(x.shape[0], nFirst), x, valid, nFirst)[0]
+    sizes = [min(chunkSize, nPermutations - start) for start in range(0, nPermutations, chunkSize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    chunk = functools.partial(_null_chunk, x=x, valid=valid.astype(np.float64), nFirst=nFirst,
+                              observed=observed, threshold=threshold, nRegions=nRegions)
+    if workers == 1:
+        results = list(map(chunk, seeds, sizes))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(chunk, seeds, sizes))
+    maxStat = np.concatenate([r[0] for r in results])
+    exceed = np.sum([r[1] for r in results], axis=0)
+    largest = None if threshold is None else np.concatenate([r[2] for r in results])
+    return observed, maxStat, exceed, largest
+
+def permutation_test(a, b=None, paired=False, nPermutations=10000, chunkSize=1000, workers=1, seed=0):
+    """
+    Permutation t-test of every feature: sign flips of the subjects for one-sample and paired
+    tests, shuffled group labels for two-sample tests. Family-wise error is controlled with the
+    maximum |t| over the features of each permutation
+    :param a: features of the first group, subjects x ...
+    :param b: features of the second group, None for a one-sample test against 0
+    :param paired: paired test of a - b, type: bool
+    :param nPermutations: number of random permutations
+    :param chunkSize: permutations evaluated at a time, bounds the memory to chunkSize x (subjects + features)
+    :param workers: number of processes, None for os.cpu_count(), 1 runs in the current process
+    :param seed: random seed, the result is reproducible for any number of workers
+    :return: t-statistics, uncorrected p-values, FWE corrected p-values; a.shape[1:], two-sided
+    """
+    observed, maxStat, exceed, _ = _permutations(a, b, paired, nPermutations, chunkSize, workers, seed)
+    with np.errstate(invalid='ignore'):
+        p = (1 + exceed) / (1 + nPermutations)
+        pFWE = (1 + np.sum(maxStat[:,None] >= np.abs(observed), axis=0)) / (1 + nPermutations)
+    missing = np.isnan(observed)
+    p[missing], pFWE[missing] = np.nan, np.nan
+    shape = np.shape(a)[1:]
+    return observed.reshape(shape), p.reshape(shape), pFWE.reshape(shape)
+
+def nbs(a, b=None, paired=False, threshold=3.0, nPermutations=10000, chunkSize=1000, workers=1, seed=0):
+    """
+    Network-based statistic (Zalesky et al. 2010): connected components of the edges with
+    |t| above threshold, tested against the largest component (number of edges) of each permutation
+    :param a: connectivity of the first group, subjects x edges (see edges) or subjects x regions x regions
+    :param b: connectivity of the second group, None for a one-sample test against 0
+    :param paired: paired test of a - b, type: bool
+    :param threshold: primary |t| threshold of the edges
+    :param nPermutations: number of random permutations
+    :param chunkSize: permutations evaluated at a time
+    :param workers: number of processes, None for os.cpu_count(), 1 runs in the current process
+    :param seed: random seed
+    :return: dict with 't' (per edge), 'component' (component of every edge, -1 below threshold),
+             'size' (edges per component), 'p' (FWE corrected p-value per component)
+    """
+    a = edges(a) if np.ndim(a) == 3 else np.asarray(a)
+    if b is not None and np.ndim(b) == 3:
+        b = edges(b)
+    nRegions = int(round((1 + np.sqrt(1 + 8*a.shape[1])) / 2))
+    assert nRegions*(nRegions-1)//2 == a.shape[1], 'Number of edges does not match an upper triangle'
+    observed, _, _, largest = _permutations(a, b, paired, nPermutations, chunkSize, workers, seed,
+                                            threshold=threshold, nRegions=nRegions)
+    component, sizes = _components(np.abs(observed) > threshold, nRegions)
+    keep = np.flatnonzero(sizes > 0) # renumber the components with edges
+    relabel = np.full(sizes.shape[0], -1)
+    relabel[keep] = np.arange(keep.shape[0])
+    component = np.where(component >= 0, relabel[np.maximum(component, 0)], -1)
+    sizes = sizes[keep]
+    p = (1 + np.sum(largest[:,None] >= sizes, axis=0)) / (1 + nPermutations)
+    return {'t': observed, 'component': component, 'size': sizes, 'p': p}
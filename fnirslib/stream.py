@@ -0,0 +1,212 @@
+"""
+author: @nimrobotics
+description: online (streaming) processing of fnirs data, block by block
+"""
+
+import numpy as np
+import logging
+from .fnirslib import region_matrix
+from .metrics import Metrics
+from .connectivity import RunningCorrelation, fisher_z
+
+class OnlineDetrend:
+    """
+    Causal linear detrend: each sample has the least squares line fit to all samples up
+    to and including it subtracted. Only running sums are kept, O(channels) state
+    """
+    def __init__(self):
+        self.n = 0
+        self._ref = None # first sample, subtracted to keep the sums small
+
+    def __call__(self, data):
+        """
+        Detrend a block of samples
+        :param data: samples x ...
+        :return: detrended block
+        """
+        x = np.asarray(data, dtype=np.float64)
+        if self._ref is None:
+            self._ref = x[0].copy()
+            shape = x.shape[1:]
+            self._st, self._stt = 0.0, 0.0
+            self._sx, self._stx = np.zeros(shape), np.zeros(shape)
+        x = x - self._ref
+        t = (self.n + np.arange(x.shape[0], dtype=np.float64)).reshape((-1,)+(1,)*(x.ndim-1))
+        n = t + 1
+        st = self._st + np.cumsum(t, axis=0)
+        stt = self._stt + np.cumsum(t*t, axis=0)
+        sx = self._sx + np.cumsum(x, axis=0)
+        stx = self._stx + np.cumsum(t*x, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = np.nan_to_num((n*stx - st*sx) / (n*stt - st*st)) # no slope for the first sample
+        intercept = (sx - slope*st) / n
+        self.n += x.shape[0]
+        self._st, self._stt, self._sx, self._stx = st[-1].item(), stt[-1].item(), sx[-1], stx[-1]
+        return x - (intercept + slope*t)
+
+class StreamProcessor:
+    """
+    Processes fnirs data as it arrives, block by block, with bounded work per block.
+    Keeps online detrend state, the samples needed for the local baseline, the open
+    trial of the stimulus column and a rolling connectivity window. Trial features are
+    emitted when a trial closes
+    """
+    def __init__(self, regions, stimNumber, freq, paired=True, trialDuration=None, baselineDuration=2,
+                 peakPadding=4, detrend=True, sig_type=0, fcWindow=None):
+        """
+        :param regions: brain regions, type: list of lists
+        :param stimNumber: stimulus number/condition, type: int
+        :param freq: sampling frequency
+        :param paired: True if each trial has start and end stim, type: bool
+        :param trialDuration: trial duration in seconds, needed if paired is False
+        :param baselineDuration: duration of the local baseline in seconds
+        :param peakPadding: number of samples to pad the peak
+        :param detrend: apply online linear detrend, type: bool
+        :param sig_type: signal type used for the rolling connectivity, 0 HbO, 1 HbR, 2 HbT
+        :param fcWindow: rolling connectivity window in seconds, None to disable
+        """
+        assert paired or trialDuration is not None, 'Trial duration needed for unpaired stims'
+        self.regions = regions
+        self.stimNumber = stimNumber
+        self.freq = freq
+        self.paired = paired
+        self.trialLength = None if paired else int(trialDuration*freq)
+        self.nBaseline = max(int(baselineDuration*freq)-1, 0) # as in Fnirslib.get_local_baseline
+        self.peakPadding = peakPadding
+        self.sig_type = sig_type
+        self.regionMatrix = region_matrix(regions, max([max(e) for e in regions])+1)
+        self.detrender = OnlineDetrend() if detrend else None
+        self.fcWindow = None if fcWindow is None else int(fcWindow*freq)
+        self.nSamples = 0 # samples seen
+        self._history = None # last nBaseline samples
+        self._trial = None # open trial
+        self._fc = None
+        self._fcBuffer = None # ring buffer of the last fcWindow samples, regions along the columns
+        self._fcPos = 0 # next write position in the ring buffer
+        self._fcCount = 0 # samples held in the ring buffer
+        self._fcAdded = 0
+
+    def push(self, data, stims):
+        """
+        Ingest a block of samples
+        :param data: block of data, samples x 3 x channels
+        :param stims: block of stimulus data, samples x stimulus columns
+        :return: list of features of the trials closed in this block
+        """
+        if self.detrender is not None:
+            data = self.detrender(data)
+        if self.fcWindow is not None:
+            self._update_connectivity(data[:,self.sig_type,:] @ self.regionMatrix)
+        closed = []
+        events = np.flatnonzero(stims[:,self.stimNumber])
+        i, pos = 0, 0
+        while True:
+            end = self._pending_end() # unpaired trials close after trialLength samples
+            if i < events.shape[0] and (end is None or events[i] < end):
+                e = events[i]
+                i += 1
+                if self._trial is not None and self.paired:
+                    closed.append(self._close(data[pos:e], e))
+                else:
+                    if self._trial is not None:
+                        logging.warning('Trial starting at {} overlaps the open trial, dropping it'.format(self.nSamples+e))
+                    self._open(data, e)
+                pos = e
+            elif end is not None and end <= data.shape[0]:
+                closed.append(self._close(data[pos:end], end))
+                pos = end
+            else:
+                break
+        if self._trial is not None:
+            self._trial['samples'].append(np.array(data[pos:])) # the caller may reuse its block buffer
+        self._keep_history(data)
+        self.nSamples += data.shape[0]
+        return closed
+
+    def replay(self, data, stims, blockSize):
+        """
+        Replays a recording in blocks, e.g. from Fnirslib.load_nirs
+        :param data: data, samples x 3 x channels
+        :param stims: stimulus data
+        :param blockSize: number of samples per block
+        :return: generator of the trials closed in each block
+        """
+        for start in range(0, data.shape[0], blockSize):
+            yield self.push(data[start:start+blockSize], stims[start:start+blockSize])
+
+    def connectivity(self):
+        """
+        Connectivity over the last fcWindow seconds
+        :return: correlation matrix, z-scores; None if fewer than two samples were seen
+        """
+        if self._fc is None or self._fc.n < 2:
+            return None
+        return fisher_z(self._fc.correlation())
+
+    def _pending_end(self):
+        """
+        Block position where the open unpaired trial ends
+        """
+        if self._trial is None or self.paired:
+            return None
+        return self._trial['start'] + self.trialLength - self.nSamples
+
+    def _open(self, data, e):
+        """
+        Opens a trial at block position e, the baseline uses the samples before it
+        """
+        before = data[max(e-self.nBaseline, 0):e]
+        if self._history is not None and before.shape[0] < self.nBaseline:
+            before = np.concatenate([self._history, before])[-self.nBaseline:]
+        baseline = Metrics(before).get_mean_activation() if before.shape[0] > 0 else np.full(data.shape[1:], np.nan)
+        self._trial = {'start': self.nSamples+e, 'baseline': baseline, 'samples': []}
+
+    def _close(self, lastSamples, e):
+        """
+        Closes the open trial at block position e and computes its features
+        """
+        trial = self._trial
+        self._trial = None
+        samples = np.concatenate(trial['samples']+[lastSamples])
+        mean = Metrics(samples).get_mean_activation() # masked (NaN) channels as in the batch path
+        peak = Metrics(samples, self.peakPadding).get_peak_activation(baseline=trial['baseline'])
+        return {'start': trial['start'], 'end': self.nSamples+e, 'baseline': trial['baseline'],
+                'mean': mean, 'peak': peak,
+                'meanClust': mean @ self.regionMatrix, 'peakClust': peak @ self.regionMatrix}
+
+    def _keep_history(self, data):
+        """
+        Keeps the last nBaseline samples for the baseline of trials starting in the next block
+        """
+        if self.nBaseline == 0:
+            return
+        if self._history is None or data.shape[0] >= self.nBaseline:
+            self._history = data[-self.nBaseline:].copy()
+        else:
+            self._history = np.concatenate([self._history, data])[-self.nBaseline:]
+
+    def _update_connectivity(self, clustered):
+        """
+        Slides the connectivity window over a block of region data, the window is kept in
+        a preallocated ring buffer so the work per block only depends on the block size
+        """
+        if self._fc is None:
+            self._fc = RunningCorrelation(clustered.shape[1])
+            self._fcBuffer = np.empty((self.fcWindow, clustered.shape[1]))
+        self._fc.add(clustered)
+        if clustered.shape[0] > self.fcWindow: # only the end of a long block stays in the window
+            self._fc.remove(clustered[:-self.fcWindow])
+            clustered = clustered[-self.fcWindow:]
+        n = clustered.shape[0]
+        overflow = self._fcCount + n - self.fcWindow
+        if overflow > 0: # oldest samples leave the window
+            self._fc.remove(self._fcBuffer[(self._fcPos - self._fcCount + np.arange(overflow)) % self.fcWindow])
+            self._fcCount -= overflow
+        self._fcBuffer[(self._fcPos + np.arange(n)) % self.fcWindow] = clustered
+        self._fcPos = (self._fcPos + n) % self.fcWindow
+        self._fcCount += n
+        self._fcAdded += n
+        if self._fcAdded > 10*self.fcWindow: # rebuild the sums now and then to bound round-off
+            self._fc = RunningCorrelation(clustered.shape[1])
+            self._fc.add(self._fcBuffer[(self._fcPos - self._fcCount + np.arange(self._fcCount)) % self.fcWindow])
+            self._fcAdded = 0
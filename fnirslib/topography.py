@@ -0,0 +1,120 @@
+"""
+author: @nimrobotics
+description: channel and region positions of a montage and the interpolation of channel
+             values to a pixel grid for topographic maps
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+import functools
+from . import mbll
+
+def project(positions):
+    """
+    2D layout of optode or channel positions. 3D positions on a head are projected with an
+    azimuthal equidistant projection around their mean direction from the fitted sphere center
+    (as for EEG topomaps), flat probes onto their plane
+    :param positions: positions, points x 2 or points x 3
+    :return: positions, points x 2
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.shape[1] == 2:
+        return positions
+    centered = positions - np.mean(positions, axis=0)
+    _, singular, axes = np.linalg.svd(centered, full_matrices=False)
+    if singular.shape[0] < 3 or singular[2] <= 1e-6*singular[0]: # flat probe
+        return centered @ axes[:2].T
+    # sphere center from the least squares fit of |p|^2 = 2 p.c + r^2 - |c|^2
+    A = np.c_[2*positions, np.ones(positions.shape[0])]
+    center = np.linalg.lstsq(A, np.sum(positions**2, axis=1), rcond=None)[0][:3]
+    direction = positions - center
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    pole = np.mean(direction, axis=0)
+    pole /= np.linalg.norm(pole)
+    u = np.cross(pole, [0., 1., 0.] if abs(pole[1]) < 0.9 else [1., 0., 0.]) # tangent plane at the pole
+    u /= np.linalg.norm(u)
+    v = np.cross(pole, u)
+    angle = np.arccos(np.clip(direction @ pole, -1, 1)) # distance from the pole
+    azimuth = np.arctan2(direction @ v, direction @ u)
+    return np.c_[angle*np.cos(azimuth), angle*np.sin(azimuth)]
+
+def channel_positions(SD):
+    """
+    Position of every channel as the midpoint of its source and detector, in the channel
+    order of the concentration data
+    :param SD: probe description with MeasList, SrcPos and DetPos, type: dict
+    :return: positions, channels x 2
+    """
+    pairs, _ = mbll.channels(SD['MeasList'])
+    src = np.atleast_2d(SD['SrcPos'])[pairs[:,0]-1]
+    det = np.atleast_2d(SD['DetPos'])[pairs[:,1]-1]
+    return project((src + det) / 2)
+
+def region_positions(positions, regions):
+    """
+    Position of every region as the mean position of its channels
+    :param positions: channel positions, channels x 2
+    :param regions: brain regions, type: list of lists
+    :return: positions, regions x 2
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    return np.stack([np.mean(positions[region], axis=0) for region in regions])
+
+@functools.lru_cache(maxsize=32)
+def _interpolation(positions, resolution):
+    points = np.array(positions)
+    low, high = points.min(axis=0), points.max(axis=0)
+    margin = 0.05*np.max(high - low)
+    low, high = low - margin, high + margin
+    step = np.max(high - low) / resolution
+    nx, ny = max(int(np.ceil((high[0]-low[0])/step)), 1), max(int(np.ceil((high[1]-low[1])/step)), 1)
+    x = low[0] + step*(np.arange(nx) + 0.5)
+    y = low[1] + step*(np.arange(ny) + 0.5)
+    pixels = np.stack(np.meshgrid(x, y), axis=-1).reshape(-1, 2) # rows of the image from the bottom
+    triangulation = scipy.spatial.Delaunay(points)
+    simplex = triangulation.find_simplex(pixels)
+    inside = simplex >= 0
+    # barycentric coordinates of the pixels in their triangle
+    transform = triangulation.transform[simplex[inside]]
+    b = np.einsum('nij,nj->ni', transform[:,:2], pixels[inside] - transform[:,2])
+    weights = np.c_[b, 1 - np.sum(b, axis=1)]
+    rows = np.repeat(np.flatnonzero(inside), 3)
+    cols = triangulation.simplices[simplex[inside]].ravel()
+    matrix = scipy.sparse.csr_matrix((weights.ravel(), (rows, cols)), shape=(pixels.shape[0], points.shape[0]))
+    inside.flags.writeable = False
+    extent = (low[0], low[0]+nx*step, low[1], low[1]+ny*step)
+    return matrix, inside, (ny, nx), extent
+
+def interpolation_matrix(positions, resolution=64):
+    """
+    Linear interpolation from the channels to a pixel grid over the Delaunay triangulation of
+    the channel positions, as a sparse pixels x channels matrix of barycentric weights.
+    Computed once per montage and resolution
+    :param positions: channel positions, channels x 2
+    :param resolution: pixels along the longer side of the grid
+    :return: matrix (pixels x channels, shared, must not be modified), pixels inside the
+             montage (bool), image shape (rows, columns), extent (left, right, bottom, top)
+    """
+    return _interpolation(tuple(map(tuple, np.asarray(positions, dtype=np.float64))), resolution)
+
+def interpolate(values, positions, resolution=64):
+    """
+    Topographic map(s) of channel values, one sparse product for any number of maps.
+    Missing (NaN) channels are left out and the weights of the others renormalized
+    :param values: values per channel, channels or maps x channels (e.g. one map per sample)
+    :param positions: channel positions, channels x 2
+    :param resolution: pixels along the longer side of the grid
+    :return: image(s), rows x columns or maps x rows x columns, NaN outside the montage
+    """
+    matrix, inside, shape, _ = interpolation_matrix(positions, resolution)
+    values = np.asarray(values, dtype=np.float64)
+    x = values.T # channels first for the sparse product
+    nan = np.isnan(x)
+    if nan.any():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            images = (matrix @ np.where(nan, 0.0, x)) / (matrix @ (~nan).astype(np.float64))
+    else:
+        images = matrix @ x
+    images[~inside] = np.nan
+    return images.T.reshape(values.shape[:-1] + shape)
@@ -0,0 +1,172 @@
+"""
+author: @nimrobotics
+description: batched writer of processed data, one container per condition
+"""
+
+import numpy as np
+import scipy.io
+import logging
+import queue
+import threading
+import warnings
+import zipfile
+import shutil
+import atexit
+import os
+from pathlib import Path
+
+class ProcessedDataWriter:
+    """
+    Writes the processed data of all subjects through a background thread, so the
+    computation is not blocked on disk. Formats:
+    'hdf5': one file per condition, <directory>/<condition>.h5, a group per subject with
+            the chunked (optionally compressed) 'pdata' dataset and the 'nTrials' attribute
+    'npz': one file per condition, <directory>/<condition>.npz with the '<subject>/pdata' and
+           '<subject>/nTrials' arrays, each subject is appended to the archive as it comes in
+    'mat': one .mat per subject and condition, <directory>/<condition>/<subject>.mat, as
+           Fnirslib.save_processed_data
+    Subjects already in the containers are kept and a subject written again replaces its
+    earlier data, in every format. Pending writes are flushed at interpreter exit if close()
+    was not called. A writer is used by a single process, arrays must not be modified after write()
+    """
+    def __init__(self, directory, format='hdf5', compression='gzip', queueSize=64):
+        """
+        :param directory: output directory
+        :param format: 'hdf5', 'npz' or 'mat', type: str
+        :param compression: compression of the 'hdf5' datasets ('gzip', 'lzf') or of the 'npz' files (any value), None for none
+        :param queueSize: number of pending writes before write() blocks
+        """
+        if format == 'hdf5':
+            try:
+                import h5py
+            except ImportError:
+                raise ImportError("h5py is required to write hdf5 files, install it with 'pip install h5py'")
+        elif format not in ['npz', 'mat']:
+            raise ValueError('Unknown format {}'.format(format))
+        self.directory = Path(directory)
+        self.format = format
+        self.compression = compression
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._files = {} # condition -> open h5py file or zip archive
+        self._members = {} # condition -> member names of the npz archive
+        self._rewritten = set() # conditions with npz members written more than once
+        self._error = None
+        self._queue = queue.Queue(maxsize=queueSize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close) # the thread is a daemon, flush what is queued before it is stopped
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, condition, subject, data, nTrials):
+        """
+        Queue the processed data of one subject
+        :param condition: condition label
+        :param subject: subject ID
+        :param data: processed data
+        :param nTrials: number of trials
+        :return: None
+        """
+        self._raise()
+        if not self._thread.is_alive():
+            raise ValueError('Writer is closed')
+        self._queue.put((condition, subject, data, nTrials))
+
+    def close(self):
+        """
+        Write all pending data and close the files
+        :return: None
+        """
+        atexit.unregister(self.close)
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue # drop the remaining writes after a failure, reported by write/close
+            try:
+                self._write(*item)
+            except Exception as e:
+                logging.error('Failed to write processed data: {}'.format(e))
+                self._error = e
+        try:
+            self._close_files()
+        except Exception as e:
+            logging.error('Failed to write processed data: {}'.format(e))
+            self._error = self._error or e
+
+    def _write(self, condition, subject, data, nTrials):
+        if self.format == 'mat':
+            fname = self.directory / condition / (subject+'.mat')
+            if condition not in self._files:
+                fname.parent.mkdir(parents=True, exist_ok=True)
+                self._files[condition] = None
+            scipy.io.savemat(str(fname), {"pdata": data, "nTrials": nTrials})
+        elif self.format == 'npz':
+            fname = self.directory / (condition+'.npz')
+            if condition not in self._files: # appended to, like the hdf5 files
+                self._files[condition] = zipfile.ZipFile(fname, 'a', zipfile.ZIP_DEFLATED if self.compression is not None else zipfile.ZIP_STORED,
+                                                         allowZip64=True)
+                self._members[condition] = set(self._files[condition].namelist())
+            archive, members = self._files[condition], self._members[condition]
+            for name, arr in [(subject+'/pdata.npy', data), (subject+'/nTrials.npy', nTrials)]:
+                if name in members:
+                    self._rewritten.add(condition) # the earlier copy is dropped on close
+                members.add(name)
+                with warnings.catch_warnings(): # duplicate member names until then
+                    warnings.simplefilter('ignore', UserWarning)
+                    with archive.open(name, 'w', force_zip64=True) as member: # same members as np.savez
+                        np.lib.format.write_array(member, np.asanyarray(arr), allow_pickle=False)
+        else:
+            import h5py
+            if condition not in self._files:
+                self._files[condition] = h5py.File(self.directory / (condition+'.h5'), 'a')
+            f = self._files[condition]
+            if subject in f:
+                del f[subject] # rewrite a subject processed again
+            group = f.create_group(subject)
+            data = np.asarray(data)
+            group.create_dataset('pdata', data=data, chunks=True if data.size > 0 else None,
+                                 compression=self.compression if data.size > 0 else None)
+            group.attrs['nTrials'] = nTrials
+            fname = self.directory / (condition+'.h5')
+        logging.info('Saved data of {} to {}'.format(subject, fname))
+
+    def _close_files(self):
+        for condition, f in self._files.items():
+            if f is not None:
+                f.close()
+            if condition in self._rewritten:
+                self._compact(self.directory / (condition+'.npz'))
+        self._files, self._members, self._rewritten = {}, {}, set()
+
+    def _compact(self, fname):
+        """
+        Rewrites an npz archive with only the last copy of every member, one member at a time
+        :param fname: archive path
+        :return: None
+        """
+        tmp = fname.with_name('{}.{}.tmp'.format(fname.name, os.getpid()))
+        with zipfile.ZipFile(fname, 'r') as src, zipfile.ZipFile(tmp, 'w', allowZip64=True) as dst:
+            latest = {info.filename: info for info in src.infolist()}
+            for name, info in latest.items():
+                member = zipfile.ZipInfo(name, info.date_time)
+                member.compress_type = info.compress_type
+                with src.open(info) as fin, dst.open(member, 'w', force_zip64=True) as fout:
+                    shutil.copyfileobj(fin, fout)
+        os.replace(tmp, fname)
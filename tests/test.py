@@ -3,9 +3,30 @@ from tracemalloc import start
 import unittest
 import sys
 import scipy.io
+import tempfile
 sys.path.append('../')
 from fnirslib.fnirslib import *
 from fnirslib.metrics import *
+from fnirslib.recording import *
+from fnirslib.cohort import *
+from fnirslib.connectivity import *
+from fnirslib.granger import *
+from fnirslib.stream import *
+from fnirslib.cache import *
+from fnirslib.results import *
+from fnirslib.writer import *
+from fnirslib.profiling import *
+from fnirslib.preprocessing import *
+from fnirslib.mbll import *
+from fnirslib.quality import *
+from fnirslib import stats
+from fnirslib.render import Renderer, MANIFEST
+from fnirslib import topography
+from fnirslib.plots import plotData
+from fnirslib import glm
+import json
+import threading
+import pandas as pd
 
 output_dir = './test_output'
 Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -45,11 +66,41 @@ def generate_data(num_trials, num_channels, num_conditions=2, num_samples=1000,
 
     return data, stim, starts, stops
 
-class TestFnirslib(unittest.TestCase):
+class TempDirTestCase(unittest.TestCase):
+    """
+    Test case with a temporary directory shared by its tests, removed after the last one
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TempDirTestCase, cls).setUpClass()
+        cls._tmpdir = tempfile.TemporaryDirectory()
+        cls.tmpdir = cls._tmpdir.name
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmpdir.cleanup()
+        super(TempDirTestCase, cls).tearDownClass()
+
+    def mkdtemp(self):
+        """
+        New directory for a single test, removed with the shared one
+        """
+        return tempfile.mkdtemp(dir=self.tmpdir)
+
+class DataTestCase(TempDirTestCase):
+    """
+    Test case with the generated recording, saved once to <tmpdir>/test_data.nirs
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(DataTestCase, cls).setUpClass()
+        cls.data, cls.stim, cls.starts, cls.stops = generate_data(10, 46, 2, 1000, 5)
+        cls.filename = cls.tmpdir+'/test_data.nirs'
+        scipy.io.savemat(cls.filename, {'s':cls.stim, 'procResult':{'dc':cls.data}})
+
+class TestFnirslib(DataTestCase):
     def __init__(self, *args, **kwargs):
         super(TestFnirslib, self).__init__(*args, **kwargs)
-        self.data, self.stim, self.starts, self.stops = generate_data(10, 46, 2, 1000, 5)
-        self.filename  = 'test_data.nirs'
         self.regions = regions =  [[0, 1, 3, 4],   # APFC
             [2, 5, 6, 7, 8],    #MDPFC
             [14, 15, 16],   #RDPFC
@@ -61,9 +112,6 @@ class TestFnirslib(unittest.TestCase):
             [27, 34, 35, 36, 37, 38],   #M1
             [39, 40, 42, 44],   #V2-V3
             [41, 43, 45] ]  #V1
-        scipy.io.savemat(self.filename, {'s':self.stim, 'procResult':{'dc':self.data}})        
-        # print(self.data.shape)
-        # print(self.stim.shape)
 
     def test_load_data(self):
         fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1')
@@ -79,6 +127,80 @@ class TestFnirslib(unittest.TestCase):
         self.assertEqual(data.shape, (np.sum(self.stops[:10]-self.starts[:10]), 3, 46))
         print('test_get_ROI_paired passed')
 
+    def test_get_ROI_trials(self):
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1')
+        data, stims = fnirs.load_nirs()
+        trials, _ = fnirs.get_ROI(data, stims, aggMethod='trials')
+        length = np.min(self.stops[:10]-self.starts[:10])
+        self.assertEqual(trials.shape, (10, length, 3, 46))
+        for i, start in enumerate(self.starts[:10]):
+            self.assertTrue(np.array_equal(trials[i], self.data[start:start+length]))
+        mean, _ = fnirs.get_ROI(data, stims, aggMethod='mean')
+        self.assertTrue(np.allclose(mean, np.mean(trials, axis=0)))
+        padded, _ = fnirs.get_ROI(data, stims, aggMethod='trials', pre=2, post=3)
+        self.assertTrue(np.array_equal(padded[:,2:-3], trials))
+        self.assertTrue(np.array_equal(padded[:,:2], np.array([self.data[s-2:s] for s in self.starts[:10]])))
+        peak = fnirs.peak_activation(trials[:,:,0,:], peakPadding=1, trials=True)
+        self.assertEqual(peak.shape, (10, 46))
+        self.assertTrue(np.allclose(peak[3], fnirs.peak_activation(trials[3,:,0,:], peakPadding=1)))
+        self.assertTrue(np.allclose(fnirs.mean_activation(trials[:,:,0,:], trials=True)[3], np.mean(trials[3,:,0,:], axis=0)))
+        with self.assertRaises(ValueError): # samples x 3 x channels, signal type not selected
+            fnirs.mean_activation(mean)
+        print('test_get_ROI_trials passed')
+
+    def test_local_baseline(self):
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1')
+        data, stims = fnirs.load_nirs()
+        data = data + np.arange(data.shape[0])[:,None,None] # make the baseline depend on the trial
+        baseline = fnirs.get_local_baseline(data, stims, 0, duration=2, freq=4)
+        expected = np.mean([np.mean(data[max(s-7, 0):s,0,:], axis=0) for s in self.starts[:10]], axis=0) # window clipped at the start of the data
+        self.assertTrue(np.allclose(baseline, expected))
+        print('test_local_baseline passed')
+
+    def test_get_baseline(self):
+        fnirs = Fnirslib(self.filename, self.regions, 1, 'condition_2')
+        data, stims = fnirs.load_nirs()
+        data = data + np.random.rand(*data.shape)
+        perTrial = fnirs.get_baseline(data, stims, 'local', duration=2, freq=4, perTrial=True)
+        starts = np.where(stims[:,1]==1)[0][::2]
+        self.assertEqual(perTrial.shape, (10, 3, 46))
+        self.assertTrue(np.allclose(perTrial, [np.mean(data[s-7:s], axis=0) for s in starts]))
+        self.assertTrue(np.allclose(fnirs.get_baseline(data, stims, 'local', sig_type=1, duration=2, freq=4), np.mean(perTrial[:,1], axis=0)))
+        baselineStims = np.zeros((stims.shape[0], 1), dtype=stims.dtype)
+        baselineStims[[500, 600]] = 1
+        baselineStims = np.concatenate([stims, baselineStims], axis=1)
+        globalBaseline = fnirs.get_baseline(data, baselineStims, 'global', baseline_stim=2, perTrial=True)
+        self.assertEqual(globalBaseline.shape, (10, 3, 46))
+        self.assertTrue(np.allclose(globalBaseline[0], np.mean(data[500:600], axis=0)))
+        self.assertTrue(np.allclose(fnirs.get_global_baseline(data, baselineStims, 2, 0), np.mean(data[500:600,0], axis=0)))
+        trials, _ = fnirs.get_epochs(data, stims)
+        corrected = fnirs.baseline_correct(trials, perTrial)
+        self.assertTrue(np.allclose(corrected[4], trials[4] - perTrial[4]))
+        # a missing sample only drops out of its own window
+        d = np.random.rand(100, 3)
+        d[10,1] = np.nan
+        means = baseline_mod.window_means(d, [5, 20, 50, 99], [15, 30, 60, 99])
+        self.assertTrue(np.allclose(means[:3], [np.nanmean(d[5:15], axis=0), np.mean(d[20:30], axis=0), np.mean(d[50:60], axis=0)]))
+        self.assertTrue(np.all(np.isnan(means[3])))
+        print('test_get_baseline passed')
+
+    def test_cluster_channels(self):
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1')
+        data = np.random.rand(5, 20, 3, 46) # trials x samples x chromophores x channels
+        clustered = fnirs.cluster_channels(data)
+        self.assertEqual(clustered.shape, (5, 20, 3, 11))
+        for i, region in enumerate(self.regions):
+            self.assertTrue(np.allclose(clustered[...,i], np.mean(data[...,region], axis=-1)))
+            self.assertTrue(np.allclose(fnirs.cluster_channels(data[0,0,0])[i], np.mean(data[0,0,0,region])))
+        median = fnirs.cluster_channels(data, aggMethod='median')
+        self.assertTrue(np.allclose(median[...,4], np.median(data[...,self.regions[4]], axis=-1)))
+        weights = [[1]*len(region) for region in self.regions]
+        weights[0] = [1, 0, 0, 3]
+        weighted = Fnirslib(self.filename, self.regions, 0, 'condition_1', regionWeights=weights).cluster_channels(data)
+        self.assertTrue(np.allclose(weighted[...,0], (data[...,0] + 3*data[...,4])/4))
+        self.assertTrue(np.allclose(weighted[...,1:], clustered[...,1:]))
+        print('test_cluster_channels passed')
+
     def test_peak_activation_integration(self):
         fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1')
         data, stims = fnirs.load_nirs()
@@ -91,12 +213,846 @@ class TestFnirslib(unittest.TestCase):
         # TODO: test mean activation integration
         print('test_mean_activation_integration passed')
 
+    def test_load_data_mmap(self):
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1')
+        data, stims = fnirs.load_nirs(mmap=True, cacheDir=self.mkdtemp())
+        self.assertIsInstance(data, np.memmap)
+        self.assertTrue(np.array_equal(data, self.data))
+        self.assertTrue(np.array_equal(stims, self.stim))
+        roi, _ = fnirs.get_ROI(data, stims, aggMethod='concat')
+        self.assertTrue(np.array_equal(roi, fnirs.get_ROI(*fnirs.load_nirs(), aggMethod='concat')[0]))
+        print('test_load_data_mmap passed')
+
+    def test_load_data_mmap_stale(self):
+        tmpdir = self.mkdtemp()
+        filename, cacheDir = tmpdir+'/edited.nirs', tmpdir+'/cache'
+        for i in range(3): # the file is edited between the reads
+            scipy.io.savemat(filename, {'s':self.stim, 'procResult':{'dc':self.data*(i+1)}})
+            os.utime(filename, ns=(i*10**9, i*10**9))
+            data, stims = read_nirs(filename, mmap=True, cacheDir=cacheDir)
+            self.assertTrue(np.array_equal(data, self.data*(i+1)))
+            del data
+        self.assertEqual(len(list(Path(cacheDir).glob('edited-*.dc.npy'))), 1)
+        self.assertEqual(len(list(Path(cacheDir).glob('edited-*.s.npy'))), 1)
+        print('test_load_data_mmap_stale passed')
+
+    def test_load_data_hdf5(self):
+        try:
+            import h5py
+        except ImportError:
+            self.skipTest('h5py not installed')
+        filename = self.mkdtemp()+'/test_data_v73.nirs'
+        with h5py.File(filename, 'w', userblock_size=512) as f: # MATLAB v7.3 layout, arrays stored transposed
+            f['s'] = self.stim.T
+            f.create_group('procResult')['dc'] = self.data.T
+        with open(filename, 'r+b') as f:
+            f.write(b'MATLAB 7.3 MAT-file'.ljust(124) + b'\x00\x02IM')
+        fnirs = Fnirslib(filename, self.regions, 0, 'condition_1')
+        for mmap in [False, True]:
+            data, stims = fnirs.load_nirs(mmap=mmap)
+            self.assertTrue(np.array_equal(data, self.data))
+            self.assertTrue(np.array_equal(stims, self.stim))
+        self.assertIsInstance(data, np.memmap)
+        print('test_load_data_hdf5 passed')
+
+    def test_load_snirf(self):
+        try:
+            import h5py
+        except ImportError:
+            self.skipTest('h5py not installed')
+        filename = self.mkdtemp()+'/test_data.snirf'
+        freq = 4
+        with h5py.File(filename, 'w') as f:
+            nirs = f.create_group('nirs')
+            group = nirs.create_group('data1')
+            group['time'] = np.arange(self.data.shape[0])/freq
+            series = self.data.transpose(0, 2, 1).reshape(self.data.shape[0], -1) # channel major, HbO HbR HbT
+            group.create_dataset('dataTimeSeries', data=series, chunks=(100, 3))
+            for col in range(series.shape[1]):
+                ml = group.create_group('measurementList{}'.format(col+1))
+                ml['sourceIndex'] = col//3 + 1
+                ml['detectorIndex'] = 1
+                ml['dataType'] = 99999
+                ml['dataTypeLabel'] = ['HbO', 'HbR', 'HbT'][col%3]
+            for i in range(self.stim.shape[1]):
+                loc = np.where(self.stim[:,i]==1)[0]
+                stim = nirs.create_group('stim{}'.format(i+1))
+                stim['name'] = 'condition_{}'.format(i+1)
+                events = np.stack([loc[::2]/freq, (loc[1::2]-loc[::2])/freq, np.ones(loc.shape[0]//2)], axis=1)
+                stim['data'] = events if i == 0 else np.c_[events, np.zeros((events.shape[0], 2))] # extra columns are allowed
+        fnirs = Fnirslib(filename, self.regions, 0, 'condition_1')
+        data, stims = fnirs.load_snirf()
+        self.assertTrue(np.array_equal(data, self.data))
+        self.assertTrue(np.array_equal(stims, self.stim))
+        data, stims = fnirs.load_snirf(start=100, stop=300, channels=[5, 2, 40])
+        self.assertTrue(np.array_equal(data, self.data[100:300][:,:,[5, 2, 40]]))
+        self.assertTrue(np.array_equal(stims, self.stim[100:300]))
+        data, stims = Recording(filename).view(self.regions, 0, 'condition_1').load_nirs()
+        self.assertEqual(data.shape, self.data.shape)
+        print('test_load_snirf passed')
+
     def test_get_ROI_unpaired(self):
         fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1', paired=False)
         data, stims = fnirs.load_nirs()
         # TODO: test unpaired
         print('test_get_ROI_unpaired passed')
 
+class TestRecording(DataTestCase):
+    """
+    Test loading a recording once and sharing it across conditions
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestRecording, self).__init__(*args, **kwargs)
+        self.regions = [list(range(0, 23)), list(range(23, 46))]
+
+    def test_views_share_data(self):
+        recording = Recording(self.filename)
+        self.assertFalse(recording.loaded)
+        data0, stims0 = recording.view(self.regions, 0, 'condition_1').load_nirs()
+        data1, stims1 = recording.view(self.regions, 1, 'condition_2').load_nirs()
+        self.assertIs(data0, data1) # parsed only once
+        self.assertIs(stims0, stims1)
+        self.assertFalse(data0.flags.writeable)
+        print('test_views_share_data passed')
+
+    def test_view_matches_fnirslib(self):
+        recording = Recording(self.filename)
+        for stimNumber in [0, 1]:
+            fnirs = Fnirslib(self.filename, self.regions, stimNumber, 'condition')
+            data, stims = fnirs.get_ROI(*fnirs.load_nirs(), aggMethod='mean')
+            view = recording.view(self.regions, stimNumber, 'condition')
+            viewData, viewStims = view.get_ROI(*view.load_nirs(), aggMethod='mean')
+            self.assertTrue(np.array_equal(data, viewData))
+            self.assertTrue(np.array_equal(stims, viewStims))
+        self.assertTrue(np.array_equal(recording.stims, self.stim)) # shared stims left untouched
+        print('test_view_matches_fnirslib passed')
+
+class TestCohort(TempDirTestCase):
+    """
+    Test batch processing of a cohort
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TestCohort, cls).setUpClass()
+        cls.data, cls.stim, cls.starts, cls.stops = generate_data(10, 46, 2, 1000, 5)
+        cls.files = [cls.tmpdir+'/cohort_{}.nirs'.format(i) for i in range(3)]
+        for i, file in enumerate(cls.files):
+            scipy.io.savemat(file, {'s':cls.stim, 'procResult':{'dc':cls.data*(i+1)+np.random.rand(*cls.data.shape)}})
+
+    def __init__(self, *args, **kwargs):
+        super(TestCohort, self).__init__(*args, **kwargs)
+        self.regions = [[0, 1, 3, 4], [2, 5, 6, 7, 8], list(range(9, 46))]
+
+    def test_parallel_matches_serial(self):
+        files = self.files + [self.tmpdir+'/missing.nirs'] # missing file is isolated as an error
+        cohort = Cohort(files, self.regions, [0, 1], ['condition_1', 'condition_2'], freq=4)
+        serial = cohort.run(workers=1)
+        parallel = cohort.run(workers=2)
+        self.assertEqual(len(serial), 8)
+        self.assertEqual([(r['ID'], r['condition']) for r in serial], [(r['ID'], r['condition']) for r in parallel])
+        self.assertEqual(len(parallel.errors), 2)
+        for feature in ['peak', 'meanClust', 'corr']:
+            ids, stacked = parallel.stack(feature, 'condition_1')
+            self.assertEqual(ids, ['cohort_0', 'cohort_1', 'cohort_2'])
+            self.assertTrue(np.array_equal(stacked, serial.stack(feature, 'condition_1')[1], equal_nan=True))
+        print('test_parallel_matches_serial passed')
+
+class TestCache(DataTestCase):
+    """
+    Test the on-disk cache of intermediate results
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestCache, self).__init__(*args, **kwargs)
+        self.regions = [[0, 1, 3, 4], [2, 5, 6, 7, 8], list(range(9, 46))]
+
+    def pipeline(self, cache, stimNumber=0):
+        fnirs = Fnirslib(self.filename, self.regions, stimNumber, 'condition', cache=cache)
+        data, stims = fnirs.load_nirs()
+        baseline = fnirs.get_local_baseline(data, stims, 0, duration=2, freq=4)
+        data, stims = fnirs.get_ROI(data, stims, aggMethod='concat')
+        data = fnirs.cluster_channels(fnirs.detrend(data))
+        return data, stims, baseline
+
+    def test_rerun_hits(self):
+        expected = self.pipeline(None)
+        directory = self.tmpdir+'/cache'
+        cache = Cache(directory)
+        first = self.pipeline(cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 5))
+        cache = Cache(directory) # a rerun in a new process
+        second = self.pipeline(cache)
+        self.assertEqual((cache.hits, cache.misses), (5, 0))
+        for a, b, c in zip(expected, first, second):
+            self.assertTrue(np.array_equal(a, b))
+            self.assertTrue(np.array_equal(a, c))
+        self.assertTrue(second[0].flags.writeable) # same as without a cache
+        key = cache.digest(second[0])
+        second[0][0] += 1 # modified in place, the remembered key no longer holds
+        self.assertNotEqual(cache.digest(second[0]), key)
+        # a different stimulus only reuses the loaded file
+        cache = Cache(directory)
+        self.pipeline(cache, stimNumber=1)
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        print('test_rerun_hits passed')
+
+    def test_derived_keys(self):
+        cache = Cache(self.tmpdir+'/derived')
+        recording = Recording(self.filename, cache=cache, dtype=np.float32)
+        fnirs = recording.view(self.regions, 0, 'condition')
+        fnirs.channelMask = np.arange(46) != 2
+        data, stims = fnirs.load_nirs()
+        masked = fnirs.mask_channels(data)
+        for arr in [data, stims, masked]: # converted and masked arrays carry their key to the next stage
+            entry = cache._lineage.get(id(arr))
+            self.assertTrue(entry is not None and entry[0]() is arr)
+        # a rerun derives the same key
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition', cache=Cache(self.tmpdir+'/derived'), dtype=np.float32)
+        self.assertEqual(fnirs.cache.digest(fnirs.load_nirs()[0]), cache.digest(data))
+        print('test_derived_keys passed')
+
+    def test_eviction(self):
+        cache = Cache(self.tmpdir+'/small', maxBytes=3*8*1000+2000)
+        for i in range(5):
+            cache.memoize('stage', [np.arange(i, i+3)], {}, lambda: np.zeros(1000))
+        size = sum(f.stat().st_size for f in Path(cache.directory).glob('*/*.npz'))
+        self.assertLessEqual(size, cache.maxBytes)
+        self.assertEqual(cache._bytes, size) # running size, the directory is only scanned when full
+        self.assertEqual(cache.misses, 5)
+        cache.memoize('stage', [np.arange(4, 7)], {}, lambda: np.zeros(1000)) # most recent entry is kept
+        self.assertEqual(cache.hits, 1)
+        print('test_eviction passed')
+
+    def test_cohort(self):
+        files = [self.filename]
+        cohort = Cohort(files, self.regions, [0, 1], ['condition_1', 'condition_2'], freq=4)
+        expected = cohort.run(workers=1)
+        cohort.cache = Cache(self.tmpdir+'/cohort')
+        for workers in [2, 2]:
+            results = cohort.run(workers=workers)
+            for feature in ['peak', 'meanClust', 'corr']:
+                self.assertTrue(np.array_equal(results.stack(feature)[1], expected.stack(feature)[1], equal_nan=True))
+        print('test_cohort passed')
+
+class TestResults(TempDirTestCase):
+    """
+    Test the columnar store of per-subject results
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestResults, self).__init__(*args, **kwargs)
+        self.columns = {'peakAct': ['C0', 'C1', 'C2'], 'funcCon': ['A-B']}
+        np.random.seed(3)
+        self.rows = [('S{}'.format(i), 'MF'[i%2], 'condition_{}'.format(i%3), np.random.rand(3)) for i in range(40)]
+
+    def expected(self, rows):
+        return pd.DataFrame([[ID, sex, condition]+list(values) for ID, sex, condition, values in rows],
+                            columns=['ID', 'sex', 'condition']+self.columns['peakAct'])
+
+    def test_append_flush(self):
+        tmpdir = self.mkdtemp()
+        store = ResultStore(self.columns, directory=tmpdir, flushEvery=7, chunkSize=3)
+        for ID, sex, condition, values in self.rows:
+            store.append('peakAct', values, ID, sex, condition)
+            store.append('funcCon', values[:1], ID, sex, condition)
+        self.assertEqual(len(list(Path(tmpdir).glob('peakAct-*.npz'))), 5) # rows are written as they come in
+        pd.testing.assert_frame_equal(store.frame('peakAct'), self.expected(self.rows))
+        store.flush()
+        reopened = ResultStore(self.columns, directory=tmpdir) # after a crash, flushed rows are kept
+        pd.testing.assert_frame_equal(reopened.frame('peakAct'), self.expected(self.rows))
+        self.assertEqual(reopened.arrays('funcCon')[1].shape, (40, 1))
+        store.to_csv(tmpdir)
+        pd.testing.assert_frame_equal(pd.read_csv(tmpdir+'/peakAct.csv'), self.expected(self.rows))
+        with self.assertRaises(ValueError):
+            store.append('funcCon', np.zeros(2), 'S0', 'M', 'condition_0')
+        print('test_append_flush passed')
+
+    def test_parallel_writers(self):
+        tmpdir = self.mkdtemp()
+        shared = ResultStore(self.columns, directory=tmpdir, flushEvery=4, prefix='threads-')
+        threads = [threading.Thread(target=lambda rows: [shared.append('peakAct', v, ID, sex, c) for ID, sex, c, v in rows],
+                                    args=(self.rows[i::4],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        shared.flush()
+        other = ResultStore(self.columns, directory=tmpdir, prefix='worker1-') # e.g. another process
+        other.append('peakAct', np.ones(3), 'S40', 'M', 'condition_0')
+        other.flush()
+        meta, values = shared.arrays('peakAct')
+        self.assertEqual(values.shape, (41, 3))
+        order = np.argsort([int(ID[1:]) for ID in meta['ID']])
+        self.assertTrue(np.array_equal(values[order][:40], np.stack([r[3] for r in self.rows])))
+        print('test_parallel_writers passed')
+
+class TestWriter(DataTestCase):
+    """
+    Test the batched processed data writer
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestWriter, self).__init__(*args, **kwargs)
+        self.regions = [list(range(0, 23)), list(range(23, 46))]
+
+    def processed(self, directory, writer):
+        fnirs = {}
+        for i in range(3):
+            filename = directory+'/subject_{}.nirs'.format(i)
+            scipy.io.savemat(filename, {'s':self.stim, 'procResult':{'dc':self.data*(i+1)}})
+            for stimNumber, condition in enumerate(['condition_1', 'condition_2']):
+                f = Fnirslib(filename, self.regions, stimNumber, condition)
+                data, stims = f.get_ROI(*f.load_nirs(), aggMethod='mean')
+                f.save_processed_data(data, stims, directory+'/processed', writer=writer)
+                fnirs[('subject_{}'.format(i), condition)] = data
+        if writer is not None:
+            writer.close()
+        return fnirs
+
+    def test_formats(self):
+        tmpdir = self.mkdtemp()
+        expected = self.processed(tmpdir, None) # .mat files
+        mat = scipy.io.loadmat(tmpdir+'/processed/condition_1/subject_0.mat')
+        self.assertTrue(np.array_equal(mat['pdata'], expected[('subject_0', 'condition_1')]))
+        self.assertEqual(mat['nTrials'][0][0], 10)
+        self.processed(tmpdir, ProcessedDataWriter(tmpdir+'/npz', format='npz'))
+        self.processed(tmpdir, ProcessedDataWriter(tmpdir+'/mat', format='mat'))
+        for (subject, condition), data in expected.items():
+            with np.load(tmpdir+'/npz/{}.npz'.format(condition)) as npz:
+                self.assertTrue(np.array_equal(npz[subject+'/pdata'], data))
+            mat = scipy.io.loadmat(tmpdir+'/mat/{}/{}.mat'.format(condition, subject))
+            self.assertTrue(np.array_equal(mat['pdata'], data))
+        print('test_formats passed')
+
+    def test_format_hdf5(self):
+        try:
+            import h5py
+        except ImportError:
+            self.skipTest('h5py not installed')
+        tmpdir = self.mkdtemp()
+        expected = self.processed(tmpdir, ProcessedDataWriter(tmpdir+'/hdf5'))
+        for (subject, condition), data in expected.items():
+            with h5py.File(tmpdir+'/hdf5/{}.h5'.format(condition), 'r') as f:
+                self.assertTrue(np.array_equal(f[subject]['pdata'][()], data))
+                self.assertEqual(f[subject].attrs['nTrials'], 10)
+        print('test_format_hdf5 passed')
+
+    def test_rewrite(self):
+        tmpdir = self.mkdtemp()
+        with ProcessedDataWriter(tmpdir, format='npz') as writer:
+            writer.write('condition', 's1', np.ones(3), 1)
+            writer.write('condition', 's1', np.zeros(4), 2) # processed again, replaces the first copy
+        with ProcessedDataWriter(tmpdir, format='npz') as writer: # a later run keeps the earlier subjects
+            writer.write('condition', 's2', np.ones(2), 3)
+        with np.load(tmpdir+'/condition.npz') as npz:
+            self.assertEqual(sorted(npz.files), ['s1/nTrials', 's1/pdata', 's2/nTrials', 's2/pdata'])
+            self.assertTrue(np.array_equal(npz['s1/pdata'], np.zeros(4)) and npz['s1/nTrials'] == 2)
+        print('test_rewrite passed')
+
+    def test_error_reported(self):
+        writer = ProcessedDataWriter(self.mkdtemp(), format='npz')
+        writer.write('condition', 'subject', np.zeros(3), 1)
+        writer.write('condition', 'other', np.array([object()]), 1) # fails in the writer thread
+        with self.assertRaises(Exception):
+            writer.close()
+        with self.assertRaises(ValueError):
+            writer.write('condition', 'subject', np.zeros(3), 1)
+        print('test_error_reported passed')
+
+class TestProfiling(DataTestCase):
+    """
+    Test the stage instrumentation
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestProfiling, self).__init__(*args, **kwargs)
+        self.regions = [list(range(0, 23)), list(range(23, 46))]
+
+    def pipeline(self):
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition')
+        data, stims = fnirs.load_nirs()
+        fnirs.sanity_check(data, stims)
+        data, stims = fnirs.get_ROI(data, stims, aggMethod='mean')
+        return fnirs.peak_activation(data[:,0,:], peakPadding=2)
+
+    def test_profiler(self):
+        expected = self.pipeline() # disabled, nothing is recorded
+        with Profiler() as profiler:
+            peak = self.pipeline()
+        self.pipeline()
+        self.assertTrue(np.array_equal(peak, expected))
+        summary = profiler.summary()
+        for stage in ['Fnirslib.load_nirs', 'Fnirslib.get_ROI', 'Fnirslib.get_epochs', 'Metrics.get_peak_activation']:
+            self.assertEqual(summary[stage]['calls'], 1)
+        # get_ROI includes get_epochs
+        self.assertGreaterEqual(summary['Fnirslib.get_ROI']['total'], summary['Fnirslib.get_epochs']['total'])
+        self.assertGreaterEqual(summary['Fnirslib.get_ROI']['peakBytes'], summary['Fnirslib.get_epochs']['peakBytes'])
+        self.assertGreater(summary['Fnirslib.get_epochs']['peakBytes'], 0)
+        self.assertEqual(summary['Fnirslib.get_ROI']['inputBytes'], self.data.nbytes + self.stim.astype(np.int64).nbytes)
+        self.assertIn('Fnirslib.sanity_check', profiler.table())
+        profiler.save_trace(self.tmpdir+'/trace.json')
+        with open(self.tmpdir+'/trace.json') as f:
+            self.assertEqual(len(json.load(f)['traceEvents']), len(profiler.events))
+        print('test_profiler passed')
+
+    def test_cohort_profile(self):
+        cohort = Cohort([self.filename]*2, self.regions, [0, 1], ['condition_1', 'condition_2'], freq=4)
+        profiler = Profiler(memory=False)
+        cohort.run(workers=2, profiler=profiler)
+        summary = profiler.summary()
+        self.assertEqual(summary['Fnirslib.get_ROI']['calls'], 8)
+        self.assertIsNone(summary['Fnirslib.get_ROI']['peakBytes'])
+        print('test_cohort_profile passed')
+
+class TestPreprocessing(unittest.TestCase):
+    """
+    Test the preprocessing chain
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestPreprocessing, self).__init__(*args, **kwargs)
+        rng = np.random.default_rng(0)
+        self.freq = 10
+        t = np.arange(3000)/self.freq
+        self.clean = np.sin(2*np.pi*0.05*t)[:,None,None] + 0.05*rng.normal(size=(3000, 3, 8))
+        self.data = self.clean.copy()
+        self.data[1000:1020,0,2] += 8*np.hanning(20) # spike
+        self.data[2000:,0,2] += 5 # baseline shift
+
+    def test_detrend(self):
+        x = self.data + 0.01*np.arange(3000)[:,None,None]
+        self.assertTrue(np.allclose(polynomial_detrend(x), scipy.signal.detrend(x, axis=0)))
+        self.assertTrue(np.allclose(polynomial_detrend(x, order=0), x-np.mean(x, axis=0)))
+        standardized = zscore(x.astype(np.float32)) # float32 data stay float32
+        self.assertEqual(standardized.dtype, np.float32)
+        self.assertTrue(np.allclose(standardized, (x-np.mean(x, axis=0))/np.std(x, axis=0), atol=1e-5))
+        print('test_detrend passed')
+
+    def test_motion_correction(self):
+        mask = detect_motion(self.data, self.freq)
+        self.assertTrue(mask[1005,0,2] and mask[2000,0,2])
+        self.assertEqual(np.count_nonzero(np.delete(mask.reshape(3000, -1), 2, axis=1)), 0) # clean channels untouched
+        corrected = spline_correction(self.data, mask, self.freq)
+        error = np.abs(corrected[:,0,2]-self.clean[:,0,2])
+        self.assertLess(np.max(error[1000:]), 0.5*np.max(np.abs(self.data[1000:,0,2]-self.clean[1000:,0,2])))
+        self.assertTrue(np.array_equal(np.delete(corrected, 2, axis=2), np.delete(self.data, 2, axis=2)))
+        print('test_motion_correction passed')
+
+    def test_chain(self):
+        steps = [('motion', {}), ('bandpass', {'band': (0.01, 0.5)}), ('detrend', {'order': 1})]
+        original = self.data.copy()
+        fnirs = Fnirslib('data.nirs', [list(range(8))], 0, 'condition')
+        out = fnirs.preprocess(self.data, self.freq, steps)
+        self.assertTrue(np.array_equal(self.data, original)) # input untouched
+        expected = spline_correction(self.data, detect_motion(self.data, self.freq), self.freq)
+        expected = scipy.signal.sosfiltfilt(scipy.signal.butter(3, [0.01, 0.5], btype='bandpass', fs=self.freq, output='sos'), expected, axis=0)
+        expected = scipy.signal.detrend(expected, axis=0)
+        self.assertTrue(np.allclose(out, expected))
+        hits = filter_sos.cache_info().hits
+        fnirs.preprocess(self.data, self.freq, steps)
+        self.assertEqual(filter_sos.cache_info().hits, hits+1) # coefficients are reused
+        with self.assertRaises(ValueError):
+            fnirs.preprocess(self.data, self.freq, [('wavelet', {})])
+        print('test_chain passed')
+
+class TestMBLL(TempDirTestCase):
+    """
+    Test the raw intensity to concentration conversion
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TestMBLL, cls).setUpClass()
+        cls.data, cls.stim, cls.starts, cls.stops = generate_data(10, 4, 2, 1000, 5)
+        cls.conc = cls.data[:,:2]*1e-6 + np.random.rand(1000, 2, 4)*1e-7 # HbO, HbR in M
+        # 2 sources, 3 detectors, channels measured at 760 and 850 nm, positions in cm
+        cls.SD = {'Lambda': np.array([760., 850.]), 'SpatialUnit': 'cm',
+                  'SrcPos': np.array([[0., 0, 0], [6, 0, 0]]), 'DetPos': np.array([[3., 0, 0], [0, 3, 0], [6, 3.5, 0]]),
+                  'MeasList': np.array([[1, 1, 1, w] for w in [1, 2]] + [[2, 1, 1, w] for w in [1, 2]] +
+                                       [[1, 2, 1, w] for w in [1, 2]] + [[2, 3, 1, w] for w in [1, 2]])}
+        coef, _ = extinction_coefficients((760., 850.))
+        distances = np.array([30., 30., 30., 35.])
+        cls.d = np.empty((1000, 8))
+        for i, (src, det, _, w) in enumerate(cls.SD['MeasList']):
+            channel = [(1, 1), (2, 1), (1, 2), (2, 3)].index((src, det))
+            od = cls.conc[:,:,channel] @ coef[w-1] * distances[channel] * 6
+            cls.d[:,i] = 1e4*np.exp(-od)
+        cls.filename = cls.tmpdir+'/raw.nirs'
+        scipy.io.savemat(cls.filename, {'d': cls.d, 'SD': cls.SD, 's': cls.stim})
+
+    def test_raw_to_conc(self):
+        pairs, index = channels(self.SD['MeasList'])
+        self.assertTrue(np.array_equal(pairs, [[1, 1], [2, 1], [1, 2], [2, 3]]))
+        self.assertTrue(np.array_equal(index, [[0, 2, 4, 6], [1, 3, 5, 7]]))
+        fnirs = Fnirslib(self.filename, [[0, 1], [2, 3]], 0, 'condition')
+        data, stims = fnirs.load_raw_nirs()
+        fnirs.sanity_check(data, stims)
+        self.assertEqual(data.shape, (1000, 3, 4))
+        # changes are relative to the mean intensity, compare without the mean
+        self.assertTrue(np.allclose(data[:,:2]-np.mean(data[:,:2], axis=0), self.conc-np.mean(self.conc, axis=0), atol=1e-12))
+        self.assertTrue(np.allclose(data[:,2], data[:,0]+data[:,1]))
+        viewData, _ = Recording(self.filename, raw=True).view([[0, 1], [2, 3]], 0, 'condition').load_raw_nirs()
+        self.assertTrue(np.array_equal(viewData, data))
+        print('test_raw_to_conc passed')
+
+    def test_extinction(self):
+        coef, pinv = extinction_coefficients((690., 830.))
+        self.assertTrue(np.allclose(coef[0], np.array([276., 2051.96])*np.log(10)/10))
+        self.assertTrue(np.allclose(pinv @ coef, np.eye(2)))
+        self.assertIs(extinction_coefficients((690., 830.))[0], coef) # computed once per wavelength set
+        with self.assertRaises(ValueError):
+            extinction_coefficients((600., 830.))
+        print('test_extinction passed')
+
+class TestQuality(unittest.TestCase):
+    """
+    Test the channel quality metrics and the mask-aware metrics
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestQuality, self).__init__(*args, **kwargs)
+        np.random.seed(3)
+        self.freq = 10
+        t = np.arange(3000)/self.freq
+        pulse = np.sin(2*np.pi*1.2*t) # cardiac pulsation, common to both wavelengths of a coupled channel
+        self.raw = 1e4 + 50*pulse[:,None,None] + np.random.rand(3000, 2, 5)
+        self.raw[:,1,1] = 1e4 + 50*np.random.randn(3000) # poor coupling, no common pulsation
+        self.raw[:,:,2] = np.minimum(self.raw[:,:,2], 1e4) # clipped at the detector range
+        self.raw[:,0,3] *= 1 + 0.5*np.sin(2*np.pi*0.05*t) # large intensity swings
+        self.data = np.random.rand(3000, 3, 5)
+        self.data[:1000,:,4] = np.nan # channel 4 missing for a third of the recording
+
+    def test_channel_metrics(self):
+        metrics, mask = assess(self.data, freq=self.freq, raw=self.raw)
+        self.assertTrue(metrics['sci'][0] > 0.9 and metrics['sci'][1] < 0.5)
+        self.assertTrue(metrics['saturation'][2] > 0.4 and metrics['saturation'][0] < 0.01)
+        self.assertTrue(metrics['cv'][3] > 15 and metrics['cv'][0] < 1)
+        self.assertAlmostEqual(metrics['nan'][4], 1/3)
+        self.assertTrue(np.array_equal(mask, [True, False, False, False, False]))
+        # without raw intensity only the concentration metrics are used
+        data = self.data.copy()
+        data[:,:,1] = 1
+        metrics, mask = assess(data)
+        self.assertTrue(np.all(np.isnan(metrics['sci'])))
+        self.assertTrue(metrics['flat'][1])
+        self.assertTrue(np.array_equal(mask, [True, False, True, True, False]))
+        print('test_channel_metrics passed')
+
+    def test_mask_aware_metrics(self):
+        regions = [[0, 1], [2, 3, 4]]
+        fnirs = Fnirslib('', regions, 0, 'condition')
+        _, mask = fnirs.channel_quality(self.data, freq=self.freq)
+        self.assertTrue(np.array_equal(mask, [True, True, True, True, False]))
+        data = fnirs.mask_channels(self.data)
+        self.assertTrue(np.all(np.isnan(data[:,:,4])) and not np.any(np.isnan(data[:,:,:4])))
+        mean = fnirs.mean_activation(data[:,0])
+        self.assertTrue(np.allclose(mean[:4], np.mean(self.data[:,0,:4], axis=0)) and np.isnan(mean[4]))
+        peak = fnirs.peak_activation(data[:,0], peakPadding=2)
+        self.assertTrue(np.all(np.isfinite(peak[:4])) and np.isnan(peak[4]))
+        # bad channels are left out of their region, on masked and on unmasked data
+        expected = np.mean(self.data[:,:,2:4], axis=-1)
+        self.assertTrue(np.allclose(fnirs.cluster_channels(data)[...,1], expected))
+        self.assertTrue(np.allclose(fnirs.cluster_channels(self.data)[...,1], expected))
+        self.assertTrue(np.allclose(fnirs.cluster_channels(data, aggMethod='median')[...,1], np.median(self.data[:,:,2:4], axis=-1)))
+        # NaN samples are left out of the clustering and connectivity, identical regions give finite z-scores
+        partial = self.data[:,0].copy()
+        partial[:10,0] = np.nan
+        clustered = Fnirslib('', regions, 0, 'condition').cluster_channels(partial)
+        self.assertTrue(np.allclose(clustered[:10,0], partial[:10,1]))
+        corr, zscores = fnirs.functional_connectivity(np.stack([clustered[:,0], clustered[:,0], data[:,0,4]]))
+        self.assertAlmostEqual(corr[0,1], 1)
+        self.assertTrue(np.isfinite(zscores[0,1]) and np.all(np.isnan(corr[2])))
+        print('test_mask_aware_metrics passed')
+
+class TestStats(unittest.TestCase):
+    """
+    Test the group statistics
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestStats, self).__init__(*args, **kwargs)
+        rng = np.random.default_rng(7)
+        self.a = rng.standard_normal((40, 10)) # subjects x edges of 5 regions
+        self.b = rng.standard_normal((40, 10))
+        self.b[:,:2] += 1.5 # edges 0-1, 0-2 differ between the conditions
+
+    def test_ttest_fdr(self):
+        for args, expected in [((self.a, self.b, True), scipy.stats.ttest_rel(self.a, self.b)),
+                               ((self.a, self.b, False), scipy.stats.ttest_ind(self.a, self.b)),
+                               ((self.a, None, False), scipy.stats.ttest_1samp(self.a, 0))]:
+            t, p = stats.ttest(*args)
+            self.assertTrue(np.allclose(t, expected.statistic) and np.allclose(p, expected.pvalue))
+        a = self.a.copy()
+        a[0,3] = np.nan # missing values are left out
+        self.assertAlmostEqual(stats.ttest(a)[0][3], scipy.stats.ttest_1samp(self.a[1:,3], 0).statistic)
+        p = np.array([0.01, 0.04, 0.03, 0.2, np.nan])
+        significant, adjusted = stats.fdr(p)
+        self.assertTrue(np.allclose(adjusted[:4], scipy.stats.false_discovery_control(p[:4])) and np.isnan(adjusted[4]))
+        self.assertTrue(np.array_equal(significant, [True, False, False, False, False]))
+        print('test_ttest_fdr passed')
+
+    def test_permutation_test(self):
+        for paired in [True, False]:
+            t, p, pFWE = stats.permutation_test(self.a, self.b, paired=paired, nPermutations=2000, chunkSize=300)
+            self.assertTrue(np.allclose(t, stats.ttest(self.a, self.b, paired=paired)[0]))
+            self.assertTrue(np.all(pFWE[:2] < 0.01) and np.all(pFWE[2:] > 0.05))
+            self.assertTrue(np.all(pFWE >= p))
+        # chunks are seeded independently of the number of workers
+        serial = stats.permutation_test(self.a, self.b, paired=True, nPermutations=1000, chunkSize=300, seed=3)
+        parallel = stats.permutation_test(self.a, self.b, paired=True, nPermutations=1000, chunkSize=300, seed=3, workers=2)
+        self.assertTrue(all(np.array_equal(s, p) for s, p in zip(serial, parallel)))
+        print('test_permutation_test passed')
+
+    def test_nbs(self):
+        matrices = np.zeros((40, 5, 5))
+        rows, cols = np.triu_indices(5, 1)
+        matrices[:, rows, cols] = self.b
+        self.assertTrue(np.array_equal(stats.edges(matrices), self.b))
+        network = stats.nbs(self.a, matrices, paired=True, threshold=3.0, nPermutations=2000)
+        self.assertTrue(np.array_equal(network['component'][:2], [0, 0]) and np.all(network['component'][2:] == -1))
+        self.assertTrue(np.array_equal(network['size'], [2]) and network['p'][0] < 0.01)
+        ids, a, b = stats.pair_subjects(['s1', 's2', 's3'], self.a[:3], ['s3', 's1'], self.b[:2])
+        self.assertEqual(ids, ['s1', 's3'])
+        self.assertTrue(np.array_equal(a, self.a[[0, 2]]) and np.array_equal(b, self.b[[1, 0]]))
+        print('test_nbs passed')
+
+class TestRender(TempDirTestCase):
+    """
+    Test the figure rendering
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestRender, self).__init__(*args, **kwargs)
+        np.random.seed(2)
+        self.labels = ['A', 'B', 'C', 'D']
+        self.corr = [np.random.rand(4, 4) for _ in range(3)]
+
+    def test_render_skips_unchanged(self):
+        directory = self.mkdtemp()
+        renderer = Renderer(directory, dpi=50)
+        for kind in ['matrix', 'circle']:
+            path = renderer.render(kind, self.corr[0], self.labels, kind+'.png', title='FC')
+            self.assertTrue(path.exists())
+        renderer.render('matrix', self.corr[0], self.labels, 'matrix.png', title='FC')
+        self.assertEqual((renderer.rendered, renderer.skipped), (2, 1))
+        renderer.render('matrix', self.corr[1], self.labels, 'matrix.png', title='FC') # new data, template reused
+        # the keys are kept in the directory, a new renderer skips the unchanged figures
+        renderer = Renderer(directory, dpi=50)
+        renderer.render('circle', self.corr[0], self.labels, 'circle.png', title='FC')
+        renderer.render('matrix', self.corr[1], self.labels, 'matrix.png', title='FC')
+        self.assertEqual((renderer.rendered, renderer.skipped), (0, 2))
+        renderer = Renderer(directory, dpi=50, colormap='jet') # the style is part of the key
+        renderer.render('matrix', self.corr[1], self.labels, 'matrix.png', title='FC')
+        self.assertEqual(renderer.rendered, 1)
+        print('test_render_skips_unchanged passed')
+
+    def test_render_batch(self):
+        directory = self.mkdtemp()
+        jobs = [{'kind': kind, 'data': corr, 'labels': self.labels, 'filename': '{}_{}.png'.format(kind, i)}
+                for i, corr in enumerate(self.corr) for kind in ['matrix', 'circle']]
+        renderer = Renderer(directory, dpi=50)
+        paths = renderer.render_batch(jobs, workers=2)
+        self.assertTrue(all(path.exists() for path in paths))
+        self.assertEqual(Renderer(directory, dpi=50).render_batch(jobs[:1]+[dict(jobs[1], data=self.corr[2])], workers=1), paths[:2])
+        plot = plotData(self.corr[0], self.labels, directory+'/', dpi=50, title='FC', filename='FC.png')
+        self.assertTrue(plot.matrixPlot().exists() and plot.circularPlot().exists())
+        print('test_render_batch passed')
+
+    def test_topography(self):
+        positions = np.random.rand(12, 2)
+        matrix, inside, shape, extent = topography.interpolation_matrix(positions, 32)
+        self.assertIs(topography.interpolation_matrix(positions.copy(), 32)[0], matrix) # computed once per montage
+        self.assertEqual(matrix.shape, (shape[0]*shape[1], 12))
+        self.assertTrue(np.allclose(matrix.sum(axis=1).A1[inside], 1)) # barycentric weights
+        # linear values are reproduced inside the montage, for one or many maps
+        image = topography.interpolate(np.stack([positions[:,0], 2*positions[:,1]]), positions, 32)
+        step = (extent[1]-extent[0])/shape[1]
+        rows, cols = np.nonzero(inside.reshape(shape))
+        self.assertTrue(np.allclose(image[0][rows, cols], extent[0]+step*(cols+0.5)))
+        self.assertTrue(np.allclose(image[1][rows, cols], 2*(extent[2]+step*(rows+0.5))))
+        self.assertTrue(np.all(np.isnan(image[0][~inside.reshape(shape)])))
+        values = np.ones(12)
+        values[3] = np.nan # missing channels are left out
+        self.assertTrue(np.allclose(topography.interpolate(values, positions, 32)[inside.reshape(shape)], 1))
+        # channel positions from the probe, regions at the mean of their channels
+        SD = {'MeasList': np.array([[1, 1, 1, 1], [1, 1, 1, 2], [1, 2, 1, 1], [1, 2, 1, 2]]),
+              'SrcPos': np.array([[0., 0, 0]]), 'DetPos': np.array([[3., 0, 0], [0, 3, 0]])}
+        channelPositions = topography.channel_positions(SD)
+        self.assertAlmostEqual(np.linalg.norm(channelPositions[0]-channelPositions[1]), np.sqrt(2)*1.5) # flat probe, distances kept
+        self.assertTrue(np.allclose(topography.region_positions(positions, [[0, 1], [2]]), [positions[:2].mean(axis=0), positions[2]]))
+        directory = self.mkdtemp()+'/'
+        plot = plotData(np.random.rand(5, 12), [str(i) for i in range(12)], directory, dpi=50, filename='topo.png', positions=positions)
+        frames = plot.topograph()
+        self.assertEqual(len(frames), 5)
+        self.assertTrue(all(frame.exists() for frame in frames))
+        with open(directory+MANIFEST) as f:
+            self.assertEqual(sorted(json.load(f)), sorted(frame.name for frame in frames))
+        plot = plotData(self.corr[0], self.labels, directory, dpi=50, filename='FC.png', positions=np.random.rand(4, 2))
+        self.assertTrue(plot.connectome().exists() and plot.connectome_directed().exists())
+        print('test_topography passed')
+
+class TestGLM(unittest.TestCase):
+    """
+    Test the design matrices and the batched GLM fit
+    """
+    def __init__(self, *args, **kwargs):
+        super(TestGLM, self).__init__(*args, **kwargs)
+        np.random.seed(4)
+        self.freq = 10
+        self.stims = np.zeros((6000, 3))
+        starts = np.arange(200, 5600, 400)
+        self.stims[starts, 1] = 1
+        self.stims[starts+100, 1] = 1 # 10 s trials
+        self.stims[starts+250, 2] = 1 # unpaired, 5 s trials
+
+    def test_hrf_betas(self):
+        X, names = glm.design_matrix(self.stims, self.freq, [1])
+        self.assertEqual(names, ['stim1', 'drift0', 'drift1'])
+        amplitude = np.linspace(0, 2, 8)
+        data = X[:,:1,None]*amplitude + 5 + 0.01*np.arange(6000)[:,None,None]/6000 + 0.1*np.random.randn(6000, 3, 8)
+        data[100,2,7] = np.nan
+        betas, tstats, dof = glm.fit(data, X)
+        self.assertEqual(betas.shape, (3, 3, 8))
+        self.assertEqual(dof, 6000 - 3)
+        self.assertTrue(np.allclose(betas[0,:,:7], amplitude[:7], atol=0.05))
+        self.assertTrue(np.all(np.isnan(betas[:,2,7])) and np.all(np.isnan(tstats[:,2,7])))
+        self.assertFalse(np.any(np.isnan(betas[:,:2,7])))
+        self.assertTrue(tstats[0,0,7] > 10 and abs(tstats[0,0,0]) < 5)
+        # same betas and t-statistics as separate least squares fits
+        y = data[:,0,:]
+        reference = np.linalg.lstsq(X, y, rcond=None)[0]
+        sigma = np.sqrt(np.sum((y - X @ reference)**2, axis=0)/dof)
+        self.assertTrue(np.allclose(betas[:,0,:], reference))
+        self.assertTrue(np.allclose(tstats[:,0,:], reference / (np.sqrt(np.diag(np.linalg.inv(X.T @ X)))[:,None]*sigma)))
+        # large offsets relative to the noise do not cancel in the residuals
+        y = 1e6 + 1e-2*X[:,:1] + 1e-3*np.random.randn(6000, 3)
+        reference = np.linalg.lstsq(X, y - 1e6, rcond=None)[0]
+        sigma = np.sqrt(np.sum((y - 1e6 - X @ reference)**2, axis=0)/dof)
+        tstats = glm.fit(y, X)[1]
+        self.assertTrue(np.allclose(tstats[0], reference[0] / (np.sqrt(np.linalg.inv(X.T @ X)[0,0])*sigma), rtol=1e-3))
+        print('test_hrf_betas passed')
+
+    def test_fir_and_contrasts(self):
+        X, names = glm.design_matrix(self.stims, self.freq, [1, 2], trialTimes=5, paired=False, basis='fir',
+                                     firDuration=10, firBin=2, driftMethod='dct')
+        self.assertEqual(names[:6], ['stim1_bin0', 'stim1_bin1', 'stim1_bin2', 'stim1_bin3', 'stim1_bin4', 'stim2_bin0'])
+        response = np.array([0, 1, 2, 1, 0])
+        onsets = np.flatnonzero(self.stims[:,1])
+        data = np.random.randn(6000, 4)*0.1
+        for onset in onsets:
+            data[onset:onset+100] += np.repeat(response, 20)[:,None]
+        betas, tstats, _ = glm.fit(data, X, contrasts=[[0, 0, 1, 0, 0, 0, 0, 0, 0, 0] + [0]*(X.shape[1]-10)])
+        self.assertTrue(np.allclose(betas[:5], response[:,None], atol=0.05))
+        self.assertTrue(np.allclose(betas[5:10], 0, atol=0.05))
+        self.assertEqual(tstats.shape, (1, 4))
+        self.assertTrue(np.all(tstats > 50))
+        # unpaired trials end after trialTimes
+        start, end = glm.trial_bounds(self.stims, 2, paired=False, trialTimes=5, freq=self.freq)
+        self.assertTrue(np.array_equal(end - start, np.full(start.shape, 50)))
+        print('test_fir_and_contrasts passed')
+
+    def test_fnirslib_glm(self):
+        fnirs = Fnirslib('unused.nirs', [[0, 1], [2]], 1, 'condition_1')
+        X, _ = glm.design_matrix(self.stims, self.freq, [1])
+        data = X[:,0,None,None]*np.ones((1, 3, 3)) + 0.1*np.random.randn(6000, 3, 3)
+        betas, tstats, names = fnirs.glm(data, self.stims, self.freq)
+        self.assertEqual(names[0], 'stim1')
+        self.assertTrue(np.allclose(betas[0], 1, atol=0.05))
+        print('test_fnirslib_glm passed')
+
+class TestPrecision(TempDirTestCase):
+    """
+    Test the float32 data path against the float64 one
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TestPrecision, cls).setUpClass()
+        cls.data, cls.stim, _, _ = generate_data(10, 46, 2, 1000, 5)
+        cls.data = 10 + cls.data + 1e-3*np.arange(cls.data.shape[0])[:,None,None] + np.random.randn(*cls.data.shape) # offset, drift and noise
+        cls.filename = cls.tmpdir + '/precision.nirs'
+        scipy.io.savemat(cls.filename, {'s': cls.stim, 'procResult': {'dc': cls.data}})
+
+    def __init__(self, *args, **kwargs):
+        super(TestPrecision, self).__init__(*args, **kwargs)
+        self.regions = [list(range(i, i+5)) for i in range(0, 45, 5)] + [[45]]
+
+    def _pipeline(self, dtype):
+        fnirs = Fnirslib(self.filename, self.regions, 0, 'condition_1', dtype=dtype)
+        data, stims = fnirs.load_nirs()
+        mean, _ = fnirs.get_ROI(data, stims, aggMethod='mean')
+        concat, _ = fnirs.get_ROI(data, stims, aggMethod='concat')
+        concat = fnirs.cluster_channels(fnirs.detrend(concat))
+        corr, zscores = fnirs.functional_connectivity(concat[:,0,:].T)
+        return data, stims, {'peak': fnirs.peak_activation(mean[:,0,:]), 'mean': fnirs.mean_activation(mean[:,0,:]),
+                             'clustered': concat, 'corr': corr, 'zscores': zscores}
+
+    def test_float32_pipeline(self):
+        data64, stims64, results64 = self._pipeline(None)
+        data32, stims32, results32 = self._pipeline(np.float32)
+        self.assertEqual(data32.dtype, np.float32)
+        self.assertEqual(data32.nbytes*2, data64.nbytes)
+        self.assertEqual(stims32.dtype, np.int8)
+        self.assertTrue(np.array_equal(stims32, stims64))
+        self.assertEqual(results32['clustered'].dtype, np.float32) # stored compactly through the stages
+        self.assertEqual(results32['mean'].dtype, np.float64) # accumulated in float64
+        for key in results64:
+            self.assertTrue(np.allclose(results32[key], results64[key], rtol=1e-4, atol=1e-4, equal_nan=True), key)
+        # a recording converts once and shares the compact data with its views
+        recording = Recording(self.filename, dtype=np.float32)
+        data, stims = recording.view(self.regions, 0, 'condition_1').load_nirs()
+        self.assertTrue(data.dtype == np.float32 and stims.dtype == np.int8)
+        self.assertTrue(data is recording.data)
+        # masking keeps float32 data float32 and does not copy when all channels are good
+        self.assertTrue(mask_channels(data, np.ones(46, dtype=bool)) is data)
+        masked = mask_channels(data, np.arange(46) != 3)
+        self.assertEqual(masked.dtype, np.float32)
+        self.assertTrue(np.all(np.isnan(masked[...,3])) and not np.any(np.isnan(masked[...,4])))
+        print('test_float32_pipeline passed')
+
+class TestStream(unittest.TestCase):
+    """
+    Test online processing by replaying a recording in blocks
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TestStream, cls).setUpClass()
+        cls.data, cls.stim, cls.starts, cls.stops = generate_data(10, 46, 2, 1000, 5)
+        cls.data = cls.data + np.random.rand(*cls.data.shape)
+
+    def __init__(self, *args, **kwargs):
+        super(TestStream, self).__init__(*args, **kwargs)
+        self.regions = [list(range(0, 20)), list(range(20, 30)), list(range(30, 46))]
+
+    def test_replay_matches_offline(self):
+        fnirs = Fnirslib('unused.nirs', self.regions, 1, 'condition_2')
+        baseline = fnirs.get_baseline(self.data, self.stim, 'local', duration=2, freq=4, perTrial=True)
+        stream = StreamProcessor(self.regions, 1, freq=4, detrend=False, peakPadding=2)
+        trials = [t for block in stream.replay(self.data, self.stim, blockSize=37) for t in block]
+        self.assertEqual(len(trials), 10)
+        for i, trial in enumerate(trials):
+            start, end = self.starts[10+i], self.stops[10+i]
+            self.assertEqual((trial['start'], trial['end']), (start, end))
+            self.assertTrue(np.allclose(trial['mean'], np.mean(self.data[start:end], axis=0)))
+            self.assertTrue(np.allclose(trial['baseline'], baseline[i]))
+            peak = Metrics(self.data[start:end], 2).get_peak_activation(baseline=baseline[i])
+            self.assertTrue(np.allclose(trial['peak'], peak))
+        # missing (NaN) samples are left out of the trial means, as in the batch path
+        data = self.data.copy()
+        start, end = self.starts[10], self.stops[10]
+        data[start:start+3,0,5] = np.nan
+        stream = StreamProcessor(self.regions, 1, freq=4, detrend=False, peakPadding=2)
+        trial = [t for block in stream.replay(data, self.stim, blockSize=37) for t in block][0]
+        self.assertTrue(np.allclose(trial['mean'], fnirs.mean_activation(data[start:end].reshape(end-start, -1)).reshape(3, 46)))
+        self.assertFalse(np.isnan(trial['mean'][0,5]))
+        print('test_replay_matches_offline passed')
+
+    def test_block_size_invariance(self):
+        results = []
+        for blockSize in [1, 50, 1000]:
+            stream = StreamProcessor(self.regions, 0, freq=4, fcWindow=25)
+            trials = [t for block in stream.replay(self.data, self.stim, blockSize) for t in block]
+            results.append((trials, stream.connectivity()[0]))
+        for trials, corr in results[1:]:
+            self.assertTrue(np.allclose([t['peak'] for t in trials], [t['peak'] for t in results[0][0]]))
+            self.assertTrue(np.allclose(corr, results[0][1], equal_nan=True))
+        detrended = OnlineDetrend()(self.data)
+        expected, _ = functional_connectivity(detrended[-100:,0,:] @ region_matrix(self.regions, 46))
+        self.assertTrue(np.allclose(results[0][1], expected, equal_nan=True))
+        line = OnlineDetrend()(np.arange(20.)[:,None]*3 + 1)
+        self.assertTrue(np.allclose(line, 0)) # a line is removed exactly
+        print('test_block_size_invariance passed')
+
 class TestMetrics(unittest.TestCase):
     """
     Test the metrics
@@ -124,6 +1080,18 @@ class TestMetrics(unittest.TestCase):
         self.assertTrue(np.array_equal(d.get_peak_activation(), np.array([12.5, 2., 8/3., 2.]))) # check values
         print('test_get_peak_activation passed')
 
+    def test_get_peak_activation_nd(self):
+        d = Metrics(self.data, peakPadding=1)
+        d.get_peak_activation()
+        self.assertEqual(d.overshoot, (1, 1)) # peaks at the first and last sample
+        data = np.random.rand(50, 3, 7, 4) # samples x chromophores x channels x trials
+        peak = Metrics(data, peakPadding=3).get_peak_activation(baseline=np.ones(4))
+        self.assertEqual(peak.shape, (3, 7, 4))
+        for idx in [(0, 0, 0), (1, 5, 2), (2, 6, 3)]:
+            column = data[(slice(None),)+idx]
+            self.assertAlmostEqual(peak[idx], Metrics(column[:,None], peakPadding=3).get_peak_activation()[0] - 1)
+        print('test_get_peak_activation_nd passed')
+
     def test_functional_connectivity(self):
         con,_ = Metrics(self.data.T).get_functional_connectivity()
         print(con.shape)
@@ -132,5 +1100,89 @@ class TestMetrics(unittest.TestCase):
         print(diag)
         self.assertEqual(con.shape, (self.data.shape[1], self.data.shape[1])) # check shape
 
+    def test_functional_connectivity_values(self):
+        corr, zscores = Metrics(self.data.T).get_functional_connectivity()
+        expected = np.corrcoef(self.data.T)
+        offDiag = ~np.eye(self.data.shape[1], dtype=bool)
+        self.assertTrue(np.allclose(corr[offDiag], expected[offDiag]))
+        self.assertTrue(np.all(np.isnan(np.diag(corr))))
+        self.assertTrue(np.all(np.isnan(np.diag(zscores)))) # no inf on the diagonal
+        self.assertTrue(np.allclose(zscores[offDiag], np.arctanh(expected[offDiag])))
+        print('test_functional_connectivity_values passed')
+
+class TestConnectivity(unittest.TestCase):
+    """
+    Test batched connectivity and group statistics
+    """
+    def test_batched_connectivity(self):
+        data = np.random.rand(6, 200, 5) # subjects x samples x regions
+        corr, zscores = functional_connectivity(data)
+        self.assertEqual(corr.shape, (6, 5, 5))
+        for i in range(6):
+            single, _ = functional_connectivity(data[i])
+            self.assertTrue(np.allclose(corr[i], single, equal_nan=True))
+        print('test_batched_connectivity passed')
+
+    def test_sliding_connectivity(self):
+        data = np.cumsum(np.random.randn(500, 4), axis=0) + 100
+        for width, step in [(50, 1), (60, 7), (20, 30)]:
+            corr, zscores = Metrics(data.T).get_dynamic_connectivity(width, step)
+            self.assertEqual(corr.shape, ((500-width)//step+1, 4, 4))
+            for w in [0, 5, corr.shape[0]-1]:
+                expected, _ = functional_connectivity(data[w*step:w*step+width])
+                self.assertTrue(np.allclose(corr[w], expected, equal_nan=True))
+            self.assertTrue(np.all(np.isnan(zscores[:, 0, 0])))
+        print('test_sliding_connectivity passed')
+
+    def test_effective_connectivity(self):
+        np.random.seed(1)
+        data = np.zeros((3, 2000, 3)) # subjects x samples x regions, region 0 drives region 1
+        noise = np.random.randn(*data.shape)
+        for t in range(2, data.shape[1]):
+            data[:,t,0] = 0.5*data[:,t-1,0] + noise[:,t,0]
+            data[:,t,1] = 0.3*data[:,t-1,1] + 0.8*data[:,t-2,0] + noise[:,t,1]
+            data[:,t,2] = 0.4*data[:,t-1,2] + noise[:,t,2]
+        gc, pvalues, order = Metrics(np.swapaxes(data, 1, 2)).get_effective_connectivity(maxOrder=6)
+        self.assertEqual(order, 2)
+        self.assertEqual(gc.shape, (3, 3, 3))
+        self.assertTrue(np.all(pvalues[:,1,0] < 0.001)) # 0 -> 1
+        self.assertTrue(np.all(gc[:,1,0] > 10*gc[:,0,1]))
+        single, _ = granger_causality(data[1], 2)
+        self.assertTrue(np.allclose(single, gc[1], equal_nan=True))
+        aic, bic = order_criteria(data[0], 6)
+        for p in [1, 3]: # criteria from the shared factorization match refitting each order
+            design, targets = np.concatenate([data[0, 6-k:-k] for k in range(1, p+1)], axis=1), data[0, 6:]
+            design, targets = design - design.mean(axis=0), targets - targets.mean(axis=0)
+            resid = targets - design @ np.linalg.lstsq(design, targets, rcond=None)[0]
+            n = targets.shape[0]
+            self.assertAlmostEqual(bic[p-1], np.linalg.slogdet(resid.T @ resid / n)[1] + np.log(n)*p*9/n, places=2)
+        print('test_effective_connectivity passed')
+
+    def test_group_connectivity(self):
+        data = np.random.rand(9, 100, 4)
+        corr, zscores = functional_connectivity(data)
+        group = GroupConnectivity()
+        for i in range(5):
+            group.add(corr[i], zscores[i])
+        other = GroupConnectivity()
+        other.add(corr[5:], zscores[5:]) # batch of subjects, e.g. from another worker
+        group.merge(other)
+        self.assertEqual(group.count, 9)
+        self.assertTrue(np.allclose(group.corr.mean, np.mean(corr, axis=0), equal_nan=True))
+        self.assertTrue(np.allclose(group.zscores.variance, np.var(zscores, axis=0, ddof=1), equal_nan=True))
+        # a subject missing a region (all its channels masked) only drops out of that region's entries
+        corr[2,1,:] = corr[2,:,1] = np.nan
+        group = GroupConnectivity()
+        group.add(corr[:4], zscores[:4])
+        for i in range(4, 9):
+            group.add(corr[i], zscores[i])
+        offDiag = ~np.eye(4, dtype=bool) # the diagonal is NaN for every subject
+        self.assertTrue(np.allclose(group.corr.mean[offDiag], np.nanmean(corr[:,offDiag], axis=0)))
+        self.assertTrue(np.all(np.isnan(np.diag(group.corr.mean))))
+        self.assertEqual(group.corr.counts[1,2], 8)
+        self.assertEqual(group.corr.counts[0,2], 9)
+        self.assertTrue(np.allclose(group.corr.variance[1,2], np.nanvar(corr[:,1,2], ddof=1)))
+        print('test_group_connectivity passed')
+
 if __name__ == '__main__':
     unittest.main()